@@ -0,0 +1,308 @@
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import ANN_MIN_TRAIN_SIZE, ANN_N_PROBE, EMBEDDING_DTYPE
+from quantization import code_dtype, dequantize, nbytes, quantize, quantized_scores
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PartitionKey = Tuple[str, str, str]  # (request_type, city, category)
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _select_top_k(ids: np.ndarray, scores: np.ndarray, k: int,
+                  min_score: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Отбирает k лучших результатов не ниже порога, по убыванию схожести"""
+    np.clip(scores, 0.0, 1.0, out=scores)
+    keep = scores >= min_score
+    ids, scores = ids[keep], scores[keep]
+
+    if 0 < k < len(scores):
+        order = np.argpartition(-scores, k - 1)[:k]
+    else:
+        order = np.arange(len(scores))
+    order = order[np.argsort(-scores[order], kind="stable")]
+    return ids[order], scores[order]
+
+
+class IVFIndex:
+    """
+    Инвертированный индекс (IVF) по косинусной схожести на NumPy.
+    Пока векторов меньше min_train_size, поиск идёт точным перебором.
+    После обучения k-means запрос сравнивается только с n_probe ближайшими кластерами.
+    Векторы хранятся сжатыми (dtype: float32 / float16 / int8), поиск идёт прямо по кодам
+    """
+
+    def __init__(self, dim: int = 512, n_probe: int = ANN_N_PROBE,
+                 min_train_size: int = ANN_MIN_TRAIN_SIZE, seed: int = 0,
+                 dtype: str = EMBEDDING_DTYPE):
+        self.dim = dim
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.dtype = dtype
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.RLock()
+
+        self._codes = np.empty((0, dim), dtype=code_dtype(dtype))
+        self._scales = np.empty(0, dtype=np.float32)  # Масштаб на вектор (для int8)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._alive = np.empty(0, dtype=bool)
+        self._size = 0  # Количество занятых строк (включая удалённые)
+        self._row_of: Dict[int, int] = {}
+
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[List[int]] = []
+        self._list_cache: Dict[int, np.ndarray] = {}
+        self._trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+    def __contains__(self, request_id: int) -> bool:
+        return request_id in self._row_of
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    @property
+    def memory_bytes(self) -> int:
+        """Память под векторы (занятые строки)"""
+        return nbytes(self._codes[:self._size], self._scales[:self._size])
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        return dequantize(self._codes[rows], self._scales[rows])
+
+    # ---------- Изменение индекса ----------
+
+    def add(self, request_id: int, vector: np.ndarray):
+        self.add_many([request_id], np.asarray(vector)[None, :])
+
+    def add_many(self, request_ids: Iterable[int], vectors: np.ndarray):
+        """Добавляет (или заменяет) векторы заявок"""
+        request_ids = [int(req_id) for req_id in request_ids]
+        if not request_ids:
+            return
+        vectors = _normalize_rows(vectors)
+
+        with self._lock:
+            for req_id in request_ids:
+                self._discard(req_id)
+
+            self._ensure_capacity(len(request_ids))
+            rows = np.arange(self._size, self._size + len(request_ids))
+            self._codes[rows], self._scales[rows] = quantize(vectors, self.dtype)
+            self._ids[rows] = request_ids
+            self._alive[rows] = True
+            self._size += len(request_ids)
+            self._row_of.update(zip(request_ids, rows.tolist()))
+
+            if self.is_trained:
+                self._append_to_lists(rows, self._assign(rows))
+            self._maybe_retrain()
+
+    def remove(self, request_id: int) -> bool:
+        """Удаляет заявку из индекса (например, при деактивации)"""
+        with self._lock:
+            removed = self._discard(request_id)
+            dead = self._size - len(self._row_of)
+            if dead > max(self.min_train_size, len(self._row_of)):
+                self._compact()
+            return removed
+
+    def _discard(self, request_id: int) -> bool:
+        row = self._row_of.pop(request_id, None)
+        if row is None:
+            return False
+        self._alive[row] = False
+        return True
+
+    def _ensure_capacity(self, extra: int):
+        needed = self._size + extra
+        if needed <= len(self._ids):
+            return
+        capacity = max(needed, 2 * len(self._ids), 64)
+
+        codes = np.empty((capacity, self.dim), dtype=self._codes.dtype)
+        codes[:self._size] = self._codes[:self._size]
+        scales = np.ones(capacity, dtype=np.float32)
+        scales[:self._size] = self._scales[:self._size]
+        ids = np.empty(capacity, dtype=np.int64)
+        ids[:self._size] = self._ids[:self._size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._size] = self._alive[:self._size]
+
+        self._codes, self._scales, self._ids, self._alive = codes, scales, ids, alive
+
+    def _compact(self):
+        """Физически удаляет помеченные строки и перераспределяет их по кластерам"""
+        rows = np.flatnonzero(self._alive[:self._size])
+        self._codes = np.ascontiguousarray(self._codes[rows])
+        self._scales = self._scales[rows].copy()
+        self._ids = self._ids[rows].copy()
+        self._alive = np.ones(len(rows), dtype=bool)
+        self._size = len(rows)
+        self._row_of = {int(req_id): row for row, req_id in enumerate(self._ids)}
+
+        if self.is_trained:
+            self._reset_lists()
+            all_rows = np.arange(self._size)
+            self._append_to_lists(all_rows, self._assign(all_rows))
+
+    # ---------- Кластеризация ----------
+
+    def _maybe_retrain(self):
+        n = len(self._row_of)
+        if n < self.min_train_size:
+            return
+        # Переобучаем при росте вдвое, чтобы кластеры оставались сбалансированными
+        if not self.is_trained or n > 2 * self._trained_size:
+            self.train()
+
+    def train(self, n_iter: int = 10):
+        """Обучает центроиды сферическим k-means на выборке векторов"""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._size])
+            if len(rows) == 0:
+                return
+            n_lists = max(1, int(np.sqrt(len(rows))))
+            sample_size = min(len(rows), n_lists * 64)
+            sample = _normalize_rows(self._decode(self._rng.choice(rows, sample_size, replace=False)))
+
+            centroids = sample[self._rng.choice(sample_size, n_lists, replace=False)].copy()
+            for _ in range(n_iter):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sample)
+                counts = np.bincount(assignment, minlength=n_lists)
+                non_empty = counts > 0
+                centroids[non_empty] = _normalize_rows(sums[non_empty])
+
+            self._centroids = centroids
+            self._trained_size = len(rows)
+            self._reset_lists()
+            self._append_to_lists(rows, self._assign(rows))
+            logger.info(f"IVF индекс обучен: {len(rows)} векторов, {n_lists} кластеров")
+
+    def _reset_lists(self):
+        self._lists = [[] for _ in range(len(self._centroids))]
+        self._list_cache.clear()
+
+    def _assign(self, rows: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        """Ближайший центроид для строк индекса; коды разжимаются блоками"""
+        parts = [np.argmax(self._decode(rows[i:i + chunk]) @ self._centroids.T, axis=1)
+                 for i in range(0, len(rows), chunk)]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def _append_to_lists(self, rows: np.ndarray, assignment: np.ndarray):
+        for row, list_no in zip(rows.tolist(), assignment.tolist()):
+            self._lists[list_no].append(row)
+            self._list_cache.pop(list_no, None)
+
+    def _list_rows(self, list_no: int) -> np.ndarray:
+        rows = self._list_cache.get(list_no)
+        if rows is None:
+            rows = np.fromiter(self._lists[list_no], dtype=np.int64, count=len(self._lists[list_no]))
+            self._list_cache[list_no] = rows
+        return rows
+
+    # ---------- Поиск ----------
+
+    def search(self, query: np.ndarray, k: int,
+               min_score: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """Приближённый top-k поиск с порогом схожести"""
+        with self._lock:
+            if not self.is_trained:
+                return self.search_exact(query, k, min_score)
+
+            query = _normalize_rows(query)[0]
+            n_probe = min(self.n_probe, len(self._centroids))
+            probes = np.argpartition(-(self._centroids @ query), n_probe - 1)[:n_probe]
+            rows = np.concatenate([self._list_rows(list_no) for list_no in probes])
+            rows = rows[self._alive[rows]]
+
+            scores = quantized_scores(self._codes[rows], self._scales[rows], query)
+            return _select_top_k(self._ids[rows], scores, k, min_score)
+
+    def search_exact(self, query: np.ndarray, k: int,
+                     min_score: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """Точный перебор: запасной путь и эталон для проверки полноты"""
+        with self._lock:
+            query = _normalize_rows(query)[0]
+            alive = self._alive[:self._size]
+            scores = quantized_scores(self._codes[:self._size], self._scales[:self._size], query)
+            return _select_top_k(self._ids[:self._size][alive], scores[alive], k, min_score)
+
+
+class PartitionedIndex:
+    """Набор IVF индексов, по одному на партицию (request_type, city, category)"""
+
+    def __init__(self, **index_kwargs):
+        self.index_kwargs = index_kwargs
+        self._partitions: Dict[PartitionKey, IVFIndex] = {}
+        self._partition_of: Dict[int, PartitionKey] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._partition_of)
+
+    def __contains__(self, request_id: int) -> bool:
+        return request_id in self._partition_of
+
+    def add(self, request_id: int, key: PartitionKey, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        with self._lock:
+            if self._partition_of.get(request_id, key) != key:
+                self.remove(request_id)
+            index = self._partitions.get(key)
+            if index is None:
+                index = IVFIndex(dim=len(vector), **self.index_kwargs)
+                self._partitions[key] = index
+            index.add(request_id, vector)
+            self._partition_of[request_id] = key
+
+    def remove(self, request_id: int) -> bool:
+        with self._lock:
+            key = self._partition_of.pop(request_id, None)
+            if key is None:
+                return False
+            return self._partitions[key].remove(request_id)
+
+    def search(self, key: PartitionKey, query: np.ndarray, k: int,
+               min_score: float = 0.0, exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """top-k поиск внутри партиции; exact=True - точный перебор"""
+        index = self._partitions.get(key)
+        if index is None or len(index) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if exact:
+            return index.search_exact(query, k, min_score)
+        return index.search(query, k, min_score)
+
+    def search_many(self, keys: Iterable[PartitionKey], query: np.ndarray, k: int,
+                    min_score: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """top-k сразу по нескольким партициям: лучшие результаты каждой сливаются"""
+        results = [self.search(key, query, k, min_score) for key in keys]
+        if not results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids = np.concatenate([ids for ids, _ in results])
+        scores = np.concatenate([scores for _, scores in results]).astype(np.float32)
+        return _select_top_k(ids, scores, k, min_score)
+
+    def partition_sizes(self) -> Dict[PartitionKey, int]:
+        with self._lock:
+            return {key: len(index) for key, index in self._partitions.items()}
+
+    def clear(self):
+        with self._lock:
+            self._partitions.clear()
+            self._partition_of.clear()
@@ -0,0 +1,298 @@
+import argparse
+import json
+import logging
+import sqlite3
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import (ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_DATABASE_NAME, ARCHIVE_PHOTO_STORE_DIR,
+                    ARCHIVE_THUMBNAIL_STORE_DIR, CLIP_MODEL_NAME, DATABASE_NAME, EMBEDDING_VERSION,
+                    PHOTO_STORE_DIR, THUMBNAIL_STORE_DIR, VACUUM_PAGES)
+from database import connect
+from metrics import ARCHIVED_REQUESTS
+from migrations import REQUESTS_COLUMNS, REQUESTS_TABLE_SQL, _table_columns
+from photo_store import PhotoStore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Колонки заявки, переносимые в архив (столбцы, добавленные миграциями, - в конце)
+ARCHIVE_COLUMNS = REQUESTS_COLUMNS + ", dhash, trace_id, chip_match_id, chip_number_raw, matched_at"
+
+# Заявки к архивации порциями: деактивированные и вышедшие из окна фоновой обработки.
+# Оба запроса идут по idx_requests_active_created
+DEACTIVATED_SQL = "SELECT id FROM requests WHERE is_active = 0 LIMIT ?"
+EXPIRED_REQUESTS_SQL = """
+    SELECT id FROM requests
+    WHERE is_active = 1 AND created_at <= datetime('now', ?)
+    LIMIT ?
+"""
+
+# Нужен ли файл фото оставшимся заявкам - по idx_requests_photo_hash
+PHOTO_IN_USE_SQL = "SELECT 1 FROM requests WHERE photo_hash = ? LIMIT 1"
+
+# Поиск по архиву: полный проход по эмбеддингам текущей модели (порциями, по запросу)
+ARCHIVE_SEARCH_SQL = """
+    SELECT r.id, r.user_id, r.request_type, r.city, r.category, r.breed, r.photo_hash, e.vector
+    FROM requests r
+    JOIN embeddings e ON e.request_id = r.id
+    WHERE e.model_name = ? AND e.model_version = ? {city_filter}
+"""
+
+SEARCH_CHUNK_SIZE = 4096
+
+
+def _ensure_archive_schema(conn: sqlite3.Connection):
+    """Схема архива: заявки с колонками горячей таблицы, эмбеддинги и время переноса"""
+    conn.execute(REQUESTS_TABLE_SQL.format(table="requests"))
+    columns = _table_columns(conn, "requests")
+    for column, column_type in (("dhash", "INTEGER"), ("trace_id", "TEXT"), ("chip_match_id", "INTEGER"),
+                                ("chip_number_raw", "TEXT"), ("matched_at", "TIMESTAMP"),
+                                ("archived_at", "TIMESTAMP")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE requests ADD COLUMN {column} {column_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_city ON requests(city)")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_archive_chip
+        ON requests(chip_number) WHERE chip_number IS NOT NULL
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS embeddings (
+            request_id INTEGER PRIMARY KEY,
+            model_name TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL
+        )
+    """)
+    conn.commit()
+    # connect() уже перевёл файл в WAL, и PRAGMA auto_vacuum сам по себе не действует -
+    # режим меняется полным VACUUM, как в миграции 12 (для нового архива это мгновенно)
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+class Archive:
+    """
+    Холодный архив заявок. Деактивированные и вышедшие из окна фоновой обработки заявки
+    вместе с эмбеддингами переносятся в отдельную БД, их фото - в отдельный каталог.
+    Горячая таблица, её индексы, индекс векторов и кеши остаются размером с активное окно.
+    В архиве можно искать по описанию (/archive) - полным проходом, только по запросу
+    """
+
+    def __init__(self, db_path: str = DATABASE_NAME, archive_path: str = ARCHIVE_DATABASE_NAME,
+                 after_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.photo_store = PhotoStore(PHOTO_STORE_DIR)
+        self.thumbnail_store = PhotoStore(THUMBNAIL_STORE_DIR)
+        self.archive_photo_store = PhotoStore(ARCHIVE_PHOTO_STORE_DIR)
+        self.archive_thumbnail_store = PhotoStore(ARCHIVE_THUMBNAIL_STORE_DIR)
+        self._schema_ready = False
+
+    def _connect_archive(self) -> sqlite3.Connection:
+        conn = connect(self.archive_path)
+        if not self._schema_ready:
+            _ensure_archive_schema(conn)
+            self._schema_ready = True
+        return conn
+
+    def _due_ids(self, reason: str) -> List[int]:
+        conn = connect(self.db_path)
+        try:
+            if reason == "deactivated":
+                rows = conn.execute(DEACTIVATED_SQL, (self.batch_size,)).fetchall()
+            else:
+                rows = conn.execute(EXPIRED_REQUESTS_SQL, (f"-{self.after_days} days", self.batch_size)).fetchall()
+            return [row[0] for row in rows]
+        finally:
+            conn.close()
+
+    def _copy_photo(self, photo_hash: str):
+        """Фото и миниатюра в архивное хранилище (повторное копирование ничего не пишет)"""
+        for source, target in ((self.photo_store, self.archive_photo_store),
+                               (self.thumbnail_store, self.archive_thumbnail_store)):
+            if source.exists(photo_hash) and not target.exists(photo_hash):
+                target.put(source.read(photo_hash), key=photo_hash)
+
+    def _archive_batch(self, request_ids: List[int]) -> int:
+        """
+        Переносит порцию заявок. Порядок шагов - копия в архив, удаление из горячей БД,
+        удаление файлов: сбой между шагами оставляет лишь копию, которую следующий проход перезапишет
+        (или файлы без заявок - их уберёт следующий перенос с тем же фото).
+        Возвращает число фото, убранных из горячего хранилища
+        """
+        placeholders = ", ".join("?" * len(request_ids))
+        conn = connect(self.db_path)
+        try:
+            rows = conn.execute(f"SELECT {ARCHIVE_COLUMNS} FROM requests WHERE id IN ({placeholders})",
+                                request_ids).fetchall()
+            embeddings = conn.execute(f"""
+                SELECT request_id, model_name, model_version, dim, vector FROM embeddings
+                WHERE request_id IN ({placeholders})
+            """, request_ids).fetchall()
+        finally:
+            conn.close()
+
+        photo_hashes = sorted({row[3] for row in rows})
+        for photo_hash in photo_hashes:
+            self._copy_photo(photo_hash)
+
+        archive = self._connect_archive()
+        try:
+            column_count = len(ARCHIVE_COLUMNS.split(","))
+            archive.executemany(f"""
+                INSERT OR REPLACE INTO requests ({ARCHIVE_COLUMNS}, archived_at)
+                VALUES ({", ".join("?" * column_count)}, CURRENT_TIMESTAMP)
+            """, rows)
+            archive.executemany("""
+                INSERT OR REPLACE INTO embeddings (request_id, model_name, model_version, dim, vector)
+                VALUES (?, ?, ?, ?, ?)
+            """, embeddings)
+            archive.commit()
+        finally:
+            archive.close()
+
+        conn = connect(self.db_path)
+        try:
+            conn.execute(f"DELETE FROM embeddings WHERE request_id IN ({placeholders})", request_ids)
+            conn.execute(f"DELETE FROM embedding_failures WHERE request_id IN ({placeholders})", request_ids)
+            conn.execute(f"DELETE FROM requests WHERE id IN ({placeholders})", request_ids)
+            # Ждущие задачи воркеров по перенесённым заявкам больше не нужны
+            conn.execute(f"""
+                DELETE FROM jobs
+                WHERE kind = 'match' AND status IN ('pending', 'running') AND request_id IN ({placeholders})
+            """, request_ids)
+            conn.commit()
+        finally:
+            conn.close()
+        return self._delete_photos(photo_hashes)
+
+    def _delete_photos(self, photo_hashes: List[str]) -> int:
+        """
+        Удаляет из горячего хранилища фото, на которые больше не ссылается ни одна заявка.
+        Проверка и удаление файлов идут под блокировкой записи: save_request берёт её до того,
+        как положить или переиспользовать файл, поэтому новая заявка не сошлётся на удалённое фото
+        """
+        conn = connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            orphaned = [photo_hash for photo_hash in photo_hashes
+                        if conn.execute(PHOTO_IN_USE_SQL, (photo_hash,)).fetchone() is None]
+            # Кеш по file_unique_id не должен указывать на убранное фото
+            conn.executemany("DELETE FROM photo_cache WHERE photo_hash = ?", [(h,) for h in orphaned])
+            for photo_hash in orphaned:
+                self.photo_store.delete(photo_hash)
+                self.thumbnail_store.delete(photo_hash)
+            conn.commit()
+        finally:
+            conn.close()
+        return len(orphaned)
+
+    def _purge_outbox(self) -> int:
+        """Отправленные уведомления старше окна - история в notifications остаётся"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.execute("DELETE FROM outbox WHERE sent_at IS NOT NULL AND sent_at <= datetime('now', ?)",
+                                  (f"-{self.after_days} days",))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def _purge_removals(self) -> int:
+        """Журнал выбывших заявок старше окна: работающие процессы давно его прочитали"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.execute("DELETE FROM request_removals WHERE removed_at <= datetime('now', ?)",
+                                  (f"-{self.after_days} days",))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def vacuum(self, pages: int = VACUUM_PAGES) -> int:
+        """Возвращает файловой системе до pages свободных страниц каждой БД; число освобождённых"""
+        freed = 0
+        for path in (self.db_path, self.archive_path):
+            conn = self._connect_archive() if path == self.archive_path else connect(path)
+            try:
+                before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                # executescript проходит PRAGMA до конца; execute освободил бы одну страницу
+                conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+                freed += before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            finally:
+                conn.close()
+        return freed
+
+    def archive_expired(self, max_batches: Optional[int] = None) -> Dict[str, int]:
+        """Переносит в архив все заявки к архивации (или max_batches порций) и освобождает место"""
+        stats = {"deactivated": 0, "expired": 0, "photos": 0}
+        batches = 0
+        for reason in ("deactivated", "expired"):
+            while max_batches is None or batches < max_batches:
+                request_ids = self._due_ids(reason)
+                if not request_ids:
+                    break
+                stats["photos"] += self._archive_batch(request_ids)
+                stats[reason] += len(request_ids)
+                ARCHIVED_REQUESTS.inc(len(request_ids), reason=reason)
+                batches += 1
+        stats["outbox"] = self._purge_outbox()
+        stats["removals"] = self._purge_removals()
+        stats["freed_pages"] = self.vacuum()
+        logger.info(f"Архивация: {stats}")
+        return stats
+
+    def search(self, query: np.ndarray, city: Optional[str] = None, top_k: int = 5,
+               model_name: str = CLIP_MODEL_NAME, model_version: str = EMBEDDING_VERSION) -> list:
+        """
+        top-k архивных заявок, чьи фото ближе всего к вектору запроса.
+        Результат в формате text_search.SearchResult
+        """
+        query = np.asarray(query, dtype=np.float32).ravel()
+        params: list = [model_name, model_version]
+        city_filter = ""
+        if city is not None:
+            city_filter = "AND r.city = ?"
+            params.append(city)
+
+        best: list = []
+        conn = self._connect_archive()
+        try:
+            cursor = conn.execute(ARCHIVE_SEARCH_SQL.format(city_filter=city_filter), params)
+            while rows := cursor.fetchmany(SEARCH_CHUNK_SIZE):
+                matrix = np.stack([np.frombuffer(row[7], dtype=np.float32) for row in rows])
+                scores = matrix @ query
+                # Держим только лучших из уже просмотренного
+                keep = np.argsort(-scores)[:top_k]
+                best.extend(rows[i][:7] + (float(scores[i]),) for i in keep)
+                best = sorted(best, key=lambda result: -result[7])[:top_k]
+        finally:
+            conn.close()
+        return best
+
+    def photo_path(self, photo_hash: str):
+        """Путь к миниатюре или оригиналу фото архивной заявки (None, если файла нет)"""
+        for store in (self.archive_thumbnail_store, self.archive_photo_store,
+                      self.thumbnail_store, self.photo_store):
+            if store.exists(photo_hash):
+                return store.path(photo_hash)
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос истёкших и деактивированных заявок в архив")
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--archive", default=ARCHIVE_DATABASE_NAME)
+    parser.add_argument("--max-batches", type=int, default=None)
+    args = parser.parse_args()
+    print(json.dumps(Archive(args.db, args.archive).archive_expired(args.max_batches), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
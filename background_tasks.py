@@ -1,26 +1,82 @@
 # background_tasks.py
+import asyncio
 import logging
+import time
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from datetime import datetime, timedelta
-import sqlite3
-from typing import List, Tuple
+from typing import List, Optional, Set, Tuple
 from aiogram import Bot
-from aiogram.types import InlineKeyboardButton
 
+from archive import Archive
+from config import ARCHIVE_INTERVAL_HOURS, DATABASE_NAME, JOB_QUEUE_ENABLED
+from database import connect
 from image_comparison import ImageComparator
+from image_processing import inference_service
+from job_queue import PRIORITY_SUBMITTED, PRIORITY_SWEEP, Job, JobQueue
+from metrics import JOBS_BY_STATUS, JOBS_PROCESSED, PARTITION_ACTIVE_REQUESTS, SWEEP_DURATION, SWEEP_REQUESTS
+from notifier import OutboundSender, enqueue_notifications
+from tracing import trace_id_var
+from worker_pool import WorkerPool, worker_pool
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Горячие запросы прохода (их планы проверяет migrations.check_query_plans).
+# Заявки, уже совпавшие по номеру чипа, сопоставлять через CLIP не нужно.
+# matched - заявку уже сопоставили сразу после подачи: проход только сдвигает за неё watermark
+NEW_REQUESTS_SQL = """
+    SELECT id, trace_id, matched_at IS NOT NULL AS matched FROM requests 
+    WHERE is_active = 1 
+    AND id > ?
+    AND created_at > datetime('now', '-30 days')
+    AND chip_match_id IS NULL
+    ORDER BY id
+"""
+
+# Совпадений на один запрос при подготовке уведомлений (2 параметра на совпадение)
+NOTIFY_CHUNK_SIZE = 400
+
+# Без очереди задач неудачные заявки повторяет сам проход - как воркер с этим id
+SWEEP_WORKER_ID = "sweep"
+RETRY_BATCH = 8
+
+REEVALUATE_SQL = """
+    SELECT id, trace_id FROM requests
+    WHERE request_type = ?
+    AND city = ?
+    AND category = ?
+    AND id <= ?
+    AND is_active = 1
+    AND created_at > datetime('now', '-30 days')
+    AND chip_match_id IS NULL
+"""
+
+
+# Совпадение к отправке: (match_id, similarity, source_user_id, match_user_id,
+# source_chat_id, match_chat_id, submitted_at)
+PreparedNotification = Tuple[int, float, int, int, int, int, Optional[float]]
+
 
 class BackgroundProcessor:
-    def __init__(self, bot: Bot, db_path: str = "database.db"):
+    def __init__(self, bot: Bot, db_path: str = DATABASE_NAME, pool: WorkerPool = worker_pool,
+                 use_job_queue: bool = JOB_QUEUE_ENABLED):
         self.bot = bot
         self.db_path = db_path
+        self.pool = pool  # SQLite и инференс выполняются вне event loop
+        # С очередью задач проход только ставит заявки в jobs, сопоставляют воркеры (worker.py)
+        self.use_job_queue = use_job_queue
+        self.jobs = JobQueue(db_path)
         self.scheduler = AsyncIOScheduler()
         self.comparator = ImageComparator(db_path)
+        self.archive = Archive(db_path)
+        # Проход и архивация не работают одновременно
+        self._maintenance_lock = asyncio.Lock()
         self.NOTIFICATION_THRESHOLD = 0.85  # Порог для уведомлений
+        self._sweep_task: Optional[asyncio.Task] = None
+        # Сопоставления только что поданных заявок, запущенные вне часового прохода
+        self._submitted: Set[asyncio.Task] = set()
+        self.sender = OutboundSender(bot, db_path, pool)
 
     async def start(self):
         """Запускает периодические задачи"""
@@ -29,159 +85,423 @@ class BackgroundProcessor:
             trigger=IntervalTrigger(hours=1),
             next_run_time=datetime.now() + timedelta(seconds=1)
         )
+        self.scheduler.add_job(
+            self.archive_expired,
+            trigger=IntervalTrigger(hours=ARCHIVE_INTERVAL_HOURS),
+            next_run_time=datetime.now() + timedelta(minutes=5)
+        )
         self.scheduler.start()
+        self.sender.start()
         logger.info("Фоновая обработка запущена")
 
     async def stop(self):
-        """Останавливает задачи"""
-        self.scheduler.shutdown()
+        """Останавливает задачи и отменяет текущий проход"""
+        self.scheduler.shutdown(wait=False)
+        if self._sweep_task and not self._sweep_task.done():
+            self._sweep_task.cancel()
+            await asyncio.gather(self._sweep_task, return_exceptions=True)
+        for task in list(self._submitted):
+            task.cancel()
+        await asyncio.gather(*self._submitted, return_exceptions=True)
+        await self.sender.stop()
+        await self.pool.shutdown()
         logger.info("Фоновая обработка остановлена")
 
-    async def process_all_requests(self):
-        """Основная задача обработки"""
-        logger.info("Начало обработки запросов...")
-
+    def _get_watermark(self) -> int:
+        """Максимальный id заявки, уже сопоставленной с противоположным пулом"""
+        conn = connect(self.db_path)
         try:
-            # Получаем активные запросы за последние 30 дней
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id FROM requests 
-                WHERE is_active = 1 
-                AND created_at > datetime('now', '-30 days')
-            """)
-            request_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT value FROM matcher_state WHERE key = 'last_request_id'")
+            row = cursor.fetchone()
+            return row[0] if row else 0
+        finally:
             conn.close()
 
-            # Обрабатываем каждый запрос
-            for request_id in request_ids:
-                await self.process_single_request(request_id)
+    def _set_watermark(self, request_id: int):
+        conn = connect(self.db_path)
+        try:
+            conn.execute("""
+                INSERT OR REPLACE INTO matcher_state (key, value)
+                VALUES ('last_request_id', ?)
+            """, (request_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _get_dirty_partitions(self) -> List[Tuple[str, str, str]]:
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT request_type, city, category FROM dirty_partitions")
+            return cursor.fetchall()
+        finally:
+            conn.close()
 
-            logger.info("Обработка завершена успешно")
+    def _get_requests_to_reevaluate(self, partition: Tuple[str, str, str],
+                                    watermark: int) -> List[Tuple[int, Optional[str]]]:
+        """Уже обработанные заявки, для которых изменившаяся партиция служит пулом кандидатов"""
+        request_type, city, category = partition
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(REEVALUATE_SQL, (self.comparator._get_opposite_request_type(request_type), city, category, watermark))
+            return cursor.fetchall()
+        finally:
+            conn.close()
 
-        except Exception as e:
-            logger.error(f"Ошибка обработки: {str(e)}")
+    def _get_new_request_ids(self, watermark: int) -> List[Tuple[int, Optional[str], int]]:
+        """Новые активные запросы за последние 30 дней: (id, trace_id, matched)"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(NEW_REQUESTS_SQL, (watermark,))
+            return cursor.fetchall()
+        finally:
+            conn.close()
 
-    async def process_single_request(self, request_id: int):
-        """Обработка одного запроса"""
+    def _enqueue_jobs(self, requests: List[Tuple[int, Optional[str]]], watermark: Optional[int] = None,
+                      partition: Optional[Tuple[str, str, str]] = None, priority: int = PRIORITY_SWEEP):
+        """
+        Ставит задачи сопоставления и в той же транзакции сдвигает watermark
+        (или снимает отметку с партиции) - заявка не потеряется и не попадёт в очередь дважды
+        """
+        conn = connect(self.db_path)
         try:
-            # Сравниваем с противоположными запросами
-            results = self.comparator.compare_with_database(request_id)
+            self.jobs.enqueue(conn, requests, priority=priority)
+            if watermark is not None:
+                conn.execute("""
+                    INSERT OR REPLACE INTO matcher_state (key, value)
+                    VALUES ('last_request_id', ?)
+                """, (watermark,))
+            if partition is not None:
+                conn.execute("""
+                    DELETE FROM dirty_partitions
+                    WHERE request_type = ? AND city = ? AND category = ?
+                """, partition)
+            conn.commit()
+        finally:
+            conn.close()
 
-            # Фильтруем результаты по порогу
-            filtered = [(rid, score) for rid, score in results if score >= self.NOTIFICATION_THRESHOLD]
+    async def archive_expired(self):
+        """Переносит истёкшие и деактивированные заявки в архив и убирает их из индекса"""
+        async with self._maintenance_lock:
+            try:
+                stats = await self.pool.run_db(self.archive.archive_expired)
+                if stats["deactivated"] or stats["expired"]:
+                    # Перенесённые заявки уходят из индекса по журналу request_removals
+                    await self.pool.run_db(self.comparator.sync)
+                    PARTITION_ACTIVE_REQUESTS.replace(self.comparator.index.partition_sizes())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка архивации: {str(e)}")
 
-            if filtered:
-                await self.notify_users(request_id, filtered)
+    async def process_all_requests(self):
+        """
+        Инкрементальная обработка: каждая новая заявка один раз сравнивается
+        с противоположным пулом, а старые пересматриваются только при изменении их партиции
+        """
+        async with self._maintenance_lock:
+            await self._process_all_requests()
+
+    async def _process_all_requests(self):
+        logger.info("Начало обработки запросов...")
+        self._sweep_task = asyncio.current_task()
+        started = time.perf_counter()
 
+        try:
+            watermark = await self.pool.run_db(self._get_watermark)
+            dirty_partitions = await self.pool.run_db(self._get_dirty_partitions)
+            request_ids = await self.pool.run_db(self._get_new_request_ids, watermark)
+
+            # Индекс догружает новые заявки и убирает выбывшие (в том числе в других процессах)
+            # по журналу - проход без новых заявок не перечитывает базу
+            await self.pool.run_db(self.comparator.sync)
+
+            if self.use_job_queue:
+                await self._enqueue_sweep(request_ids, dirty_partitions, watermark)
+                SWEEP_DURATION.set(time.perf_counter() - started)
+                PARTITION_ACTIVE_REQUESTS.replace(self.comparator.index.partition_sizes())
+                return
+
+            # Заявки, не сопоставленные на прошлых проходах, - с задержкой и пределом попыток
+            retried = await self._retry_failed()
+
+            # Новые заявки: сходство симметрично, поэтому пара (новая, старая)
+            # покрывает и старую заявку - её повторно сравнивать не нужно.
+            # Неудачная заявка ставится в jobs на повтор в той же транзакции, что и сдвиг watermark.
+            # Заявки, сопоставленные сразу после подачи, не сравниваются второй раз
+            failed = 0
+            skipped_upto = None
+            for request_id, trace_id, matched in request_ids:
+                if matched:
+                    skipped_upto = request_id
+                    continue
+                skipped_upto = None
+                if await self.process_single_request(request_id, trace_id):
+                    await self.pool.run_db(self._set_watermark, request_id)
+                else:
+                    await self.pool.run_db(self._enqueue_jobs, [(request_id, trace_id)], request_id)
+                    failed += 1
+                SWEEP_REQUESTS.inc(kind="new")
+            if skipped_upto is not None:
+                await self.pool.run_db(self._set_watermark, skipped_upto)
+
+            # Старые заявки, чей пул кандидатов изменился (досчитанные эмбеддинги, смена модели)
+            reevaluated = 0
+            for partition in dirty_partitions:
+                stale_ids = await self.pool.run_db(self._get_requests_to_reevaluate, partition, watermark)
+                retry = []
+                for request_id, trace_id in stale_ids:
+                    if not await self.process_single_request(request_id, trace_id):
+                        retry.append((request_id, trace_id))
+                    reevaluated += 1
+                    SWEEP_REQUESTS.inc(kind="reevaluated")
+                await self.pool.run_db(self._enqueue_jobs, retry, None, partition)
+                failed += len(retry)
+
+            logger.info(
+                f"Обработка завершена: новых заявок {sum(not matched for _, _, matched in request_ids)}, "
+                f"пересмотрено {reevaluated} в {len(dirty_partitions)} партициях, "
+                f"повторено {retried}, отложено на повтор {failed}"
+            )
+            logger.info(f"Метрики инференса: {inference_service.metrics()}")
+            SWEEP_DURATION.set(time.perf_counter() - started)
+            PARTITION_ACTIVE_REQUESTS.replace(self.comparator.index.partition_sizes())
+
+        except asyncio.CancelledError:
+            logger.info("Обработка прервана остановкой")
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка обработки: {str(e)}")
+        finally:
+            self._sweep_task = None
+
+    async def _enqueue_sweep(self, request_ids: List[Tuple[int, Optional[str], int]],
+                             dirty_partitions: List[Tuple[str, str, str]], watermark: int):
+        """Проход в режиме очереди: те же заявки, что и при обработке на месте, уходят воркерам"""
+        new_requests = [(request_id, trace_id) for request_id, trace_id, matched in request_ids if not matched]
+        if request_ids:
+            await self.pool.run_db(self._enqueue_jobs, new_requests, request_ids[-1][0])
+            SWEEP_REQUESTS.inc(len(new_requests), kind="new")
+
+        reevaluated = 0
+        for partition in dirty_partitions:
+            stale_ids = await self.pool.run_db(self._get_requests_to_reevaluate, partition, watermark)
+            await self.pool.run_db(self._enqueue_jobs, stale_ids, None, partition)
+            reevaluated += len(stale_ids)
+            SWEEP_REQUESTS.inc(len(stale_ids), kind="reevaluated")
+
+        purged = await self.pool.run_db(self.jobs.purge_done)
+        counts = await self.pool.run_db(self.jobs.counts)
+        JOBS_BY_STATUS.replace({(status,): count for status, count in counts.items()})
+        logger.info(
+            f"В очередь поставлено: новых заявок {len(new_requests)}, на пересмотр {reevaluated} "
+            f"в {len(dirty_partitions)} партициях; удалено выполненных задач {purged}"
+        )
+
+    async def _retry_failed(self) -> int:
+        """Повторяет заявки из jobs, чей срок повтора подошёл; возвращает число попыток"""
+        await self.pool.run_db(self.jobs.reclaim_expired)
+        retried = 0
+        # Неудачная попытка откладывает задачу (fail), поэтому цикл конечен
+        while jobs := await self.pool.run_db(self.jobs.claim, SWEEP_WORKER_ID, RETRY_BATCH):
+            for job in jobs:
+                await self.run_job(SWEEP_WORKER_ID, job)
+                retried += 1
+        if retried:
+            await self.pool.run_db(self.jobs.purge_done)
+        return retried
+
+    async def run_job(self, worker_id: str, job: Job) -> bool:
+        """
+        Выполняет задачу очереди: сопоставление заявки, затем complete.
+        Ошибка - fail(): повтор с задержкой или failed после JOB_MAX_ATTEMPTS попыток
+        """
+        job_id, kind, request_id, attempts, trace_id = job
+        token = trace_id_var.set(trace_id or "-")
+        try:
+            await self.match_request(request_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Задача {job_id} (заявка {request_id}, попытка {attempts}) не выполнена: {str(e)}")
+            await self.pool.run_db(self.jobs.fail, worker_id, job_id, str(e))
+            JOBS_PROCESSED.inc(kind=kind, result="error")
+            return False
+        else:
+            completed = await self.pool.run_db(self.jobs.complete, worker_id, job_id)
+            # Аренду могли отобрать (воркер завис дольше lease) - тогда задачу выполнит другой
+            JOBS_PROCESSED.inc(kind=kind, result="done" if completed else "lost_lease")
+            return completed
+        finally:
+            trace_id_var.reset(token)
+
+    def submit(self, request_id: int, trace_id: Optional[str] = None):
+        """
+        Сопоставление только что поданной заявки, не дожидаясь часового прохода (он остаётся
+        страховкой): задача с повышенным приоритетом воркерам или сразу в этом процессе
+        """
+        task = asyncio.create_task(self._match_submitted(request_id, trace_id))
+        self._submitted.add(task)
+        task.add_done_callback(self._submitted.discard)
+
+    async def _match_submitted(self, request_id: int, trace_id: Optional[str]):
+        if not self.use_job_queue:
+            if await self.process_single_request(request_id, trace_id):
+                # Уведомления уходят сразу, а не на следующем опросе очереди
+                self.sender.wake()
+                return
+        # Задача воркерам, а без очереди - повтор неудачного сопоставления проходом
+        try:
+            await self.pool.run_db(self._enqueue_jobs, [(request_id, trace_id)],
+                                   priority=PRIORITY_SUBMITTED)
+        except Exception as e:
+            logger.error(f"Не удалось поставить задачу по заявке {request_id}: {str(e)}")
+
+    async def match_request(self, request_id: int):
+        """Сопоставление заявки и постановка уведомлений; ошибки пробрасываются вызывающему"""
+        # Сравниваем с противоположными запросами в пуле потоков, не блокируя бота
+        results = await self.pool.run_db(self.comparator.compare_with_database, request_id)
+
+        # Фильтруем результаты по порогу
+        filtered = [(rid, score) for rid, score in results if score >= self.NOTIFICATION_THRESHOLD]
+        await self.notify_users(request_id, filtered)
+
+    async def process_single_request(self, request_id: int, trace_id: Optional[str] = None) -> bool:
+        """
+        Обработка одного запроса; логи и уведомления получают trace id заявки.
+        False - сопоставить не удалось (ошибка залогирована), заявку нужно повторить
+        """
+        token = trace_id_var.set(trace_id or "-")
+        try:
+            await self.match_request(request_id)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка обработки запроса {request_id}: {str(e)}")
+            return False
+        finally:
+            trace_id_var.reset(token)
+        return True
+
+    def _prepare_notifications(self, source_id: int,
+                               matches: List[Tuple[int, float]]) -> List[PreparedNotification]:
+        """
+        Одним запросом на пачку совпадений получает пользователей, их chat_id
+        и признак уже отправленного уведомления для пары пользователей.
+        Возвращает (match_id, similarity, source_user_id, match_user_id, source_chat_id, match_chat_id,
+        submitted_at) - время подачи более новой заявки пары: с него совпадение стало возможным
+        """
+        conn = connect(self.db_path)
+        try:
+            prepared = []
+            seen_pairs = set()
+            # Ограничение SQLite на число параметров - режем совпадения на порции
+            for start in range(0, len(matches), NOTIFY_CHUNK_SIZE):
+                chunk = matches[start:start + NOTIFY_CHUNK_SIZE]
+                values = ", ".join(["(?, ?)"] * len(chunk))
+                params = [value for match in chunk for value in match] + [source_id]
+                rows = conn.execute(f"""
+                    WITH m(match_id, similarity) AS (VALUES {values})
+                    SELECT m.match_id, m.similarity,
+                           su.id, mu.id, su.chat_id, mu.chat_id,
+                           (julianday(MAX(sr.created_at, mr.created_at)) - 2440587.5) * 86400.0,
+                           EXISTS(
+                               SELECT 1 FROM notifications n
+                               WHERE n.user_low = MIN(su.id, mu.id)
+                               AND n.user_high = MAX(su.id, mu.id)
+                           ) AS notified
+                    FROM m
+                    JOIN requests sr ON sr.id = ?
+                    JOIN users su ON su.id = sr.user_id
+                    JOIN requests mr ON mr.id = m.match_id
+                    JOIN users mu ON mu.id = mr.user_id
+                    ORDER BY m.similarity DESC
+                """, params).fetchall()
+
+                for (match_id, similarity, source_user_id, match_user_id, source_chat_id, match_chat_id,
+                     submitted_at, notified) in rows:
+                    # Пропускаем уже отправленные уведомления и повторы пары в этой пачке
+                    pair = (min(source_user_id, match_user_id), max(source_user_id, match_user_id))
+                    if notified or pair in seen_pairs:
+                        continue
+                    seen_pairs.add(pair)
+                    prepared.append((match_id, similarity, source_user_id, match_user_id,
+                                     source_chat_id, match_chat_id, submitted_at))
+
+            return prepared
 
-    async def notify_users(self, source_id: int, matches: List[Tuple[int, float]]):
-        """Отправка уведомлений пользователям"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        finally:
+            conn.close()
 
+    def _record_notifications(self, source_id: int, prepared: List[PreparedNotification]):
+        """
+        Записываем пачку в историю уведомлений, ставим сообщения в исходящую очередь
+        и отмечаем заявку сопоставленной одной транзакцией - совпадение не потеряется,
+        даже если отправка задержится, а проход не сравнит заявку второй раз
+        """
+        conn = connect(self.db_path)
         try:
-            # Получаем информацию об исходном запросе
-            cursor.execute("""
-                SELECT user_id, request_type FROM requests 
-                WHERE id = ?
-            """, (source_id,))
-            source_user_id, source_type = cursor.fetchone()
-
-            # Для каждого совпадения
-            for match_id, similarity in matches:
-                # Проверяем, не отправлялось ли уже уведомление
-                cursor.execute("""
-                    SELECT 1 FROM notifications 
-                    WHERE source_request = ? AND matched_request = ?
-                """, (source_id, match_id))
-                if cursor.fetchone():
-                    continue  # Пропускаем уже отправленные уведомления
-
-                # Получаем информацию о совпадении
-                cursor.execute("""
-                    SELECT user_id FROM requests 
-                    WHERE id = ?
-                """, (match_id,))
-                match_user_id = cursor.fetchone()[0]
-
-                # Получаем chat_id обоих пользователей
-                cursor.execute("SELECT chat_id FROM users WHERE id = ?", (source_user_id,))
-                source_chat_id = cursor.fetchone()[0]
-
-                cursor.execute("SELECT chat_id FROM users WHERE id = ?", (match_user_id,))
-                match_chat_id = cursor.fetchone()[0]
-
-                # Формируем сообщения
-                message_text = (
-                    "🔔 Найдено совпадение!\n\n"
-                    f"• Уровень совпадения: {similarity:.2%}\n"
-                    "Хотите связаться с пользователем?"
-                )
-
-                # Создаем клавиатуры с кнопками
-                source_kb = self._create_notification_kb(match_user_id)
-                match_kb = self._create_notification_kb(source_user_id)
-
-                # Отправляем уведомления только если они еще не были отправлены
-                if not self.has_sent_notification(source_user_id, match_user_id):
-                    await self.bot.send_message(
-                        chat_id=source_chat_id,
-                        text=message_text,
-                        reply_markup=source_kb
-                    )
-
-                    await self.bot.send_message(
-                        chat_id=match_chat_id,
-                        text=message_text,
-                        reply_markup=match_kb
+            # Блокировка записи берётся сразу: несколько воркеров очереди могут одновременно
+            # сопоставить обе заявки пары, поэтому пары перепроверяются уже под блокировкой
+            conn.execute("BEGIN IMMEDIATE")
+            notified = set()
+            for start in range(0, len(prepared), NOTIFY_CHUNK_SIZE):
+                pairs = [(min(item[2], item[3]), max(item[2], item[3]))
+                         for item in prepared[start:start + NOTIFY_CHUNK_SIZE]]
+                values = ", ".join(["(?, ?)"] * len(pairs))
+                notified.update(conn.execute(f"""
+                    WITH p(user_low, user_high) AS (VALUES {values})
+                    SELECT p.user_low, p.user_high FROM p
+                    WHERE EXISTS (
+                        SELECT 1 FROM notifications n
+                        WHERE n.user_low = p.user_low AND n.user_high = p.user_high
                     )
-
-                    # Записываем в историю уведомлений
-                    cursor.execute("""
-                        INSERT INTO notifications 
-                        (source_request, matched_request, similarity)
-                        VALUES (?, ?, ?)
-                    """, (source_id, match_id, similarity))
-
+                """, [value for pair in pairs for value in pair]).fetchall())
+
+            fresh = [item for item in prepared if (min(item[2], item[3]), max(item[2], item[3])) not in notified]
+            conn.executemany("""
+                INSERT INTO notifications
+                (source_request, matched_request, similarity, user_low, user_high)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(source_id, match_id, similarity, min(source_user_id, match_user_id),
+                   max(source_user_id, match_user_id))
+                  for match_id, similarity, source_user_id, match_user_id, _, _, _ in fresh])
+            # Каждый из пользователей получает контакты другого
+            enqueue_notifications(conn, [
+                row
+                for _, similarity, source_user_id, match_user_id, source_chat_id, match_chat_id, submitted_at in fresh
+                for row in ((source_chat_id, match_user_id, similarity, submitted_at),
+                            (match_chat_id, source_user_id, similarity, submitted_at))
+            ])
+            conn.execute("UPDATE requests SET matched_at = CURRENT_TIMESTAMP WHERE id = ?", (source_id,))
             conn.commit()
-
         finally:
             conn.close()
 
+    async def notify_users(self, source_id: int, matches: List[Tuple[int, float]]):
+        """
+        Ставит уведомления в исходящую очередь (отправкой занимается OutboundSender)
+        и отмечает заявку сопоставленной - даже без совпадений
+        """
+        prepared = await self.pool.run_db(self._prepare_notifications, source_id, matches) if matches else []
+        await self.pool.run_db(self._record_notifications, source_id, prepared)
+
     def has_sent_notification(self, user_a: int, user_b: int) -> bool:
         """Проверяет было ли уже отправлено уведомление между двумя пользователями"""
-        conn = sqlite3.connect(self.db_path)
+        conn = connect(self.db_path)
         cursor = conn.cursor()
         try:
             cursor.execute("""
                 SELECT 1 FROM notifications 
-                WHERE (source_request IN (?, ?) AND matched_request IN (?, ?))
-            """, (user_a, user_b, user_a, user_b))
+                WHERE user_low = ? AND user_high = ?
+            """, (min(user_a, user_b), max(user_a, user_b)))
             return cursor.fetchone() is not None
         finally:
             conn.close()
 
-    @staticmethod
-    def _create_notification_kb(user_id: int):
-        """Создает inline-клавиатуру для уведомления"""
-        from aiogram.utils.keyboard import InlineKeyboardBuilder
-
-        builder = InlineKeyboardBuilder()
-        builder.add(
-            InlineKeyboardButton(  # Теперь класс распознается
-                text="✅ Да, показать контакты",
-                callback_data=f"show_contacts_{user_id}"
-            ),
-            InlineKeyboardButton(  # И здесь тоже
-                text="❌ Нет, спасибо",
-                callback_data="dismiss_notification"
-            )
-        )
-        return builder.as_markup()
-
 
 # Инициализация в основном файле бота
 async def setup_background_tasks(bot: Bot):
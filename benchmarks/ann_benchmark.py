@@ -0,0 +1,85 @@
+"""
+Бенчмарк IVF индекса против точного перебора: recall@k и задержка поиска.
+
+Запуск из корня репозитория:
+    python -m benchmarks.ann_benchmark --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import time
+from typing import Dict
+
+import numpy as np
+
+from ann_index import IVFIndex
+
+
+def make_clustered_vectors(n: int, dim: int, rng: np.random.Generator,
+                           points_per_cluster: int = 50, noise: float = 1.0,
+                           chunk: int = 100_000) -> np.ndarray:
+    """Векторы, сгруппированные вокруг центров - похоже на эмбеддинги фото одних и тех же животных"""
+    n_clusters = max(1, n // points_per_cluster)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk):
+        stop = min(n, start + chunk)
+        labels = rng.integers(0, n_clusters, stop - start)
+        block = centers[labels] + noise * rng.standard_normal((stop - start, dim)).astype(np.float32) / np.sqrt(dim)
+        vectors[start:stop] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return vectors
+
+
+def run(n: int, dim: int, k: int, n_queries: int, n_probe: int, seed: int) -> Dict[str, float]:
+    rng = np.random.default_rng(seed)
+    vectors = make_clustered_vectors(n, dim, rng)
+    queries = vectors[rng.choice(n, n_queries, replace=False)]
+    queries = queries + 0.3 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(dim)
+
+    index = IVFIndex(dim=dim, n_probe=n_probe, min_train_size=min(n, 2048), seed=seed)
+    started = time.perf_counter()
+    index.add_many(np.arange(n), vectors)
+    build_seconds = time.perf_counter() - started
+
+    ann_latency, exact_latency, recalls = [], [], []
+    for query in queries:
+        started = time.perf_counter()
+        exact_ids, _ = index.search_exact(query, k)
+        exact_latency.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        ann_ids, _ = index.search(query, k)
+        ann_latency.append(time.perf_counter() - started)
+
+        recalls.append(len(np.intersect1d(exact_ids, ann_ids)) / max(1, len(exact_ids)))
+
+    return {
+        "vectors": n,
+        "k": k,
+        "n_probe": n_probe,
+        "build_seconds": build_seconds,
+        f"recall@{k}": float(np.mean(recalls)),
+        "ann_ms_mean": float(np.mean(ann_latency) * 1000),
+        "ann_ms_p95": float(np.percentile(ann_latency, 95) * 1000),
+        "exact_ms_mean": float(np.mean(exact_latency) * 1000),
+        "exact_ms_p95": float(np.percentile(exact_latency, 95) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--n-probe", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        print(json.dumps(run(n, args.dim, args.k, args.queries, args.n_probe, args.seed), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
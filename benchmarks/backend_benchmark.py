@@ -0,0 +1,96 @@
+"""
+Бенчмарк бэкендов визуальной части CLIP на CPU: изображений в секунду и задержка
+батча для каждого сочетания бэкенда и int8 квантования (см. clip_backend).
+
+Недоступные бэкенды (например, без onnxruntime) пропускаются с пометкой в отчёте.
+
+Запуск из корня репозитория:
+    python -m benchmarks.backend_benchmark --threads 4 --batch-sizes 1 8 32
+"""
+import argparse
+import json
+import time
+from io import BytesIO
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.synthetic_db import animal_photo
+from clip_backend import (MODEL_INPUT_SIZE, OnnxVisionEncoder, ReferenceEncoder, TorchVisionEncoder,
+                          configure_threads)
+from config import CLIP_EXPORT_DIR
+from image_processing import decode_image, get_model
+
+# (бэкенд, int8): torch без квантования - эталон
+BACKEND_CONFIGS: List[Tuple[str, bool]] = [
+    ("torch", False), ("torch", True),
+    ("torchscript", False), ("torchscript", True),
+    ("onnx", False), ("onnx", True),
+]
+
+
+def sample_images(n: int, seed: int = 0) -> List[Image.Image]:
+    """Синтетические снимки, декодированные так же, как фото заявок"""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(n):
+        data = animal_photo(rng, rng.random((8, 8, 3)) * 255, 2 * MODEL_INPUT_SIZE, jitter=12.0)
+        images.append(decode_image(BytesIO(data)))
+    return images
+
+
+def build_encoder(model, backend: str, quantize: bool, threads: int, export_dir: str = CLIP_EXPORT_DIR):
+    """Кодировщик ровно заданной конфигурации, без подмены на эталон при ошибке"""
+    if backend == "torch" and not quantize:
+        return ReferenceEncoder(model)
+    if backend == "onnx":
+        return OnnxVisionEncoder(model, quantize, threads, export_dir)
+    return TorchVisionEncoder(model, quantize, script=backend == "torchscript")
+
+
+def measure(encoder, images: List[Image.Image], batch_size: int, repeats: int) -> Dict[str, float]:
+    batches = [images[start:start + batch_size] for start in range(0, len(images), batch_size)]
+    encoder.encode(batches[0])  # прогрев: ленивые инициализации, выделение памяти
+    latencies = []
+    for _ in range(repeats):
+        for batch in batches:
+            started = time.perf_counter()
+            encoder.encode(batch)
+            latencies.append(time.perf_counter() - started)
+    total_images = repeats * len(images)
+    return {
+        f"batch{batch_size}_images_per_second": total_images / sum(latencies),
+        f"batch{batch_size}_latency_ms_p50": float(np.percentile(latencies, 50) * 1000),
+        f"batch{batch_size}_latency_ms_p95": float(np.percentile(latencies, 95) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="потоков на операцию (0 - по умолчанию)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    configure_threads(args.threads)
+    model = get_model()
+    images = sample_images(args.images, args.seed)
+
+    for backend, quantize in BACKEND_CONFIGS:
+        report = {"backend": backend, "int8": quantize, "threads": args.threads}
+        try:
+            started = time.perf_counter()
+            encoder = build_encoder(model, backend, quantize, args.threads)
+            report["setup_seconds"] = time.perf_counter() - started
+            for batch_size in args.batch_sizes:
+                report.update(measure(encoder, images, batch_size, args.repeats))
+        except Exception as e:
+            report["skipped"] = str(e)
+        print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Проверка бэкендов визуальной части CLIP: насколько их эмбеддинги отклоняются
+от исходной модели sentence-transformers (1 - косинусная схожесть на одном и том же снимке).
+
+Код возврата 1, если у какого-то доступного бэкенда максимальное отклонение больше
+допустимого: --max-drift для float32 бэкендов, --max-drift-int8 для квантованных.
+
+Запуск из корня репозитория:
+    python -m benchmarks.backend_parity
+    python -m benchmarks.backend_parity --images 128 --max-drift-int8 0.03
+"""
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from benchmarks.backend_benchmark import BACKEND_CONFIGS, build_encoder, sample_images
+from clip_backend import ReferenceEncoder
+from image_processing import get_model
+
+
+def cosine_drift(reference: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return 1.0 - np.sum(reference * vectors, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-drift", type=float, default=1e-3)
+    parser.add_argument("--max-drift-int8", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model = get_model()
+    images = sample_images(args.images, args.seed)
+    batches = [images[start:start + args.batch_size] for start in range(0, len(images), args.batch_size)]
+    reference = np.concatenate([ReferenceEncoder(model).encode(batch) for batch in batches])
+
+    failed = False
+    for backend, quantize in BACKEND_CONFIGS:
+        if backend == "torch" and not quantize:
+            continue
+        report = {"backend": backend, "int8": quantize}
+        try:
+            encoder = build_encoder(model, backend, quantize, threads=0)
+            vectors = np.concatenate([encoder.encode(batch) for batch in batches])
+        except Exception as e:
+            report["skipped"] = str(e)
+            print(json.dumps(report, ensure_ascii=False))
+            continue
+
+        drift = cosine_drift(reference, vectors)
+        limit = args.max_drift_int8 if quantize else args.max_drift
+        report.update({
+            "drift_mean": float(drift.mean()),
+            "drift_max": float(drift.max()),
+            "limit": limit,
+            "ok": bool(drift.max() <= limit),
+        })
+        failed |= not report["ok"]
+        print(json.dumps(report, ensure_ascii=False))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
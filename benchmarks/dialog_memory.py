@@ -0,0 +1,119 @@
+"""
+Память состояния диалогов подачи заявки (ExpiringMemoryStorage).
+
+Заполняет хранилище незавершёнными диалогами в двух вариантах данных FSM:
+прежнем (байты фото и миниатюры в состоянии) и текущем (file_id, file_unique_id,
+путь к временному файлу) и измеряет tracemalloc прирост памяти на один диалог.
+Затем проверяет, что просроченные диалоги удаляются вместе с временными файлами.
+Код возврата 1, если на диалог уходит больше --max-bytes или очистка не сработала.
+
+Запуск из корня репозитория:
+    python -m benchmarks.dialog_memory --dialogs 10000 --photo-kb 200
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from aiogram.fsm.storage.base import StorageKey
+
+from dialog_storage import ExpiringMemoryStorage, PhotoSpool
+
+
+def _legacy_data(i: int, photo: bytes, thumb: bytes) -> dict:
+    """Данные диалога до перехода на file_id: байты фото живут в памяти все шаги"""
+    # Отдельная копия байтов на диалог, как после скачивания
+    return {"trace_id": f"{i:016x}", "photo_data": photo + i.to_bytes(4, "little"),
+            "thumb_data": thumb + i.to_bytes(4, "little"),
+            "photo_dhash": i, "file_unique_id": f"AQAD{i:012d}", "request_type": "lost",
+            "category": "Собака"}
+
+
+def _current_data(i: int, spool_path: str) -> dict:
+    return {"trace_id": f"{i:016x}", "file_id": f"AgACAgIAAxkBAAI{i:040d}", "file_unique_id": f"AQAD{i:012d}",
+            "photo_hash": None, "photo_spool": spool_path, "photo_dhash": i,
+            "request_type": "lost", "category": "Собака"}
+
+
+async def _fill(storage: ExpiringMemoryStorage, dialogs: int, make_data) -> float:
+    """Прирост памяти на диалог, байт"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(dialogs):
+        key = StorageKey(bot_id=1, chat_id=i, user_id=i)
+        await storage.set_state(key, "Form:category")
+        await storage.set_data(key, make_data(i))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / dialogs
+
+
+async def run(args) -> dict:
+    photo = os.urandom(args.photo_kb * 1024)
+    thumb = os.urandom(12 * 1024)
+
+    legacy = ExpiringMemoryStorage(ttl_seconds=3600)
+    # Прежний вариант - на меньшем числе диалогов: иначе это гигабайты
+    legacy_bytes = await _fill(legacy, min(args.dialogs, args.legacy_dialogs),
+                               lambda i: _legacy_data(i, photo, thumb))
+    await legacy.close()
+    del legacy
+    gc.collect()
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool = PhotoSpool(spool_dir)
+        spooled = min(args.dialogs, args.spooled)
+        paths = [spool.put(f"{i}-AQAD{i:012d}", photo) for i in range(spooled)]
+
+        storage = ExpiringMemoryStorage(ttl_seconds=3600,
+                                        on_expire=lambda data: spool.discard(data.get("photo_spool")))
+        current_bytes = await _fill(storage, args.dialogs,
+                                    lambda i: _current_data(i, paths[i] if i < spooled else None))
+
+        # Все диалоги становятся старше ttl: очистка забирает записи и временные файлы
+        storage.ttl_seconds = 0
+        time.sleep(0.01)
+        started = time.perf_counter()
+        expired = storage.expire()
+        expire_seconds = time.perf_counter() - started
+        files_left = sum(1 for _ in Path(spool_dir).iterdir())
+        await storage.close()
+
+    return {
+        "dialogs": args.dialogs,
+        "photo_kb": args.photo_kb,
+        "legacy_bytes_per_dialog": round(legacy_bytes),
+        "bytes_per_dialog": round(current_bytes),
+        "reduction": round(legacy_bytes / current_bytes, 1) if current_bytes else 0.0,
+        "expired": expired,
+        "expire_seconds": round(expire_seconds, 4),
+        "records_left": len(storage.storage),
+        "spool_files_left": files_left,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dialogs", type=int, default=10000)
+    parser.add_argument("--photo-kb", type=int, default=200, help="размер скачанного фото")
+    parser.add_argument("--legacy-dialogs", type=int, default=500, help="диалогов в прежнем варианте")
+    parser.add_argument("--spooled", type=int, default=200, help="диалогов с временным файлом фото")
+    parser.add_argument("--max-bytes", type=int, default=4096, help="допустимая память на диалог")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    report["ok"] = (report["bytes_per_dialog"] <= args.max_bytes and report["expired"] == args.dialogs
+                    and report["records_left"] == 0 and report["spool_files_left"] == 0)
+    print(json.dumps(report, ensure_ascii=False))
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Задержка хендлеров бота во время прохода фоновой обработки.
+
+Пробный "хендлер" каждые --interval-ms выполняет то же, что обычный шаг диалога:
+запрос к БД через общий асинхронный интерфейс db. Замеряется время от запланированного
+старта до ответа - в него входит и ожидание event loop. Сначала без нагрузки (эталон),
+затем во время холодного прохода по синтетической базе: эмбеддинги всех заявок
+досчитываются (вместо CLIP - заглушка), партиции сравниваются, уведомления ставятся в очередь.
+
+Код возврата 1, если p95 во время прохода больше --max-p95-ms: работа прохода
+должна идти в пуле потоков, а не в event loop. С --inline проход выполняется прямо
+в event loop - так видно, что проверка ловит блокировку.
+
+Запуск из корня репозитория:
+    python -m benchmarks.handler_latency --requests 2000
+    python -m benchmarks.handler_latency --requests 2000 --inline
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from benchmarks.pipeline_benchmark import generate_dataset
+from worker_pool import WorkerPool
+
+
+class InlinePool(WorkerPool):
+    """Блокирующая работа прямо в event loop - как до выноса в пул"""
+
+    async def _run(self, executor, fn: Callable, *fn_args, **kwargs) -> Any:
+        return fn(*fn_args, **kwargs)
+
+
+async def _probe(db, interval: float, stop: asyncio.Event, next_at: float) -> List[float]:
+    """Задержки пробного хендлера от next_at до установки stop"""
+    latencies = []
+    chat_id = 0
+    # Хотя бы один замер: если event loop занят весь проход, задержка равна его длительности
+    while True:
+        chat_id += 1
+        await db.fetchone("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
+        latencies.append(time.perf_counter() - next_at)
+        if stop.is_set():
+            return latencies
+        next_at += interval
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+
+
+def _stats(latencies: List[float], prefix: str) -> Dict[str, float]:
+    return {
+        f"{prefix}_samples": len(latencies),
+        f"{prefix}_ms_p50": float(np.percentile(latencies, 50) * 1000),
+        f"{prefix}_ms_p95": float(np.percentile(latencies, 95) * 1000),
+        f"{prefix}_ms_max": float(np.max(latencies) * 1000),
+    }
+
+
+async def measure(db_path: str, args) -> Dict[str, float]:
+    # Модули бота импортируются после chdir: пути хранилищ фото в config относительные
+    from background_tasks import BackgroundProcessor
+    from benchmarks.stub_encoder import install_stub_encoder
+    from database import AsyncDatabase
+    from image_processing import inference_service
+
+    install_stub_encoder()
+    db = AsyncDatabase(db_path)
+    interval = args.interval_ms / 1000
+    metrics: Dict[str, float] = {}
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(_probe(db, interval, stop, time.perf_counter()))
+    await asyncio.sleep(args.idle_seconds)
+    stop.set()
+    metrics.update(_stats(await probe, "idle"))
+
+    pool = InlinePool(inference_processes=0) if args.inline else WorkerPool(inference_processes=0)
+    processor = BackgroundProcessor(None, db_path, pool=pool, use_job_queue=False)
+    try:
+        stop = asyncio.Event()
+        started = time.perf_counter()
+        probe = asyncio.create_task(_probe(db, interval, stop, started))
+        await processor.process_all_requests()
+        metrics["sweep_seconds"] = time.perf_counter() - started
+        stop.set()
+        metrics.update(_stats(await probe, "sweep"))
+    finally:
+        await processor.pool.shutdown()
+        inference_service.stop()
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--cities", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--interval-ms", type=float, default=20.0, help="период пробного хендлера")
+    parser.add_argument("--idle-seconds", type=float, default=2.0, help="длительность эталонного замера")
+    parser.add_argument("--max-p95-ms", type=float, default=100.0, help="допустимый p95 во время прохода")
+    parser.add_argument("--inline", action="store_true", help="проход в event loop (для сравнения)")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        generate_dataset(work_dir, args)
+        os.chdir(work_dir)
+        try:
+            metrics = asyncio.run(measure(str(work_dir / "bench.db"), args))
+        finally:
+            os.chdir(cwd)
+
+    metrics["cpu_count"] = os.cpu_count()
+    metrics["ok"] = metrics["sweep_ms_p95"] <= args.max_p95_ms
+    print(json.dumps(metrics, ensure_ascii=False))
+    sys.exit(0 if metrics["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
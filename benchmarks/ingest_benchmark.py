@@ -0,0 +1,121 @@
+"""
+Бенчмарк приёма фото: сколько байт скачивается, время декодирования
+и пиковый RSS на одно фото до и после перехода на уменьшенное декодирование.
+
+"before" - самый большой PhotoSize, полное декодирование и конвертация в RGB.
+"after" - самый маленький PhotoSize не меньше 224px, draft-декодирование JPEG и миниатюра.
+Фото генерируются заранее во временный каталог, каждый режим запускается
+в отдельном процессе, чтобы пиковый RSS не смешивался.
+
+Запуск из корня репозитория:
+    python -m benchmarks.ingest_benchmark --photos 50
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+from image_processing import MODEL_INPUT_SIZE, decode_image, make_thumbnail, pick_photo_size
+
+# Размеры, которые Telegram отдаёт для одного фото (по длинной стороне)
+TELEGRAM_SIZES = (90, 320, 800, 1280)
+
+
+def make_photo_sizes(rng: np.random.Generator, aspect: float = 4 / 3) -> List[Image.Image]:
+    """Синтетическое фото в размерах Telegram: плавный фон с шумом, как у снимка с камеры"""
+    width, height = TELEGRAM_SIZES[-1], int(TELEGRAM_SIZES[-1] / aspect)
+    base = rng.random((height // 16, width // 16, 3)) * 255
+    image = Image.fromarray(base.astype(np.uint8)).resize((width, height), Image.BICUBIC)
+    noise = rng.normal(0, 8, (height, width, 3))
+    image = Image.fromarray(np.clip(np.asarray(image) + noise, 0, 255).astype(np.uint8))
+
+    return [image.resize((side, int(side / aspect)), Image.BICUBIC) for side in TELEGRAM_SIZES]
+
+
+def generate_photos(data_dir: Path, n_photos: int, seed: int):
+    """Сохраняет фото как <номер>_<ширина>x<высота>.jpg"""
+    rng = np.random.default_rng(seed)
+    for number in range(n_photos):
+        for scaled in make_photo_sizes(rng):
+            scaled.save(data_dir / f"{number}_{scaled.width}x{scaled.height}.jpg", "JPEG", quality=87)
+
+
+def load_photo_sizes(data_dir: Path, number: int) -> List[SimpleNamespace]:
+    """PhotoSize-подобные объекты; байты читаются только у выбранного размера"""
+    sizes = []
+    for path in sorted(data_dir.glob(f"{number}_*.jpg")):
+        width, height = map(int, path.stem.split("_")[1].split("x"))
+        sizes.append(SimpleNamespace(width=width, height=height, path=path))
+    return sorted(sizes, key=lambda size: size.width * size.height)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss - в КБ на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_mode(mode: str, data_dir: Path, n_photos: int) -> Dict[str, float]:
+    baseline_rss = _peak_rss_mb()
+
+    downloaded, decoded, decode_seconds = [], [], []
+    for number in range(n_photos):
+        sizes = load_photo_sizes(data_dir, number)
+        # Скачивание из Telegram заменено чтением файла выбранного размера
+        if mode == "before":
+            data = sizes[-1].path.read_bytes()
+            started = time.perf_counter()
+            image = Image.open(BytesIO(data)).convert("RGB")
+        else:
+            data = pick_photo_size(sizes).path.read_bytes()
+            started = time.perf_counter()
+            image = decode_image(make_thumbnail(data))
+        decode_seconds.append(time.perf_counter() - started)
+        downloaded.append(len(data))
+        # Память под декодированный буфер: этим в основном и определяется пик RSS на фото
+        decoded.append(image.width * image.height * len(image.getbands()))
+        assert min(image.size) >= MODEL_INPUT_SIZE
+
+    return {
+        "mode": mode,
+        "photos": n_photos,
+        "bytes_per_photo": float(np.mean(downloaded)),
+        "decode_ms_mean": float(np.mean(decode_seconds) * 1000),
+        "decode_ms_p95": float(np.percentile(decode_seconds, 95) * 1000),
+        "decoded_kb_per_photo": float(np.mean(decoded) / 1024),
+        "peak_rss_mb": _peak_rss_mb(),
+        "peak_rss_growth_mb": _peak_rss_mb() - baseline_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=["before", "after"], help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, Path(args.data_dir), args.photos), ensure_ascii=False))
+        return
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate_photos(Path(data_dir), args.photos, args.seed)
+        for mode in ("before", "after"):
+            subprocess.run([sys.executable, "-m", "benchmarks.ingest_benchmark", "--mode", mode,
+                            "--photos", str(args.photos), "--data-dir", data_dir], check=True)
+
+
+if __name__ == "__main__":
+    main()
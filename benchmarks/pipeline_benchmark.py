@@ -0,0 +1,235 @@
+"""
+Бенчмарк конвейера сопоставления на синтетической базе.
+
+Измеряет:
+- полный проход process_all_requests по холодной базе (эмбеддинги досчитываются):
+  время, число SQL-запросов, кодирований в секунду;
+- проход по партициям, помеченным изменившимися, и проход без новых заявок;
+- задержку compare_with_database на одну заявку (индекс и точный перебор);
+- batch_compare по самой большой партиции;
+- пиковый RSS и (с --tracemalloc) пик памяти Python-объектов.
+
+Результаты пишутся в JSON вместе с коммитом, --baseline печатает изменение
+относительно прошлого прогона.
+
+Запуск из корня репозитория:
+    python -m benchmarks.pipeline_benchmark --requests 5000 --output results.json
+    python -m benchmarks.pipeline_benchmark --requests 5000 --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+class StatementCounter:
+    """Считает выполненные SQL по первому слову (SELECT, INSERT, ...)"""
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+
+    def __call__(self, sql: str):
+        self.counts[sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "?"] += 1
+
+    def reset(self):
+        self.counts.clear()
+
+    @property
+    def queries(self) -> int:
+        """Запросы к данным, без PRAGMA и управления транзакциями"""
+        return sum(self.counts[kind] for kind in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE"))
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _latency_stats(seconds: List[float], prefix: str) -> Dict[str, float]:
+    if not seconds:
+        return {}
+    return {
+        f"{prefix}_ms_mean": float(np.mean(seconds) * 1000),
+        f"{prefix}_ms_p50": float(np.percentile(seconds, 50) * 1000),
+        f"{prefix}_ms_p95": float(np.percentile(seconds, 95) * 1000),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_dataset(work_dir: Path, args) -> Dict[str, int]:
+    """Генерация в отдельном процессе, чтобы она не попала в пиковый RSS прогона"""
+    result = subprocess.run([
+        sys.executable, "-m", "benchmarks.synthetic_db",
+        "--db", str(work_dir / "bench.db"), "--photos-dir", str(work_dir / "photos"),
+        "--requests", str(args.requests), "--cities", str(args.cities),
+        "--categories", str(args.categories), "--seed", str(args.seed),
+    ], cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")]))))
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+async def measure(db_path: str, args) -> Dict[str, float]:
+    # Модули бота импортируются после chdir: пути хранилищ фото в config относительные
+    from background_tasks import BackgroundProcessor
+    from database import get_pool
+    from image_comparison import ImageComparator
+    from image_processing import batch_compare, inference_service
+    from worker_pool import WorkerPool
+
+    if args.encoder == "stub":
+        from benchmarks.stub_encoder import install_stub_encoder
+        install_stub_encoder()
+
+    metrics: Dict[str, float] = {}
+    counter = StatementCounter()
+    get_pool(db_path).set_trace_callback(counter)
+
+    processor = BackgroundProcessor(None, db_path, pool=WorkerPool(inference_processes=0))
+    try:
+        if args.tracemalloc:
+            tracemalloc.start()
+
+        # Холодный проход: эмбеддинги всех заявок досчитываются по ходу
+        encoded_before = inference_service.metrics()["requests"]
+        started = time.perf_counter()
+        await processor.process_all_requests()
+        sweep_seconds = time.perf_counter() - started
+        encodes = inference_service.metrics()["requests"] - encoded_before
+        metrics.update({
+            "sweep_seconds": sweep_seconds,
+            "sweep_db_queries": counter.queries,
+            "sweep_db_statements": sum(counter.counts.values()),
+            "sweep_encodes": encodes,
+            "encodes_per_second": encodes / sweep_seconds if sweep_seconds else 0.0,
+        })
+        if args.tracemalloc:
+            metrics["sweep_python_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+        # Второй проход пересматривает партиции, где эмбеддинги досчитывались в первом,
+        # третий - без новых заявок и изменений, должен быть почти бесплатным
+        for prefix in ("dirty_sweep", "idle_sweep"):
+            counter.reset()
+            started = time.perf_counter()
+            await processor.process_all_requests()
+            metrics[f"{prefix}_seconds"] = time.perf_counter() - started
+            metrics[f"{prefix}_db_queries"] = counter.queries
+
+        conn = get_pool(db_path).acquire()
+        try:
+            request_ids = [row[0] for row in conn.execute("SELECT id FROM requests ORDER BY id")]
+            metrics["outbox_rows"] = conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            largest = conn.execute("""
+                SELECT request_type, city, category FROM requests
+                GROUP BY request_type, city, category ORDER BY COUNT(*) DESC LIMIT 1
+            """).fetchone()
+        finally:
+            conn.close()
+
+        # Задержка сопоставления одной заявки на тёплой базе
+        rng = np.random.default_rng(args.seed)
+        sample = rng.choice(request_ids, min(args.sample, len(request_ids)), replace=False).tolist()
+        for use_index, prefix in ((True, "match_index"), (False, "match_exact")):
+            comparator = ImageComparator(db_path)
+            comparator.use_index = use_index
+            comparator.rebuild_index()
+            latencies = []
+            counter.reset()
+            for request_id in sample:
+                started = time.perf_counter()
+                comparator.compare_with_database(request_id)
+                latencies.append(time.perf_counter() - started)
+            metrics.update(_latency_stats(latencies, prefix))
+            metrics[f"{prefix}_db_queries_per_request"] = counter.queries / len(sample)
+
+        # batch_compare по самой большой партиции
+        candidates = processor.comparator.store.load_candidates(*largest, exclude_id=0)
+        if candidates:
+            latencies = []
+            for _, source in candidates[:args.sample]:
+                started = time.perf_counter()
+                batch_compare(source, candidates, processor.comparator.top_k)
+                latencies.append(time.perf_counter() - started)
+            metrics["batch_compare_candidates"] = len(candidates)
+            metrics.update(_latency_stats(latencies, "batch_compare"))
+    finally:
+        await processor.pool.shutdown()
+        inference_service.stop()
+
+    metrics["peak_rss_mb"] = _peak_rss_mb()
+    return metrics
+
+
+def compare_with_baseline(metrics: Dict[str, float], baseline_path: Path):
+    baseline = json.loads(baseline_path.read_text())
+    print(f"Сравнение с {baseline_path} (коммит {baseline.get('commit')}):")
+    for name, value in metrics.items():
+        old = baseline["metrics"].get(name)
+        if not old:
+            continue
+        print(f"  {name}: {old:.4g} -> {value:.4g} ({(value - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--cities", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--sample", type=int, default=200, help="заявок для замера задержки")
+    parser.add_argument("--encoder", choices=["stub", "clip"], default="stub")
+    parser.add_argument("--tracemalloc", action="store_true", help="замерить пик памяти Python (замедляет прогон)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+    output = Path(args.output).resolve() if args.output else None
+    baseline = Path(args.baseline).resolve() if args.baseline else None
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        dataset = generate_dataset(work_dir, args)
+        os.chdir(work_dir)
+        try:
+            metrics = asyncio.run(measure(str(work_dir / "bench.db"), args))
+        finally:
+            os.chdir(cwd)
+
+    result = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "dataset": dataset,
+        "metrics": metrics,
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if output:
+        output.write_text(text)
+    if baseline:
+        compare_with_baseline(metrics, baseline)
+
+
+if __name__ == "__main__":
+    main()
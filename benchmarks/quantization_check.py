@@ -0,0 +1,134 @@
+"""
+Проверка сжатого хранения эмбеддингов: совпадают ли результаты на порогах
+0.75 (ImageComparator.similarity_threshold) и 0.85 (NOTIFICATION_THRESHOLD)
+с точным поиском по float32.
+
+Эталонный набор по умолчанию синтетический: для каждого запроса строятся кандидаты
+с заданной схожестью, равномерно от 0.5 до 1.0 - много пар лежит вплотную к порогам.
+С --db берутся реальные эмбеддинги из базы.
+Код возврата 1, если режим с точным пересчётом (EMBEDDING_RERANK=1) меняет хоть одно совпадение.
+
+Запуск из корня репозитория:
+    python -m benchmarks.quantization_check
+    python -m benchmarks.quantization_check --db database.db
+"""
+import argparse
+import json
+import sqlite3
+import sys
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+from ann_index import IVFIndex
+from config import CLIP_MODEL_NAME, EMBEDDING_VERSION, MATCH_TOP_K, RERANK_MARGIN
+from image_processing import top_k_similarities
+
+THRESHOLDS = (0.75, 0.85)  # similarity_threshold и NOTIFICATION_THRESHOLD
+
+
+def make_reference_set(n_queries: int, per_query: int, dim: int,
+                       rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """Запросы и кандидаты со схожестью s: c = s*q + sqrt(1 - s^2)*u, где u ортогонален q"""
+    queries = rng.standard_normal((n_queries, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    candidates = []
+    for query in queries:
+        targets = rng.uniform(0.5, 1.0, per_query).astype(np.float32)
+        noise = rng.standard_normal((per_query, dim)).astype(np.float32)
+        noise -= np.outer(noise @ query, query)
+        noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+        candidates.append(targets[:, None] * query + np.sqrt(1 - targets ** 2)[:, None] * noise)
+    return queries, np.concatenate(candidates).astype(np.float32)
+
+
+def load_reference_set(db_path: str, n_queries: int,
+                       rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """Реальные эмбеддинги текущей модели; запросы - случайная выборка из них"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT vector FROM embeddings WHERE model_name = ? AND model_version = ?",
+            (CLIP_MODEL_NAME, EMBEDDING_VERSION)
+        ).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        raise SystemExit(f"В {db_path} нет эмбеддингов модели {CLIP_MODEL_NAME} v{EMBEDDING_VERSION}")
+    vectors = np.frombuffer(b"".join(blob for blob, in rows), dtype=np.float32).reshape(len(rows), -1)
+    queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+    return queries, vectors
+
+
+def find_matches(index: IVFIndex, vectors: np.ndarray, queries: np.ndarray, k: int,
+                 threshold: float, rerank: bool) -> Tuple[Set[Tuple[int, int]], Dict[Tuple[int, int], float]]:
+    """Тот же порядок действий, что в ImageComparator._search_index"""
+    matches, scores = set(), {}
+    for query_no, query in enumerate(queries):
+        if rerank:
+            ids, _ = index.search_exact(query, 2 * k, threshold - RERANK_MARGIN)
+            ids, found = top_k_similarities(query, ids, vectors[ids], k)
+        else:
+            ids, found = index.search_exact(query, k, threshold)
+        for req_id, score in zip(ids.tolist(), found.tolist()):
+            scores[(query_no, req_id)] = score
+            if score >= threshold:
+                matches.add((query_no, req_id))
+    return matches, scores
+
+
+def run(queries: np.ndarray, vectors: np.ndarray, k: int) -> List[Dict[str, object]]:
+    dim = vectors.shape[1]
+    ids = np.arange(len(vectors))
+    reference = IVFIndex(dim=dim, min_train_size=len(vectors) + 1, dtype="float32")
+    reference.add_many(ids, vectors)
+
+    results = []
+    for dtype in ("float16", "int8"):
+        index = IVFIndex(dim=dim, min_train_size=len(vectors) + 1, dtype=dtype)
+        index.add_many(ids, vectors)
+        for rerank in (False, True):
+            report = {
+                "dtype": dtype,
+                "rerank": rerank,
+                "bytes_per_vector": index.memory_bytes / len(vectors),
+                "float32_bytes_per_vector": reference.memory_bytes / len(vectors),
+            }
+            for threshold in THRESHOLDS:
+                expected, exact_scores = find_matches(reference, vectors, queries, k, threshold, False)
+                found, scores = find_matches(index, vectors, queries, k, threshold, rerank)
+                errors = [abs(scores[key] - exact_scores[key]) for key in scores.keys() & exact_scores.keys()]
+                report[f"matches@{threshold}"] = len(expected)
+                report[f"changed@{threshold}"] = len(expected ^ found)
+                report[f"max_score_error@{threshold}"] = max(errors, default=0.0)
+            results.append(report)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="взять эмбеддинги из базы вместо синтетического набора")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--per-query", type=int, default=40)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--k", type=int, default=MATCH_TOP_K)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.db:
+        queries, vectors = load_reference_set(args.db, args.queries, rng)
+    else:
+        queries, vectors = make_reference_set(args.queries, args.per_query, args.dim, rng)
+
+    failed = False
+    for report in run(queries, vectors, args.k):
+        print(json.dumps(report, ensure_ascii=False))
+        if report["rerank"] and any(report[f"changed@{threshold}"] for threshold in THRESHOLDS):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Заглушка вместо CLIP для тяжёлых прогонов бенчмарков: быстрый детерминированный
+эмбеддинг, у похожих картинок - похожие векторы. Загрузка torch не нужна.
+"""
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+import image_processing
+from worker_pool import worker_pool
+
+
+class StubModel:
+    """Уменьшенное до 16x16 изображение -> фиксированная случайная проекция в dim"""
+
+    def __init__(self, dim: int = 512, side: int = 16, seed: int = 0):
+        self.side = side
+        rng = np.random.default_rng(seed)
+        self.projection = rng.standard_normal((side * side * 3, dim)).astype(np.float32) / np.sqrt(dim)
+
+    def encode(self, images: List[Image.Image], batch_size: int = 32, **kwargs) -> np.ndarray:
+        pixels = np.stack([
+            np.asarray(image.convert("RGB").resize((self.side, self.side), Image.BILINEAR), dtype=np.float32).ravel()
+            for image in images
+        ])
+        pixels -= pixels.mean(axis=1, keepdims=True)
+        vectors = pixels @ self.projection
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def install_stub_encoder(dim: int = 512) -> StubModel:
+    """Подменяет модель в текущем процессе; инференс идёт без пула процессов"""
+    model = StubModel(dim)
+    worker_pool.inference_processes = 0
+    image_processing._model = model
+    image_processing._encoder = model
+    image_processing.model_ready.set()
+    return model
@@ -0,0 +1,121 @@
+"""
+Генератор синтетической базы users/requests с фотографиями.
+
+Города и категории распределены по закону Ципфа (большая часть заявок - в нескольких
+крупных городах, кошки и собаки встречаются чаще остальных), у части потерянных животных
+есть заявка "нашёл" с другим снимком того же животного.
+Эмбеддинги по умолчанию не считаются - их досчитывает фоновая обработка.
+
+Запуск из корня репозитория:
+    python -m benchmarks.synthetic_db --db bench.db --photos-dir photos --requests 10000
+"""
+import argparse
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+from database import initialize_database
+from perceptual_hash import dhash_bytes, to_db
+from photo_store import PhotoStore
+
+CITIES = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань",
+          "Нижний Новгород", "Челябинск", "Самара", "Омск", "Ростов-на-Дону"]
+CATEGORIES = ["кошка", "собака", "попугай", "хомяк", "кролик", "черепаха", "хорёк", "морская свинка"]
+
+
+def zipf_weights(n: int, s: float) -> np.ndarray:
+    weights = 1.0 / np.arange(1, n + 1) ** s
+    return weights / weights.sum()
+
+
+def make_names(base: List[str], n: int, prefix: str) -> List[str]:
+    return base[:n] + [f"{prefix}-{i}" for i in range(len(base), n)]
+
+
+def animal_photo(rng: np.random.Generator, base: np.ndarray, side: int, jitter: float) -> bytes:
+    """Снимок животного: общий для него узор + сдвиг яркости, шум и случайное кадрирование"""
+    pattern = np.clip(base * rng.uniform(0.85, 1.15) + rng.normal(0, jitter, base.shape), 0, 255)
+    image = Image.fromarray(pattern.astype(np.uint8)).resize((side + side // 4, side + side // 4), Image.BICUBIC)
+    left, top = rng.integers(0, side // 4 + 1, 2)
+    buffer = BytesIO()
+    image.crop((left, top, left + side, top + side)).save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def generate(db_path: str, photos_dir: str, n_requests: int, n_cities: int = 10,
+             n_categories: int = 8, found_ratio: float = 0.3, photo_side: int = 256,
+             city_skew: float = 1.2, category_skew: float = 1.5, seed: int = 0) -> Dict[str, int]:
+    """Создаёт базу со схемой текущих миграций и наполняет её заявками"""
+    rng = np.random.default_rng(seed)
+    initialize_database(db_path)
+    photos = PhotoStore(photos_dir)
+    cities = make_names(CITIES, n_cities, "Город")
+    categories = make_names(CATEGORIES, n_categories, "Категория")
+    city_weights = zipf_weights(n_cities, city_skew)
+    category_weights = zipf_weights(n_categories, category_skew)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        n_users = max(1, n_requests // 2)
+        conn.executemany("INSERT INTO users (chat_id, username) VALUES (?, ?)",
+                         [(100000 + i, f"user{i}") for i in range(n_users)])
+
+        now = datetime.now()
+        rows = []
+        while len(rows) < n_requests:
+            city = cities[rng.choice(n_cities, p=city_weights)]
+            category = categories[rng.choice(n_categories, p=category_weights)]
+            base = rng.random((8, 8, 3)) * 255
+            request_types = ["lost", "found"] if rng.random() < found_ratio else [str(rng.choice(["lost", "found"]))]
+            for request_type in request_types:
+                data = animal_photo(rng, base, photo_side, jitter=12.0)
+                created_at = now - timedelta(days=float(rng.uniform(0, 29)))
+                rows.append((
+                    int(rng.integers(1, n_users + 1)), request_type, photos.put(data), category,
+                    "дворняга", str(rng.choice(["самец", "самка", "неизвестно"])),
+                    str(rng.choice(["маленький", "средний", "большой"])),
+                    str(rng.choice(["короткая", "длинная", "нет"])),
+                    city, None, created_at.strftime("%Y-%m-%d %H:%M:%S"), to_db(dhash_bytes(data))
+                ))
+
+        conn.executemany("""
+            INSERT INTO requests (
+                user_id, request_type, photo_hash, category, breed, gender,
+                size, hair, city, chip_number, created_at, dhash
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows[:n_requests])
+        conn.commit()
+        partitions = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT request_type, city, category FROM requests)"
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+    return {"users": n_users, "requests": n_requests, "partitions": partitions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--photos-dir", required=True)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--cities", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--found-ratio", type=float, default=0.3,
+                        help="доля животных, у которых есть и заявка 'потерял', и 'нашёл'")
+    parser.add_argument("--photo-side", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stats = generate(args.db, args.photos_dir, args.requests, args.cities, args.categories,
+                     args.found_ratio, args.photo_side, seed=args.seed)
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
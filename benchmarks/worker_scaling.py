@@ -0,0 +1,133 @@
+"""
+Масштабирование воркеров очереди задач (worker.py): пропускная способность
+сопоставления при 1, 2, 4... процессах на одной и той же синтетической базе.
+
+Каждый прогон - свежая копия базы, все заявки ставятся в очередь jobs, затем
+N процессов run_worker(exit_when_idle=True) разбирают её. Проверяется, что все задачи
+выполнены ровно по разу и число уведомлений не зависит от N; иначе код возврата 1.
+Ускорение ограничено числом ядер машины.
+
+Запуск из корня репозитория:
+    python -m benchmarks.worker_scaling --requests 2000 --processes 1 2 4
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict
+
+from benchmarks.pipeline_benchmark import generate_dataset
+
+
+def _worker(work_dir: str, encoder: str, threads: int):
+    # Модули бота импортируются после chdir: пути хранилищ фото в config относительные
+    os.chdir(work_dir)
+    from clip_backend import configure_threads
+    from worker import run_worker
+
+    if encoder == "stub":
+        from benchmarks.stub_encoder import install_stub_encoder
+        install_stub_encoder()
+    else:
+        configure_threads(threads)
+    asyncio.run(run_worker(str(Path(work_dir) / "bench.db"), exit_when_idle=True))
+
+
+def _prepare_queue(db_path: str) -> int:
+    from database import connect
+    from job_queue import JobQueue
+
+    conn = connect(db_path)
+    try:
+        requests = conn.execute("SELECT id, trace_id FROM requests WHERE is_active = 1 ORDER BY id").fetchall()
+        JobQueue(db_path).enqueue(conn, requests)
+        conn.commit()
+        return len(requests)
+    finally:
+        conn.close()
+
+
+def _queue_report(db_path: str) -> Dict[str, int]:
+    from database import connect
+
+    conn = connect(db_path)
+    try:
+        report = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        report["attempts"] = conn.execute("SELECT COALESCE(SUM(attempts), 0) FROM jobs").fetchone()[0]
+        report["outbox_rows"] = conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        return report
+    finally:
+        conn.close()
+
+
+def run(base_dir: Path, run_dir: Path, processes: int, args) -> Dict[str, float]:
+    shutil.copytree(base_dir, run_dir)
+    db_path = str(run_dir / "bench.db")
+    jobs = _prepare_queue(db_path)
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=_worker, args=(str(run_dir), args.encoder, args.threads))
+               for _ in range(processes)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - started
+
+    report = _queue_report(db_path)
+    return {
+        "processes": processes,
+        "jobs": jobs,
+        "seconds": seconds,
+        "jobs_per_second": jobs / seconds if seconds else 0.0,
+        "done": report.get("done", 0),
+        "pending": report.get("pending", 0) + report.get("running", 0),
+        "failed": report.get("failed", 0),
+        "attempts": report["attempts"],
+        "outbox_rows": report["outbox_rows"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--cities", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=1, help="потоков инференса на процесс")
+    parser.add_argument("--encoder", choices=["stub", "clip"], default="stub")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(json.dumps({"cpu_count": os.cpu_count()}))
+    failed = False
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        base_dir = work_dir / "base"
+        base_dir.mkdir()
+        generate_dataset(base_dir, args)
+
+        baseline = None
+        outbox_rows = None
+        for processes in args.processes:
+            report = run(base_dir, work_dir / f"run{processes}", processes, args)
+            baseline = baseline or report["jobs_per_second"]
+            report["speedup"] = report["jobs_per_second"] / baseline if baseline else 0.0
+            # Каждая задача выполнена ровно раз, результат не зависит от числа воркеров
+            outbox_rows = report["outbox_rows"] if outbox_rows is None else outbox_rows
+            report["ok"] = (report["done"] == report["jobs"] and report["attempts"] == report["jobs"]
+                            and report["outbox_rows"] == outbox_rows)
+            failed |= not report["ok"]
+            print(json.dumps(report, ensure_ascii=False))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
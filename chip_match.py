@@ -0,0 +1,81 @@
+import logging
+import re
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+from notifier import enqueue_notifications
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ISO 11784 - 15 цифр, старые форматы (AVID, FECAVA) - 9-10 цифр и букв
+CHIP_MIN_LENGTH = 9
+CHIP_MAX_LENGTH = 15
+
+# Схожесть, с которой совпадение по чипу попадает в историю и очередь уведомлений
+CHIP_MATCH_SIMILARITY = 1.0
+
+# Активные заявки противоположного типа с тем же чипом (частичный индекс idx_requests_chip)
+CHIP_MATCH_SQL = """
+    SELECT r.id, r.user_id, u.chat_id FROM requests r
+    JOIN users u ON u.id = r.user_id
+    WHERE r.chip_number = ? AND r.request_type = ? AND r.is_active = 1 AND u.chat_id != ?
+"""
+
+# Заявка из CHIP_MATCH_SQL: (request_id, user_id, chat_id)
+ChipMatch = Tuple[int, int, int]
+
+
+def normalize_chip_number(text: Optional[str]) -> Optional[str]:
+    """
+    Номер чипа без пробелов, дефисов и точек, в верхнем регистре.
+    None - если после очистки это не похоже на номер чипа
+    """
+    if not text:
+        return None
+    value = re.sub(r"[^0-9A-Za-z]", "", text).upper()
+    if not CHIP_MIN_LENGTH <= len(value) <= CHIP_MAX_LENGTH:
+        return None
+    return value
+
+
+def find_chip_matches(conn: sqlite3.Connection, chip_number: str, request_type: str,
+                      chat_id: int) -> List[ChipMatch]:
+    """Заявки другой стороны с тем же чипом (свои заявки пользователя не считаются)"""
+    opposite_type = "found" if request_type == "lost" else "lost"
+    return conn.execute(CHIP_MATCH_SQL, (chip_number, opposite_type, chat_id)).fetchall()
+
+
+def record_chip_matches(conn: sqlite3.Connection, request_id: int, user_id: int, chat_id: int,
+                        matches: List[ChipMatch]) -> int:
+    """
+    Записывает совпадения по чипу в транзакцию переданного соединения: история уведомлений,
+    исходящая очередь для обоих пользователей и отметка chip_match_id у обеих заявок
+    (такие заявки фоновая обработка CLIP пропускает). Возвращает число поставленных уведомлений
+    """
+    queued = 0
+    for match_id, match_user_id, match_chat_id in matches:
+        conn.execute("UPDATE requests SET chip_match_id = ? WHERE id = ?", (match_id, request_id))
+        conn.execute("UPDATE requests SET chip_match_id = ? WHERE id = ? AND chip_match_id IS NULL",
+                     (request_id, match_id))
+
+        user_low, user_high = min(user_id, match_user_id), max(user_id, match_user_id)
+        if conn.execute("SELECT 1 FROM notifications WHERE user_low = ? AND user_high = ?",
+                        (user_low, user_high)).fetchone():
+            continue
+        conn.execute("""
+            INSERT OR IGNORE INTO notifications
+            (source_request, matched_request, similarity, user_low, user_high)
+            VALUES (?, ?, ?, ?, ?)
+        """, (request_id, match_id, CHIP_MATCH_SIMILARITY, user_low, user_high))
+        # Совпадение по чипу находится в момент подачи заявки
+        enqueue_notifications(conn, [
+            (chat_id, match_user_id, CHIP_MATCH_SIMILARITY),
+            (match_chat_id, user_id, CHIP_MATCH_SIMILARITY),
+        ], submitted_at=time.time())
+        queued += 2
+
+    if matches:
+        logger.info(f"Заявка {request_id}: совпадение по чипу с {[match[0] for match in matches]}")
+    return queued
@@ -0,0 +1,170 @@
+import logging
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+from config import CLIP_BACKEND, CLIP_EXPORT_DIR, CLIP_MODEL_NAME, CLIP_QUANTIZE, INFERENCE_THREADS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# torch - исходная модель sentence-transformers или её визуальная часть (с CLIP_QUANTIZE),
+# torchscript - трассированная визуальная часть, onnx - экспорт в ONNX Runtime
+BACKENDS = ("torch", "torchscript", "onnx")
+
+# CLIP всё равно приводит изображение к 224px по короткой стороне
+MODEL_INPUT_SIZE = 224
+
+
+def configure_threads(threads: int = INFERENCE_THREADS):
+    """Число потоков внутри операций PyTorch (0 - значение библиотеки по умолчанию)"""
+    if threads > 0:
+        import torch
+        torch.set_num_threads(threads)
+
+
+def _vision_tower(clip_model):
+    """Визуальная часть CLIP: пиксели -> эмбеддинг, как CLIPModel.get_image_features"""
+    import torch
+
+    class VisionTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.vision_model = clip_model.vision_model
+            self.visual_projection = clip_model.visual_projection
+
+        def forward(self, pixel_values):
+            pooled = self.vision_model(pixel_values=pixel_values, return_dict=False)[1]
+            return self.visual_projection(pooled)
+
+    return VisionTower().eval()
+
+
+class ReferenceEncoder:
+    """Исходная модель sentence-transformers: eager PyTorch, float32"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, images: List[Image.Image]) -> np.ndarray:
+        return self.model.encode(images, batch_size=len(images))
+
+
+class _VisionEncoder:
+    """Общая часть ускоренных бэкендов: та же предобработка, что у sentence-transformers"""
+
+    def __init__(self, model):
+        self.image_processor = model[0].processor.image_processor
+
+    def preprocess(self, images: List[Image.Image]) -> np.ndarray:
+        pixels = self.image_processor(images=images, return_tensors="np")["pixel_values"]
+        return np.ascontiguousarray(pixels, dtype=np.float32)
+
+
+class TorchVisionEncoder(_VisionEncoder):
+    """Визуальная часть CLIP в PyTorch: с динамическим int8 квантованием и/или TorchScript"""
+
+    def __init__(self, model, quantize: bool = False, script: bool = False):
+        import torch
+
+        super().__init__(model)
+        tower = _vision_tower(model[0].model)
+        if quantize:
+            # Веса Linear - int8, активации квантуются на лету; копия, исходная модель не меняется
+            tower = torch.ao.quantization.quantize_dynamic(tower, {torch.nn.Linear}, dtype=torch.qint8)
+        if script:
+            example = torch.zeros(1, 3, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE)
+            with torch.inference_mode():
+                tower = torch.jit.freeze(torch.jit.trace(tower, example).eval())
+        self.tower = tower
+
+    def encode(self, images: List[Image.Image]) -> np.ndarray:
+        import torch
+
+        pixels = torch.from_numpy(self.preprocess(images))
+        with torch.inference_mode():
+            return self.tower(pixels).numpy()
+
+
+def export_onnx(model, export_dir: str = CLIP_EXPORT_DIR, quantize: bool = False) -> Path:
+    """
+    Экспортирует визуальную часть CLIP в ONNX (один раз, файл переиспользуется).
+    С quantize - дополнительно динамическое int8 квантование весов
+    """
+    export_dir = Path(export_dir)
+    export_dir.mkdir(parents=True, exist_ok=True)
+    base = CLIP_MODEL_NAME.replace("/", "_")
+    fp32_path = export_dir / f"{base}-vision.onnx"
+    int8_path = export_dir / f"{base}-vision-int8.onnx"
+
+    if not fp32_path.exists():
+        import torch
+
+        tower = _vision_tower(model[0].model)
+        example = torch.zeros(1, 3, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE)
+        tmp_path = fp32_path.with_suffix(".tmp")
+        torch.onnx.export(
+            tower, (example,), str(tmp_path),
+            input_names=["pixel_values"], output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=17,
+        )
+        tmp_path.replace(fp32_path)
+        logger.info(f"Визуальная часть CLIP экспортирована в {fp32_path}")
+
+    if not quantize:
+        return fp32_path
+    if not int8_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_path = int8_path.with_suffix(".tmp")
+        quantize_dynamic(str(fp32_path), str(tmp_path), weight_type=QuantType.QInt8)
+        tmp_path.replace(int8_path)
+        logger.info(f"int8 модель сохранена в {int8_path}")
+    return int8_path
+
+
+class OnnxVisionEncoder(_VisionEncoder):
+    """Визуальная часть CLIP в ONNX Runtime (CPU)"""
+
+    def __init__(self, model, quantize: bool = False, threads: int = INFERENCE_THREADS,
+                 export_dir: str = CLIP_EXPORT_DIR):
+        import onnxruntime as ort
+
+        super().__init__(model)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            str(export_onnx(model, export_dir, quantize)), options, providers=["CPUExecutionProvider"]
+        )
+
+    def encode(self, images: List[Image.Image]) -> np.ndarray:
+        return self.session.run(None, {"pixel_values": self.preprocess(images)})[0]
+
+
+def create_image_encoder(model, backend: str = CLIP_BACKEND, quantize: bool = CLIP_QUANTIZE,
+                         threads: int = INFERENCE_THREADS, export_dir: str = CLIP_EXPORT_DIR):
+    """
+    Кодировщик изображений для модели sentence-transformers по настройкам бэкенда.
+    Если бэкенд недоступен (нет onnxruntime, ошибка экспорта), используется исходная модель
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд CLIP: {backend}, доступны {BACKENDS}")
+    configure_threads(threads)
+    if backend == "torch" and not quantize:
+        return ReferenceEncoder(model)
+    try:
+        if backend == "onnx":
+            encoder = OnnxVisionEncoder(model, quantize, threads, export_dir)
+        else:
+            encoder = TorchVisionEncoder(model, quantize, script=backend == "torchscript")
+    except Exception as e:
+        logger.warning(f"Бэкенд CLIP {backend} (int8={quantize}) недоступен, используется исходная модель: {str(e)}")
+        return ReferenceEncoder(model)
+    logger.info(f"Бэкенд CLIP: {backend}, int8={quantize}, потоков={threads or 'по умолчанию'}")
+    return encoder
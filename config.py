@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -6,3 +7,110 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 #здесь можно прописать ссылку на базу данных
+DATABASE_NAME = os.getenv("DATABASE_NAME", "database.db")
+
+# Модель CLIP и версия эмбеддингов.
+# При смене модели или версии сохранённые векторы считаются устаревшими и пересчитываются
+CLIP_MODEL_NAME = os.getenv("CLIP_MODEL_NAME", "clip-ViT-B-32")
+EMBEDDING_VERSION = os.getenv("EMBEDDING_VERSION", "1")
+
+# Бэкенд визуальной части CLIP на CPU: torch (исходная модель), torchscript или onnx;
+# динамическое int8 квантование весов, потоков на операцию (0 - по умолчанию библиотеки)
+# и каталог для экспортированных моделей
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "torch")
+CLIP_QUANTIZE = os.getenv("CLIP_QUANTIZE", "0") == "1"
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "0"))
+CLIP_EXPORT_DIR = os.getenv("CLIP_EXPORT_DIR", "models")
+
+# Текстовый поиск /search: текстовая модель в пространстве CLIP_MODEL_NAME
+# (многоязычная - запросы на русском), размер LRU кеша текстовых эмбеддингов,
+# сколько частых фраз "порода категория" посчитать при запуске и сколько результатов показать
+CLIP_TEXT_MODEL_NAME = os.getenv("CLIP_TEXT_MODEL_NAME", "clip-ViT-B-32-multilingual-v1")
+TEXT_CACHE_SIZE = int(os.getenv("TEXT_CACHE_SIZE", "1024"))
+TEXT_PRECOMPUTE_PHRASES = int(os.getenv("TEXT_PRECOMPUTE_PHRASES", "200"))
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "5"))
+
+# Микробатчинг инференса CLIP: максимальный размер батча,
+# время ожидания добора батча и ограничение длины очереди
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "32"))
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "10"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "1024"))
+
+# Приближённый поиск ближайших соседей (IVF) по партициям (тип, город, категория).
+# При ANN_INDEX_ENABLED=0 используется точный перебор
+ANN_INDEX_ENABLED = os.getenv("ANN_INDEX_ENABLED", "1") == "1"
+ANN_N_PROBE = int(os.getenv("ANN_N_PROBE", "8"))
+ANN_MIN_TRAIN_SIZE = int(os.getenv("ANN_MIN_TRAIN_SIZE", "2048"))
+MATCH_TOP_K = int(os.getenv("MATCH_TOP_K", "50"))
+
+# Хранение векторов в индексе: float32, float16 или int8 (с масштабом на вектор).
+# В таблице embeddings векторы остаются float32 - по ним top-k пересчитывается точно
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float16")
+EMBEDDING_RERANK = os.getenv("EMBEDDING_RERANK", "1") == "1"
+RERANK_MARGIN = float(os.getenv("RERANK_MARGIN", "0.02"))
+
+# Пулы для работы вне event loop: потоки для SQLite, процессы для инференса
+# (INFERENCE_PROCESSES=0 - инференс в текущем процессе) и лимит одновременных задач
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+INFERENCE_PROCESSES = int(os.getenv("INFERENCE_PROCESSES", "1"))
+WORKER_MAX_PENDING = int(os.getenv("WORKER_MAX_PENDING", "64"))
+
+# Очередь задач сопоставления для отдельных воркеров (worker.py).
+# При JOB_QUEUE_ENABLED=1 бот только ставит задачи, сопоставление выполняют воркеры;
+# аренда задачи (воркер продлевает её, пока работает), число попыток и период опроса очереди
+JOB_QUEUE_ENABLED = os.getenv("JOB_QUEUE_ENABLED", "0") == "1"
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "1"))
+
+# Пул соединений SQLite: сколько соединений держать открытыми,
+# таймаут ожидания блокировки и размер кеша подготовленных выражений на соединение
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+# Каталог контентно-адресуемого хранилища фотографий (файлы по SHA-256)
+PHOTO_STORE_DIR = os.getenv("PHOTO_STORE_DIR", "photos")
+# Миниатюры 224px для повторного расчёта эмбеддингов лежат под хешем оригинала
+THUMBNAIL_STORE_DIR = os.getenv("THUMBNAIL_STORE_DIR", os.path.join(PHOTO_STORE_DIR, "thumbs"))
+
+# Холодный архив: заявки старше ARCHIVE_AFTER_DAYS (окно фоновой обработки) и деактивированные
+# переносятся в отдельную БД и каталог фото. Архивация идёт порциями раз в ARCHIVE_INTERVAL_HOURS,
+# затем освобождается до VACUUM_PAGES страниц (incremental vacuum)
+ARCHIVE_DATABASE_NAME = os.getenv("ARCHIVE_DATABASE_NAME", "archive.db")
+ARCHIVE_PHOTO_STORE_DIR = os.getenv("ARCHIVE_PHOTO_STORE_DIR", "photos_archive")
+ARCHIVE_THUMBNAIL_STORE_DIR = os.getenv("ARCHIVE_THUMBNAIL_STORE_DIR",
+                                        os.path.join(ARCHIVE_PHOTO_STORE_DIR, "thumbs"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "5000"))
+
+# Диалог подачи заявки: состояние FSM хранит только file_id фото, а скачанное фото лежит
+# во временном файле до сохранения заявки. PHOTO_SPOOL_ENABLED=0 - без файлов, фото скачивается
+# заново при сохранении; диалоги без активности дольше DIALOG_TTL_MINUTES забываются вместе с файлами
+PHOTO_SPOOL_ENABLED = os.getenv("PHOTO_SPOOL_ENABLED", "1") == "1"
+PHOTO_SPOOL_DIR = os.getenv("PHOTO_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "petfinder-spool"))
+DIALOG_TTL_MINUTES = float(os.getenv("DIALOG_TTL_MINUTES", "60"))
+
+# Кеш фото по file_unique_id Telegram: записей в SQLite и в LRU в памяти
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "50000"))
+PHOTO_CACHE_MEMORY_SIZE = int(os.getenv("PHOTO_CACHE_MEMORY_SIZE", "1024"))
+
+# Исходящая очередь уведомлений: общий и на один чат лимит сообщений в секунду,
+# число попыток, максимум совпадений в одном сводном сообщении и период опроса очереди
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_PER_CHAT_RATE = float(os.getenv("SEND_PER_CHAT_RATE", "1"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+SEND_DIGEST_SIZE = int(os.getenv("SEND_DIGEST_SIZE", "10"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+
+# Перцептивный хеш (dHash, 64 бита): максимальное расстояние Хэмминга,
+# при котором фото считаются дубликатами и сопоставляются без CLIP
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+
+# Метрики в формате Prometheus на локальном HTTP эндпоинте /metrics (порт 0 - выключено)
+# и доля записей, которые пишут отладочные логи горячих циклов
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
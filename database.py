@@ -1,51 +1,197 @@
+import asyncio
+import contextvars
+import queue
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Any, Callable, Dict, Optional
 
+from config import DATABASE_NAME, DB_BUSY_TIMEOUT_MS, DB_POOL_SIZE, DB_STATEMENT_CACHE
+from metrics import stage_timer
+from migrations import check_query_plans, run_migrations
 
-def initialize_database():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER UNIQUE NOT NULL,
-            username TEXT,
-            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            request_type TEXT CHECK(request_type IN ('found', 'lost')),
-            photo_data BLOB NOT NULL,
-            breed TEXT,
-            category TEXT,
-            gender TEXT CHECK(gender IN ('самец', 'самка', 'неизвестно')),
-            size TEXT CHECK(size IN ('маленький', 'средний', 'большой')),
-            hair TEXT CHECK(hair IN ('короткая', 'длинная', 'нет')),
-            city TEXT NOT NULL,
-            chip_number TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active INTEGER DEFAULT 1 CHECK(is_active IN (0, 1)), 
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notifications (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            source_request INTEGER,
-            matched_request INTEGER,
-            similarity REAL,
-            notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(source_request, matched_request),  -- Добавляем уникальность
-            FOREIGN KEY(source_request) REFERENCES requests(id),
-            FOREIGN KEY(matched_request) REFERENCES requests(id)
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий выполнение выражений (этап sql)"""
+
+    def execute(self, sql, parameters=()):
+        with stage_timer("sql"):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with stage_timer("sql"):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение из пула: close() возвращает его в пул вместо закрытия"""
+    pool: Optional["ConnectionPool"] = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    # Connection.execute создаёт курсор в обход cursor() - направляем через замеряемый курсор
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        if self.pool is None:
+            return super().close()
+        # Незакоммиченные изменения отбрасываются, как при обычном закрытии
+        if self.in_transaction:
+            self.rollback()
+        self.pool.release(self)
+
+    def dispose(self):
+        """Действительно закрывает соединение"""
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Пул соединений SQLite в режиме WAL: читатели не блокируют писателя,
+    а кеш подготовленных выражений переживает отдельные запросы
+    """
+
+    def __init__(self, db_path: str = DATABASE_NAME, size: int = DB_POOL_SIZE,
+                 busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS):
+        self.db_path = db_path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle: "queue.LifoQueue[PooledConnection]" = queue.LifoQueue()
+        self._trace_callback: Optional[Callable[[str], None]] = None
+
+    def _connect(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            factory=PooledConnection,
+            check_same_thread=False,  # Соединение используется одним потоком за раз
+            cached_statements=DB_STATEMENT_CACHE
         )
-    ''')
-    conn.commit()
-    conn.close()
-    print(f"[{datetime.now()}] База данных инициализирована")
-initialize_database()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        conn.set_trace_callback(self._trace_callback)
+        conn.pool = self
+        return conn
+
+    def set_trace_callback(self, callback: Optional[Callable[[str], None]]):
+        """
+        Вызывается для каждого выполненного SQL (подсчёт запросов в бенчмарках).
+        Применяется к свободным и новым соединениям - ставить до начала работы
+        """
+        self._trace_callback = callback
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for conn in idle:
+            conn.set_trace_callback(callback)
+            self._idle.put(conn)
+
+    def acquire(self) -> PooledConnection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            # Пул не блокирует вызывающего: при нехватке открывается новое соединение,
+            # а лишние закрываются при возврате
+            return self._connect()
+
+    def release(self, conn: PooledConnection):
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.dispose()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().dispose()
+            except queue.Empty:
+                return
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str = DATABASE_NAME) -> ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(db_path)
+        return pool
+
+
+def connect(db_path: str = DATABASE_NAME) -> PooledConnection:
+    """Соединение из пула. Закрытие (conn.close()) возвращает его в пул"""
+    return get_pool(db_path).acquire()
+
+
+class AsyncDatabase:
+    """Асинхронный доступ к БД: запросы выполняются в выделенном потоке, не блокируя бота"""
+
+    def __init__(self, db_path: str = DATABASE_NAME):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="sqlite")
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Выполняет fn(conn, *args) в одной транзакции и коммитит её"""
+        def call():
+            conn = connect(self.db_path)
+            try:
+                result = fn(conn, *args)
+                conn.commit()
+                return result
+            finally:
+                conn.close()
+
+        # Контекст (trace id) переносится в поток БД
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, call)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Выполняет изменяющий запрос, возвращает lastrowid"""
+        return await self.run(lambda conn: conn.execute(sql, params).lastrowid)
+
+
+# Общий асинхронный интерфейс для хендлеров
+db = AsyncDatabase()
+
+
+def initialize_database(db_path: str = DATABASE_NAME):
+    conn = connect(db_path)
+    try:
+        version = run_migrations(conn)
+    finally:
+        conn.close()
+    print(f"[{datetime.now()}] База данных инициализирована (версия схемы {version})")
+
+
+if __name__ == "__main__":
+    import sys
+
+    initialize_database()
+    # python database.py --check-plans: проверка планов горячих запросов
+    if "--check-plans" in sys.argv:
+        conn = connect()
+        try:
+            problems = check_query_plans(conn)
+        finally:
+            conn.close()
+        for problem in problems:
+            print(f"Полный проход по таблице: {problem}")
+        sys.exit(1 if problems else 0)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import DIALOG_TTL_MINUTES, PHOTO_SPOOL_DIR
+from metrics import DIALOGS_EXPIRED
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PhotoSpool:
+    """
+    Временные файлы фото на время диалога подачи заявки: в состоянии FSM остаётся
+    только путь, байты читаются при сохранении заявки. Файлы брошенных диалогов
+    удаляются по времени изменения
+    """
+
+    def __init__(self, root: str = PHOTO_SPOOL_DIR):
+        self.root = Path(root)
+
+    def put(self, key: str, data: bytes) -> str:
+        """Записывает фото (атомарно, как PhotoStore) и возвращает путь к файлу"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / key
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return str(path)
+
+    def read(self, path: Optional[str]) -> Optional[bytes]:
+        """Байты фото или None, если файла уже нет (удалён по сроку, перезапуск)"""
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def discard(self, path: Optional[str]):
+        if path:
+            Path(path).unlink(missing_ok=True)
+
+    def purge(self, older_than_seconds: float) -> int:
+        """Удаляет файлы старше older_than_seconds; возвращает их число"""
+        if not self.root.exists():
+            return 0
+        deadline = time.time() - older_than_seconds
+        removed = 0
+        for path in self.root.iterdir():
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+class ExpiringMemoryStorage(MemoryStorage):
+    """
+    MemoryStorage, которая забывает диалоги без активности дольше ttl_seconds.
+    Пустые записи (пользователь не в диалоге) тоже удаляются - память не растёт
+    с числом пользователей, которые когда-либо писали боту
+    """
+
+    def __init__(self, ttl_seconds: float = DIALOG_TTL_MINUTES * 60,
+                 on_expire: Optional[Callable[[Dict[str, Any]], None]] = None):
+        super().__init__()
+        self.ttl_seconds = ttl_seconds
+        self.on_expire = on_expire
+        self._touched: Dict[StorageKey, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _is_stale(self, key: StorageKey) -> bool:
+        touched = self._touched.get(key)
+        return touched is not None and time.monotonic() - touched > self.ttl_seconds
+
+    def _drop(self, key: StorageKey):
+        record = self.storage.pop(key, None)
+        self._touched.pop(key, None)
+        if record is not None and (record.state is not None or record.data):
+            DIALOGS_EXPIRED.inc()
+            if self.on_expire is not None:
+                try:
+                    self.on_expire(record.data)
+                except Exception as e:
+                    logger.error(f"Ошибка очистки просроченного диалога: {str(e)}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        self._touched[key] = time.monotonic()
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await super().set_data(key, data)
+        self._touched[key] = time.monotonic()
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        # Диалог мог истечь между проходами очистки - пользователь начинает заново
+        if self._is_stale(key):
+            self._drop(key)
+        return await super().get_state(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        if self._is_stale(key):
+            self._drop(key)
+        return await super().get_data(key)
+
+    def expire(self) -> int:
+        """Удаляет просроченные и пустые записи; возвращает число просроченных диалогов"""
+        expired = 0
+        for key in list(self.storage):
+            record = self.storage[key]
+            if record.state is None and not record.data:
+                self.storage.pop(key, None)
+                self._touched.pop(key, None)
+            elif self._is_stale(key):
+                self._drop(key)
+                expired += 1
+        return expired
+
+    def start(self, interval_seconds: Optional[float] = None):
+        """Периодическая очистка в event loop (по умолчанию - каждую четверть ttl)"""
+        async def run():
+            while True:
+                await asyncio.sleep(interval_seconds or max(1.0, self.ttl_seconds / 4))
+                expired = self.expire()
+                if expired:
+                    logger.info(f"Удалено просроченных диалогов: {expired}")
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(run())
+
+    async def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await super().close()
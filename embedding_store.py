@@ -0,0 +1,202 @@
+import logging
+import sqlite3
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from config import CLIP_MODEL_NAME, DATABASE_NAME, EMBEDDING_VERSION
+from database import connect
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Горячие запросы сопоставления (их планы проверяет migrations.check_query_plans).
+# Заявки с совпадением по чипу в сопоставление CLIP не попадают - как в NEW_REQUESTS_SQL
+CANDIDATES_SQL = """
+    SELECT r.id, e.vector
+    FROM requests r
+    JOIN embeddings e ON e.request_id = r.id
+    WHERE r.request_type = ?
+    AND r.city = ?
+    AND r.category = ?
+    AND r.id != ?
+    AND r.is_active = 1
+    AND r.chip_match_id IS NULL
+    AND e.model_name = ?
+    AND e.model_version = ?
+"""
+
+# Заявки, чьё фото не удалось декодировать этой моделью, пропускаются до смены фото или модели
+MISSING_SQL = """
+    SELECT r.id, r.photo_hash
+    FROM requests r
+    LEFT JOIN embeddings e
+        ON e.request_id = r.id
+        AND e.model_name = ?
+        AND e.model_version = ?
+    LEFT JOIN embedding_failures f
+        ON f.request_id = r.id
+        AND f.photo_hash = r.photo_hash
+        AND f.model_name = ?
+        AND f.model_version = ?
+    WHERE r.request_type = ?
+    AND r.city = ?
+    AND r.category = ?
+    AND r.is_active = 1
+    AND r.chip_match_id IS NULL
+    AND e.request_id IS NULL
+    AND f.request_id IS NULL
+"""
+
+
+class EmbeddingStore:
+    """Хранилище эмбеддингов CLIP: вектор считается один раз при создании заявки"""
+
+    def __init__(self, db_path: str = DATABASE_NAME,
+                 model_name: str = CLIP_MODEL_NAME,
+                 model_version: str = EMBEDDING_VERSION):
+        self.db_path = db_path
+        self.model_name = model_name
+        self.model_version = model_version
+
+    @staticmethod
+    def _to_blob(embedding: np.ndarray) -> bytes:
+        """Нормализует вектор и сериализует его в float32"""
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        return vector.astype(np.float32).tobytes()
+
+    @staticmethod
+    def _from_blob(blob: bytes) -> np.ndarray:
+        return np.frombuffer(blob, dtype=np.float32)
+
+    def save(self, request_id: int, embedding: np.ndarray, conn: Optional[sqlite3.Connection] = None):
+        """Сохраняет эмбеддинг заявки. Если передано соединение - пишет в его транзакцию"""
+        blob = self._to_blob(embedding)
+        own_conn = conn is None
+        if own_conn:
+            conn = connect(self.db_path)
+
+        try:
+            conn.execute("""
+                INSERT OR REPLACE INTO embeddings
+                (request_id, model_name, model_version, dim, vector)
+                VALUES (?, ?, ?, ?, ?)
+            """, (request_id, self.model_name, self.model_version,
+                  len(blob) // 4, blob))
+            if own_conn:
+                conn.commit()
+        finally:
+            if own_conn:
+                conn.close()
+
+    def load(self, request_id: int) -> Optional[np.ndarray]:
+        """Возвращает актуальный эмбеддинг заявки или None"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT vector FROM embeddings
+                WHERE request_id = ? AND model_name = ? AND model_version = ?
+            """, (request_id, self.model_name, self.model_version))
+            row = cursor.fetchone()
+            return self._from_blob(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def _fetch_candidate_rows(self, request_type: str, city: str, category: str,
+                              exclude_id: int) -> List[Tuple[int, bytes]]:
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(CANDIDATES_SQL, (request_type, city, category, exclude_id,
+                  self.model_name, self.model_version))
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def load_candidates(self, request_type: str, city: str, category: str,
+                        exclude_id: int) -> List[Tuple[int, np.ndarray]]:
+        """Эмбеддинги активных заявок с заданным типом, городом и категорией"""
+        rows = self._fetch_candidate_rows(request_type, city, category, exclude_id)
+        return [(req_id, self._from_blob(blob)) for req_id, blob in rows]
+
+    def load_candidate_matrix(self, request_type: str, city: str, category: str,
+                              exclude_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """То же, что load_candidates, но в виде (ids, непрерывная матрица (N, dim))"""
+        rows = self._fetch_candidate_rows(request_type, city, category, exclude_id)
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+        ids = np.fromiter((req_id for req_id, _ in rows), dtype=np.int64, count=len(rows))
+        # Все векторы одной модели имеют одинаковую размерность - склеиваем байты в одну матрицу
+        matrix = np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.float32).reshape(len(rows), -1)
+        return ids, matrix
+
+    def load_many(self, request_ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Точные float32 векторы заданных заявок: (ids, матрица (N, dim)) в порядке выборки"""
+        if len(request_ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+        conn = connect(self.db_path)
+        try:
+            placeholders = ", ".join("?" * len(request_ids))
+            rows = conn.execute(f"""
+                SELECT request_id, vector FROM embeddings
+                WHERE request_id IN ({placeholders})
+                AND model_name = ? AND model_version = ?
+            """, [int(req_id) for req_id in request_ids] + [self.model_name, self.model_version]).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+        ids = np.fromiter((req_id for req_id, _ in rows), dtype=np.int64, count=len(rows))
+        matrix = np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.float32).reshape(len(rows), -1)
+        return ids, matrix
+
+    def load_since(self, after_id: int) -> List[Tuple[int, str, str, str, np.ndarray]]:
+        """Активные заявки с id > after_id вместе с партицией: (id, type, city, category, vector)"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT r.id, r.request_type, r.city, r.category, e.vector
+                FROM requests r
+                JOIN embeddings e ON e.request_id = r.id
+                WHERE r.id > ?
+                AND r.is_active = 1
+                AND r.chip_match_id IS NULL
+                AND e.model_name = ?
+                AND e.model_version = ?
+                ORDER BY r.id
+            """, (after_id, self.model_name, self.model_version))
+            return [(req_id, request_type, city, category, self._from_blob(blob))
+                    for req_id, request_type, city, category, blob in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def load_missing(self, request_type: str, city: str, category: str) -> List[Tuple[int, str]]:
+        """Активные заявки без актуального эмбеддинга (старые записи или смена модели)"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(MISSING_SQL, (self.model_name, self.model_version, self.model_name, self.model_version,
+                                         request_type, city, category))
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def record_failure(self, request_id: int, photo_hash: str, error: str):
+        """Запоминает, что фото заявки не декодируется: load_missing больше его не вернёт"""
+        conn = connect(self.db_path)
+        try:
+            conn.execute("""
+                INSERT OR REPLACE INTO embedding_failures
+                (request_id, photo_hash, model_name, model_version, error)
+                VALUES (?, ?, ?, ?, ?)
+            """, (request_id, photo_hash, self.model_name, self.model_version, error[:500]))
+            conn.commit()
+        finally:
+            conn.close()
@@ -1,16 +1,66 @@
-from aiogram import Bot, Router, F, types
-from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, FSInputFile, ReplyKeyboardRemove, CallbackQuery
+import asyncio
+from aiogram import BaseMiddleware, Bot, Router, F, types
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.types import Message, FSInputFile, InputMediaPhoto, ReplyKeyboardRemove, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 import sqlite3
 import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import numpy as np
 logger = logging.getLogger(__name__)
 import texts
 from texts import CATEGORY_TEXT
+from config import PHASH_MAX_DISTANCE, PHOTO_SPOOL_ENABLED, THUMBNAIL_STORE_DIR
+from background_tasks import BackgroundProcessor
+from database import db
+from dialog_storage import PhotoSpool
+from embedding_store import EmbeddingStore
+from photo_cache import PhotoCache
+from photo_store import PhotoStore
+from image_processing import get_image_embedding_async, make_thumbnail, model_ready, pick_photo_size
+from metrics import stage_timer
+from perceptual_hash import dhash_bytes, from_db, hamming, to_db
+from chip_match import find_chip_matches, normalize_chip_number, record_chip_matches
+from text_search import TextSearch, text_model_ready
+from tracing import new_trace_id, trace_id_var
+from worker_pool import worker_pool
+
+
+class TraceMiddleware(BaseMiddleware):
+    """Восстанавливает trace id диалога из FSM, чтобы логи всех шагов заявки были связаны"""
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        state: Optional[FSMContext] = data.get("state")
+        trace_id = (await state.get_data()).get("trace_id") if state is not None else None
+        token = trace_id_var.set(trace_id or new_trace_id())
+        try:
+            return await handler(event, data)
+        finally:
+            trace_id_var.reset(token)
+
 
 rt = Router()
+rt.message.outer_middleware(TraceMiddleware())
+rt.callback_query.outer_middleware(TraceMiddleware())
+embedding_store = EmbeddingStore()
+photo_store = PhotoStore()
+thumbnail_store = PhotoStore(THUMBNAIL_STORE_DIR)
+photo_cache = PhotoCache()
+photo_spool = PhotoSpool()  # Фото незавершённых заявок (кроме PHOTO_SPOOL_ENABLED=0)
+pending_embeddings = set()  # Заявки, ожидающие эмбеддинга до готовности модели
+
+# Telegram принимает в медиагруппе от 2 до 10 фото
+MEDIA_GROUP_LIMIT = 10
+
+# Перцептивные хеши активных заявок пользователя того же типа
+USER_HASHES_SQL = """
+    SELECT r.id, r.dhash FROM users u
+    JOIN requests r ON r.user_id = u.id
+    WHERE u.chat_id = ? AND r.request_type = ? AND r.is_active = 1 AND r.dhash IS NOT NULL
+"""
 
 
 class Form(StatesGroup):
@@ -25,8 +75,53 @@ class Form(StatesGroup):
     chip_number = State()
 
 
-def create_connection():
-    return sqlite3.connect("database.db")
+async def embed_request_later(request_id: int, photo_data: bytes, matcher: BackgroundProcessor,
+                              trace_id: Optional[str] = None):
+    """Считает эмбеддинг заявки, поставленной в очередь до готовности модели, и сопоставляет её"""
+    try:
+        embedding = await get_image_embedding_async(photo_data)
+        await db.run(lambda conn: embedding_store.save(request_id, embedding, conn))
+    except Exception as e:
+        logger.error(f"Не удалось посчитать эмбеддинг заявки {request_id}: {str(e)}")
+        return
+    matcher.submit(request_id, trace_id)
+
+
+async def load_dialog_photo(bot: Bot, data: dict) -> Optional[Tuple[bytes, bytes]]:
+    """
+    Фото заявки при сохранении: (оригинал, миниатюра 224px) или None, если фото уже
+    в хранилище (кеш по file_unique_id). Байты берутся из временного файла диалога,
+    а без него - повторным скачиванием по file_id: в состоянии FSM их нет
+    """
+    photo_hash = data.get('photo_hash')
+    if photo_hash is not None and photo_store.exists(photo_hash):
+        return None
+    photo_data = photo_spool.read(data.get('photo_spool'))
+    if photo_data is None:
+        with stage_timer("download"):
+            file = await bot.get_file(data['file_id'])
+            photo_data = (await bot.download_file(file.file_path)).read()
+    thumb_data = await asyncio.get_running_loop().run_in_executor(None, make_thumbnail, photo_data)
+    return photo_data, thumb_data
+
+
+def request_image_data(data: dict, photo: Optional[Tuple[bytes, bytes]] = None) -> bytes:
+    """Изображение для модели: миниатюра 224px (или оригинал) загруженного фото либо из хранилища"""
+    if photo is not None:
+        return photo[1] or photo[0]
+    photo_hash = data['photo_hash']
+    if thumbnail_store.exists(photo_hash):
+        return thumbnail_store.read(photo_hash)
+    return photo_store.read(photo_hash)
+
+
+def find_user_duplicate(conn: sqlite3.Connection, chat_id: int, request_type: str,
+                        photo_dhash: int) -> Optional[int]:
+    """id активной заявки пользователя с тем же (или почти тем же) фото"""
+    for request_id, value in conn.execute(USER_HASHES_SQL, (chat_id, request_type)):
+        if hamming(photo_dhash, from_db(value)) <= PHASH_MAX_DISTANCE:
+            return request_id
+    return None
 
 
 def cancel_keyboard():
@@ -53,6 +148,7 @@ def main_keyboard():
 # Обработчик отмены
 @rt.callback_query(F.data == "cancel")
 async def cancel_handler(callback: CallbackQuery, state: FSMContext):
+    photo_spool.discard((await state.get_data()).get('photo_spool'))
     await state.clear()
     await callback.message.answer(texts.CANCEL, reply_markup=main_keyboard(), parse_mode="HTML")
     await callback.answer()
@@ -69,6 +165,93 @@ async def cmd_start(message: Message):
     )
 
 
+def _search_photo(photo_hash: str):
+    """Миниатюра найденной заявки для ответа на /search (оригинал, если миниатюры нет)"""
+    if thumbnail_store.exists(photo_hash):
+        return FSInputFile(thumbnail_store.path(photo_hash))
+    return FSInputFile(photo_store.path(photo_hash))
+
+
+# поиск по текстовому описанию; text_search передаётся из main через Dispatcher
+@rt.message(Command("search"))
+async def handle_search(message: Message, command: CommandObject, text_search: TextSearch):
+    if not command.args or not command.args.strip():
+        await message.answer(texts.SEARCH_USAGE, parse_mode="HTML")
+        return
+    if not text_model_ready.is_set():
+        await message.answer(texts.SEARCH_NOT_READY)
+        return
+
+    description, city = text_search.parse_query(command.args)
+    try:
+        # Поиск не пишет в БД - в общем пуле потоков, не занимая поток транзакций db
+        results = await worker_pool.run_db(text_search.search, description or command.args, city)
+    except Exception as e:
+        logger.error(f"Ошибка поиска по описанию: {str(e)}")
+        await message.answer("⚠️ Не удалось выполнить поиск, попробуйте позже")
+        return
+    if not results:
+        await message.answer(texts.SEARCH_EMPTY)
+        return
+    await send_search_results(message, results, _search_photo)
+
+
+# поиск по холодному архиву заявок - только по запросу пользователя
+@rt.message(Command("archive"))
+async def handle_archive_search(message: Message, command: CommandObject, text_search: TextSearch):
+    if not command.args or not command.args.strip():
+        await message.answer(texts.ARCHIVE_USAGE, parse_mode="HTML")
+        return
+    if not text_model_ready.is_set():
+        await message.answer(texts.SEARCH_NOT_READY)
+        return
+
+    description, city = text_search.parse_query(command.args)
+    try:
+        results = await worker_pool.run_db(text_search.search_archive, description or command.args, city)
+    except Exception as e:
+        logger.error(f"Ошибка поиска по архиву: {str(e)}")
+        await message.answer("⚠️ Не удалось выполнить поиск, попробуйте позже")
+        return
+    if not results:
+        await message.answer(texts.ARCHIVE_EMPTY)
+        return
+    await send_search_results(message, results,
+                              lambda photo_hash: _archive_photo(text_search.archive, photo_hash))
+
+
+def _archive_photo(archive, photo_hash: str) -> Optional[FSInputFile]:
+    """Фото архивной заявки; None, если файла уже нет - заявка попадёт в ответ только текстом"""
+    path = archive.photo_path(photo_hash)
+    return FSInputFile(path) if path is not None else None
+
+
+async def send_search_results(message: Message, results: list,
+                              photo: Callable[[str], Optional[FSInputFile]]):
+    """
+    Фото найденных заявок (медиагруппой, если их несколько) и список с кнопками контактов.
+    Заявки без фото (photo вернул None) есть только в списке
+    """
+    type_names = {"lost": "Потерян", "found": "Найден"}
+    lines = []
+    media = []
+    builder = InlineKeyboardBuilder()
+    for number, (_, user_id, request_type, request_city, category, breed, photo_hash, _) in enumerate(results, start=1):
+        caption = f"{number}. {type_names.get(request_type, request_type)}: {category}, {breed} ({request_city})"
+        lines.append(caption)
+        photo_file = photo(photo_hash) if len(media) < MEDIA_GROUP_LIMIT else None
+        if photo_file is not None:
+            media.append(InputMediaPhoto(media=photo_file, caption=caption))
+        builder.add(types.InlineKeyboardButton(text=f"✅ Контакты #{number}", callback_data=f"show_contacts_{user_id}"))
+    builder.adjust(1)
+
+    if len(media) == 1:
+        await message.answer_photo(media[0].media, caption=media[0].caption)
+    elif media:
+        await message.answer_media_group(media)
+    await message.answer("🔎 Результаты поиска:\n\n" + "\n".join(lines), reply_markup=builder.as_markup())
+
+
 @rt.message(F.text.in_(["Я ИЩУ ПИТОМЦА", "Я НАШЕЛ ПИТОМЦА"]))
 async def handle_request_type(message: Message, state: FSMContext):
     if message.text == "Я ИЩУ ПИТОМЦА":
@@ -86,7 +269,10 @@ async def handle_request_type(message: Message, state: FSMContext):
             parse_mode="HTML"
         )
 
-    await state.update_data(request_type=request_type)
+    # trace id заявки: им помечаются логи диалога, фоновой обработки и уведомлений
+    trace_id = new_trace_id()
+    trace_id_var.set(trace_id)
+    await state.update_data(request_type=request_type, trace_id=trace_id)
     await state.set_state(Form.photo)
 
 
@@ -94,11 +280,45 @@ async def handle_request_type(message: Message, state: FSMContext):
 @rt.message(Form.photo, F.photo)
 async def handle_photo(message: Message, state: FSMContext, bot: Bot):
     try:
-        photo = message.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        photo_data = await bot.download_file(file.file_path)
-
-        await state.update_data(photo_data=photo_data.read())
+        # Самый маленький размер, которого хватает модели, а не самый большой
+        photo = pick_photo_size(message.photo)
+        data = await state.get_data()
+
+        # В состоянии FSM остаются только идентификаторы фото (и путь к временному файлу),
+        # байты не держатся в памяти все шаги диалога
+        photo_data = None
+        photo_fields = dict(file_id=photo.file_id, file_unique_id=photo.file_unique_id,
+                            photo_hash=None, photo_spool=None)
+
+        # Та же картинка (пересланная, повторно отправленная) уже есть в кеше - не скачиваем её
+        cached = await db.run(photo_cache.get, photo.file_unique_id)
+        if cached is not None and photo_store.exists(cached[0]):
+            photo_hash, photo_dhash, _ = cached
+            photo_fields["photo_hash"] = photo_hash
+        else:
+            with stage_timer("download"):
+                file = await bot.get_file(photo.file_id)
+                photo_data = (await bot.download_file(file.file_path)).read()
+
+            # dHash считается вне event loop, миниатюра - при сохранении заявки
+            photo_dhash = await asyncio.get_running_loop().run_in_executor(None, dhash_bytes, photo_data)
+
+        # Повторная отправка того же фото - дубликат заявки
+        if photo_dhash is not None:
+            duplicate_id = await db.run(find_user_duplicate, message.from_user.id,
+                                        data['request_type'], photo_dhash)
+            if duplicate_id is not None:
+                await message.answer(texts.DUPLICATE_PHOTO, reply_markup=main_keyboard(), parse_mode="HTML")
+                await state.clear()
+                return
+
+        if photo_data is not None and PHOTO_SPOOL_ENABLED:
+            photo_spool.discard(data.get('photo_spool'))
+            photo_fields["photo_spool"] = await asyncio.get_running_loop().run_in_executor(
+                None, photo_spool.put, f"{message.from_user.id}-{photo.file_unique_id}", photo_data
+            )
+
+        await state.update_data(photo_dhash=photo_dhash, **photo_fields)
         await state.set_state(Form.category)
 
         await message.answer(
@@ -239,57 +459,145 @@ async def handle_city(message: Message, state: FSMContext):
     )
 
 
-# после отправки последнего сообщения мы делаем запись в базу данных
+def save_request(conn: sqlite3.Connection, chat_id: int, username: Optional[str],
+                 data: dict, embedding: Optional[np.ndarray], chip_matches: Optional[list] = None,
+                 photo: Optional[Tuple[bytes, bytes]] = None) -> int:
+    """
+    Сохраняет пользователя, заявку и её эмбеддинг в одной транзакции.
+    Совпадения по номеру чипа записываются и ставятся в очередь уведомлений в ней же.
+    FileNotFoundError - фото из кеша успели убрать в архив, нужны его байты (photo)
+    """
+    cursor = conn.cursor()
+    # Блокировка записи - до работы с файлом фото: архивация удаляет файлы под ней же
+    # и не уберёт фото, на которое ссылается эта заявка
+    if not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+
+    # Вставляем или игнорируем пользователя
+    cursor.execute("INSERT OR IGNORE INTO users (chat_id, username) VALUES (?, ?)",
+                   (chat_id, username))
+
+    # Получаем user_id
+    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
+    user_id = cursor.fetchone()[0]
+
+    # Одинаковые фото хранятся один раз, миниатюра - под хешем оригинала.
+    # Фото из кеша по file_unique_id уже лежит в хранилище (photo не передаётся)
+    photo_hash = data.get('photo_hash')
+    if photo is not None:
+        photo_data, thumb_data = photo
+        photo_hash = photo_store.put(photo_data)
+        if thumb_data:
+            thumbnail_store.put(thumb_data, key=photo_hash)
+    elif not photo_store.exists(photo_hash):
+        raise FileNotFoundError(f"Фото {photo_hash} уже нет в хранилище")
+
+    # Вставляем запрос в таблицу requests
+    cursor.execute('''
+        INSERT INTO requests (
+            user_id, request_type, photo_hash, category, breed,
+            gender, size, hair, city, chip_number, chip_number_raw, dhash, trace_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        user_id,
+        data['request_type'],
+        photo_hash,
+        data.get('category'),
+        data.get('breed'),
+        data.get('gender'),
+        data.get('size'),
+        data.get('hair'),
+        data.get('city'),
+        data.get('chip_number'),
+        data.get('chip_number_raw'),
+        to_db(data['photo_dhash']) if data.get('photo_dhash') is not None else None,
+        data.get('trace_id')
+    ))
+    request_id = cursor.lastrowid
+
+    if embedding is not None:
+        embedding_store.save(request_id, embedding, conn)
+    if data.get('file_unique_id'):
+        photo_cache.put(conn, data['file_unique_id'], photo_hash, data.get('photo_dhash'), embedding)
+    if chip_matches:
+        record_chip_matches(conn, request_id, user_id, chat_id, chip_matches)
+    return request_id
+
+
+# после отправки последнего сообщения мы делаем запись в базу данных;
+# matcher (фоновая обработка) передаётся из main через Dispatcher
 @rt.message(Form.chip_number, Command("skip"))
 @rt.message(Form.chip_number)
-async def handle_chip_number(message: Message, state: FSMContext):
-    chip_number = message.text if message.text != "/skip" else None
-    await state.update_data(chip_number=chip_number)
+async def handle_chip_number(message: Message, state: FSMContext, matcher: BackgroundProcessor, bot: Bot):
+    # Ответ сохраняется как есть; совпадения ищутся только по тексту, похожему на номер чипа
+    chip_number_raw = message.text if message.text != "/skip" else None
+    chip_number = normalize_chip_number(chip_number_raw)
+    await state.update_data(chip_number=chip_number, chip_number_raw=chip_number_raw)
 
     data = await state.get_data()
-    conn = create_connection()
 
     try:
-        cursor = conn.cursor()
-
         # Получаем юзернейм или None
         username = message.from_user.username if message.from_user.username else None
 
-        # Вставляем или игнорируем пользователя
-        cursor.execute("INSERT OR IGNORE INTO users (chat_id, username) VALUES (?, ?)",
-                       (message.from_user.id, username))
-
-        # Получаем user_id
-        cursor.execute("SELECT id FROM users WHERE chat_id = ?", (message.from_user.id,))
-        user_id = cursor.fetchone()[0]
-
-        # Вставляем запрос в таблицу requests
-        cursor.execute('''
-            INSERT INTO requests (
-                user_id, request_type, photo_data, category, breed,
-                gender, size, hair, city, chip_number
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            data['request_type'],
-            data['photo_data'],
-            data.get('category'),
-            data.get('breed'),
-            data.get('gender'),
-            data.get('size'),
-            data.get('hair'),
-            data.get('city'),
-            chip_number
-        ))
-
-        conn.commit()
+        # Байты фото нужны только сейчас: из временного файла или скачиваются заново
+        try:
+            photo = await load_dialog_photo(bot, data)
+        except Exception as e:
+            logger.error(f"Не удалось получить фото заявки: {str(e)}")
+            await message.answer("❌ Ошибка обработки фото. Попробуйте еще раз.", reply_markup=main_keyboard())
+            return
+
+        # Точное совпадение по чипу проверяется до любой работы с моделью:
+        # при совпадении уведомления уходят сразу, эмбеддинг досчитает фоновая обработка
+        chip_matches = []
+        if chip_number is not None:
+            chip_matches = await db.run(find_chip_matches, chip_number, data['request_type'], message.from_user.id)
+
+        # Эмбеддинг считается один раз при создании заявки (или берётся из кеша фото).
+        # Если не получилось - его досчитает фоновая обработка
+        # Модели достаточно миниатюры 224px
+        cached = photo_cache.peek(data['file_unique_id']) if data.get('file_unique_id') else None
+        embedding = cached[2] if cached is not None else None
+        image_data = None
+        if embedding is None and model_ready.is_set() and not chip_matches:
+            try:
+                image_data = request_image_data(data, photo)
+                embedding = await get_image_embedding_async(image_data)
+            except Exception as e:
+                logger.error(f"Не удалось посчитать эмбеддинг заявки: {str(e)}")
+
+        try:
+            request_id = await db.run(save_request, message.from_user.id, username, data, embedding,
+                                      chip_matches, photo)
+        except FileNotFoundError:
+            # Фото из кеша перенесено в архив между проверкой и сохранением - берём байты заново
+            data = {**data, 'photo_hash': None}
+            photo = await load_dialog_photo(bot, data)
+            request_id = await db.run(save_request, message.from_user.id, username, data, embedding,
+                                      chip_matches, photo)
+        if chip_matches:
+            # Уведомления уже в исходящей очереди - отправляются сразу, не дожидаясь опроса
+            matcher.sender.wake()
+            await message.answer(texts.CHIP_MATCH, reply_markup=main_keyboard(), parse_mode="HTML")
+            return
+
+        # Модель ещё загружается: заявка уже сохранена, эмбеддинг посчитается после прогрева.
+        # Иначе заявка сопоставляется сразу, не дожидаясь часового прохода
+        if embedding is None and not model_ready.is_set():
+            task = asyncio.create_task(embed_request_later(
+                request_id, image_data or request_image_data(data, photo), matcher, data.get('trace_id')))
+            pending_embeddings.add(task)
+            task.add_done_callback(pending_embeddings.discard)
+        else:
+            matcher.submit(request_id, data.get('trace_id'))
         await message.answer(texts.SUCCESS, reply_markup=main_keyboard())
 
     except sqlite3.Error as e:
         await message.answer(f"{texts.ERROR}{str(e)}", reply_markup=cancel_keyboard())
 
     finally:
-        conn.close()
+        photo_spool.discard(data.get('photo_spool'))
         await state.clear()
 
 # уведомления
@@ -303,18 +611,13 @@ async def handle_contacts_request(callback: CallbackQuery):
         logger.error(f"Некорректный формат callback: {callback.data}. Ошибка: {e}")
         return
 
-    conn = None
     try:
-        conn = sqlite3.connect("database.db")
-        cursor = conn.cursor()
-
         # Получаем данные целевого пользователя из базы
-        cursor.execute("""
+        target_user = await db.fetchone("""
             SELECT chat_id, username 
             FROM users 
             WHERE id = ?
         """, (target_user_id,))
-        target_user = cursor.fetchone()
 
         if not target_user:
             await callback.answer("❌ Пользователь не найден", show_alert=True)
@@ -338,9 +641,6 @@ async def handle_contacts_request(callback: CallbackQuery):
     except Exception as e:
         logger.error(f"Неизвестная ошибка: {str(e)}")
         await callback.answer("⚠️ Внутренняя ошибка", show_alert=True)
-    finally:
-        if conn:
-            conn.close()
 
 
 @rt.callback_query(F.data == "dismiss_notification")
@@ -1,118 +1,365 @@
 import logging
-import sqlite3
-from io import BytesIO
-from typing import List, Tuple
+import threading
+from typing import List, Optional, Tuple
+import numpy as np
 from PIL import Image
 
-from image_processing import get_image_embedding, batch_compare
+from ann_index import PartitionedIndex
+from config import (ANN_INDEX_ENABLED, DATABASE_NAME, EMBEDDING_DTYPE, EMBEDDING_RERANK, MATCH_TOP_K,
+                    PHASH_MAX_DISTANCE, RERANK_MARGIN, THUMBNAIL_STORE_DIR)
+from database import connect
+from embedding_store import EmbeddingStore
+from photo_store import PhotoStore
+from image_processing import (decode_image, get_image_embedding, inference_service, make_thumbnail,
+                              top_k_similarities)
+from metrics import stage_timer
+from perceptual_hash import PartitionedHashIndex, dhash, from_db, hash_similarity, to_db
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Перцептивные хеши активных заявок без совпадения по чипу, появившихся после watermark
+HASHES_SQL = """
+    SELECT id, request_type, city, category, dhash FROM requests
+    WHERE id > ? AND is_active = 1 AND chip_match_id IS NULL AND dhash IS NOT NULL
+    ORDER BY id
+"""
+
+# Заявки, выбывшие из сопоставления после отметки: деактивация, архив, совпадение по чипу
+# (журнал пишут триггеры requests)
+REMOVALS_SQL = "SELECT id, request_id FROM request_removals WHERE id > ? ORDER BY id"
+
 
 class ImageComparator:
-    def __init__(self, db_path: str = "database.db"):
+    def __init__(self, db_path: str = DATABASE_NAME):
         self.db_path = db_path
         self.similarity_threshold = 0.75  # Порог схожести изображений
+        self.top_k = MATCH_TOP_K  # Максимум кандидатов на одну заявку
+        self.store = EmbeddingStore(db_path)
+        self.photos = PhotoStore()
+        self.thumbnails = PhotoStore(THUMBNAIL_STORE_DIR)
+        self.use_index = ANN_INDEX_ENABLED
+        self.index = PartitionedIndex(dtype=EMBEDDING_DTYPE)
+        # Сжатые оценки индекса уточняются по float32 векторам из БД
+        self.rerank = EMBEDDING_RERANK and EMBEDDING_DTYPE != "float32"
+        self._indexed_upto = 0  # Максимальный id заявки, уже загруженной в индекс
+        self.hash_max_distance = PHASH_MAX_DISTANCE
+        self.hashes = PartitionedHashIndex()  # dHash -> мгновенные совпадения дубликатов
+        self._hashed_upto = 0
+        self._removed_upto = 0  # Последняя запись журнала request_removals, учтённая индексом
+        # Сопоставления поданных заявок, проход и архивация работают в разных потоках пула:
+        # синхронизация и подмена индексов идут под общей блокировкой
+        self._index_lock = threading.RLock()
 
     def _get_opposite_request_type(self, request_type: str) -> str:
         """Возвращает противоположный тип запроса"""
         return "found" if request_type == "lost" else "lost"
 
-    def _blob_to_image(self, blob_data: bytes) -> Image.Image:
+    def _photo_to_image(self, photo_hash: str) -> Image.Image:
+        """
+        Изображение для модели: миниатюра 224px, а если её нет -
+        она один раз строится из оригинала в файловом хранилище
+        """
         try:
-            return Image.open(BytesIO(blob_data)).convert('RGB')  # Принудительная конвертация в RGB
+            if not self.thumbnails.exists(photo_hash):
+                self.thumbnails.put(make_thumbnail(self.photos.read(photo_hash)), key=photo_hash)
+            return decode_image(self.thumbnails.path(photo_hash))
         except Exception as e:
-            logger.error(f"Ошибка конвертации BLOB: {str(e)}")
+            logger.error(f"Ошибка чтения фото {photo_hash}: {str(e)}")
             raise ValueError("Invalid image data") from e
 
-    def _get_comparable_requests(self, request_id: int, city: str, category: str) -> List[Tuple[int, bytes]]:
-        """Получает список сравнимых запросов из БД с учетом города и категории"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _embed_photo(self, request_id: int, photo_hash: str) -> Optional[np.ndarray]:
+        """
+        Считает эмбеддинг по фото заявки и сохраняет его в хранилище.
+        None - фото не декодируется; ошибки инференса пробрасываются (заявку повторят)
+        """
+        try:
+            image = self._photo_to_image(photo_hash)
+        except ValueError as e:
+            logger.warning(f"Пропущен запрос {request_id}: {str(e)}")
+            self.store.record_failure(request_id, photo_hash, str(e.__cause__ or e))
+            return None
+        embedding = get_image_embedding(image)
+        self.store.save(request_id, embedding)
+        return embedding
+
+    def _load_index(self, index: PartitionedIndex, after_id: int) -> int:
+        """Добавляет в индекс векторы заявок с id > after_id; возвращает новую отметку"""
+        rows = self.store.load_since(after_id)
+        for req_id, request_type, city, category, vector in rows:
+            index.add(req_id, (request_type, city, category), vector)
+        return rows[-1][0] if rows else after_id
 
+    def _load_hashes(self, hashes: PartitionedHashIndex, after_id: int) -> int:
+        """Добавляет перцептивные хеши заявок с id > after_id; возвращает новую отметку"""
+        conn = connect(self.db_path)
         try:
-            # Получаем тип исходного запроса
-            cursor.execute("SELECT request_type FROM requests WHERE id = ?", (request_id,))
-            request_type = cursor.fetchone()[0]
-            opposite_type = "found" if request_type == "lost" else "lost"
+            rows = conn.execute(HASHES_SQL, (after_id,)).fetchall()
+        finally:
+            conn.close()
+        for req_id, request_type, city, category, value in rows:
+            hashes.add(req_id, (request_type, city, category), from_db(value))
+        return rows[-1][0] if rows else after_id
 
-            # Получаем противоположные запросы с учетом фильтров
-            cursor.execute("""
-                SELECT id, photo_data FROM requests 
-                WHERE request_type = ?
-                AND city = ?
-                AND category = ?
-                AND id != ?
-                AND is_active = 1
-            """, (opposite_type, city, category, request_id))
-
-            return cursor.fetchall()
+    def _sync_index(self):
+        """Догружает в индекс заявки, появившиеся после последней синхронизации"""
+        with self._index_lock:
+            self._indexed_upto = self._load_index(self.index, self._indexed_upto)
+
+    def _sync_hashes(self):
+        """Догружает перцептивные хеши новых заявок"""
+        with self._index_lock:
+            self._hashed_upto = self._load_hashes(self.hashes, self._hashed_upto)
+
+    def _sync_removals(self):
+        """Убирает из индексов заявки, деактивированные или перенесённые в архив любым процессом"""
+        conn = connect(self.db_path)
+        try:
+            with self._index_lock:
+                rows = conn.execute(REMOVALS_SQL, (self._removed_upto,)).fetchall()
+                for _, req_id in rows:
+                    self.index.remove(req_id)
+                    self.hashes.remove(req_id)
+                if rows:
+                    self._removed_upto = rows[-1][0]
         finally:
             conn.close()
 
-    def compare_with_database(self, request_id: int) -> List[Tuple[int, float]]:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def sync(self):
+        """
+        Приводит индексы в памяти к БД по изменениям с прошлой синхронизации:
+        догружает новые заявки и убирает выбывшие. Стоимость зависит от числа изменений,
+        а не от размера базы
+        """
+        self._sync_removals()
+        self._sync_index()
+        self._sync_hashes()
+
+    def rebuild_index(self):
+        """
+        Полностью перестраивает индекс по БД. Новый индекс строится в стороне и подменяет
+        старый целиком - поиск во время перестройки не видит пустого или неполного индекса
+        """
+        conn = connect(self.db_path)
+        try:
+            # Выбывшие во время перестройки заявки убираются по журналу после подмены
+            removed_upto = conn.execute("SELECT COALESCE(MAX(id), 0) FROM request_removals").fetchone()[0]
+        finally:
+            conn.close()
+        index = PartitionedIndex(dtype=EMBEDDING_DTYPE)
+        indexed_upto = self._load_index(index, 0)
+        hashes = PartitionedHashIndex()
+        hashed_upto = self._load_hashes(hashes, 0)
+        with self._index_lock:
+            self.index, self.hashes = index, hashes
+            self._indexed_upto, self._hashed_upto = indexed_upto, hashed_upto
+            self._removed_upto = removed_upto
+            # Изменения за время перестройки применяются сразу
+            self.sync()
 
+    def deactivate_request(self, request_id: int):
+        """Деактивирует заявку и убирает её из индекса"""
+        conn = connect(self.db_path)
         try:
-            # Получаем данные исходного запроса
+            conn.execute("UPDATE requests SET is_active = 0 WHERE id = ?", (request_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        with self._index_lock:
+            self.index.remove(request_id)
+            self.hashes.remove(request_id)
+
+    def _get_source_embedding(self, request_id: int, partition: Tuple[str, str, str]) -> Optional[np.ndarray]:
+        """Эмбеддинг исходной заявки: из хранилища, либо считается один раз"""
+        embedding = self.store.load(request_id)
+        if embedding is not None:
+            return embedding
+
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT photo_hash FROM requests WHERE id = ?", (request_id,))
+            photo_hash = cursor.fetchone()[0]
+        finally:
+            conn.close()
+        embedding = self._embed_photo(request_id, photo_hash)
+        if embedding is not None:
+            with self._index_lock:
+                self.index.add(request_id, partition, embedding)
+        return embedding
+
+    def _get_source_hash(self, request_id: int) -> Optional[int]:
+        """dHash исходной заявки; считается и сохраняется, если его ещё нет"""
+        conn = connect(self.db_path)
+        try:
+            photo_hash, value = conn.execute(
+                "SELECT photo_hash, dhash FROM requests WHERE id = ?", (request_id,)
+            ).fetchone()
+            if value is not None:
+                return from_db(value)
+            try:
+                value = dhash(self._photo_to_image(photo_hash))
+            except ValueError:
+                return None
+            conn.execute("UPDATE requests SET dhash = ? WHERE id = ?", (to_db(value), request_id))
+            conn.commit()
+            return value
+        finally:
+            conn.close()
+
+    def _find_duplicates(self, request_id: int, request_type: str, city: str,
+                         category: str) -> List[Tuple[int, float]]:
+        """Совпадения по перцептивному хешу: репосты одного и того же фото находятся без CLIP"""
+        source_hash = self._get_source_hash(request_id)
+        if source_hash is None:
+            return []
+        self._sync_hashes()
+        opposite_type = self._get_opposite_request_type(request_type)
+        return [
+            (req_id, hash_similarity(distance))
+            for req_id, distance in self.hashes.search(
+                (opposite_type, city, category), source_hash, self.hash_max_distance, exclude={request_id}
+            )
+        ]
+
+    def _backfill_embeddings(self, request_type: str, city: str, category: str):
+        """Досчитывает эмбеддинги заявок, созданных до появления хранилища"""
+        # Сначала ставим в очередь все изображения, чтобы сервис инференса собрал их в батчи
+        pending = []
+        for req_id, photo_hash in self.store.load_missing(request_type, city, category):
+            try:
+                pending.append((req_id, inference_service.submit(self._photo_to_image(photo_hash))))
+            except ValueError as e:
+                # Битое фото не декодируется и на следующих проходах - запоминаем
+                logger.warning(f"Пропущен запрос {req_id}: {str(e)}")
+                self.store.record_failure(req_id, photo_hash, str(e.__cause__ or e))
+
+        backfilled = 0
+        for req_id, future in pending:
+            try:
+                embedding = future.result()
+                self.store.save(req_id, embedding)
+                with self._index_lock:
+                    self.index.add(req_id, (request_type, city, category), embedding)
+                backfilled += 1
+            except Exception as e:
+                logger.warning(f"Пропущен запрос {req_id}: {str(e)}")
+
+        # Старые заявки получили новые векторы - партицию нужно пересмотреть
+        if backfilled:
+            self.mark_partition_dirty(request_type, city, category)
+
+    def mark_partition_dirty(self, request_type: str, city: str, category: str):
+        """Помечает партицию изменившейся для следующего инкрементального прохода"""
+        conn = connect(self.db_path)
+        try:
+            conn.execute("""
+                INSERT OR IGNORE INTO dirty_partitions (request_type, city, category)
+                VALUES (?, ?, ?)
+            """, (request_type, city, category))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _get_comparable_requests(self, request_id: int, request_type: str,
+                                 city: str, category: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Получает эмбеддинги сравнимых запросов из БД с учетом города и категории"""
+        opposite_type = self._get_opposite_request_type(request_type)
+        self._backfill_embeddings(opposite_type, city, category)
+
+        # Получаем противоположные запросы с учетом фильтров
+        return self.store.load_candidate_matrix(opposite_type, city, category, request_id)
+
+    def _search_exact(self, request_id: int, request_type: str, city: str, category: str,
+                      source_embedding: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Точный перебор по эмбеддингам из БД"""
+        candidate_ids, candidate_matrix = self._get_comparable_requests(request_id, request_type, city, category)
+        if len(candidate_ids) == 0:
+            return candidate_ids, np.empty(0, dtype=np.float32)
+        with stage_timer("scoring"):
+            return top_k_similarities(source_embedding, candidate_ids, candidate_matrix, self.top_k)
+
+    def _search_index(self, request_type: str, city: str, category: str,
+                      source_embedding: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Приближённый поиск по индексу партиции (противоположный тип, город, категория)"""
+        opposite_type = self._get_opposite_request_type(request_type)
+        self._backfill_embeddings(opposite_type, city, category)
+        self._sync_index()
+        if not self.rerank:
+            with stage_timer("scoring"):
+                return self.index.search(
+                    (opposite_type, city, category), source_embedding,
+                    self.top_k, self.similarity_threshold
+                )
+
+        # Порог и top-k с запасом на ошибку квантования, затем точный пересчёт
+        with stage_timer("scoring"):
+            ids, _ = self.index.search(
+                (opposite_type, city, category), source_embedding,
+                2 * self.top_k, self.similarity_threshold - RERANK_MARGIN
+            )
+            exact_ids, matrix = self.store.load_many(ids.tolist())
+            return top_k_similarities(source_embedding, exact_ids, matrix, self.top_k)
+
+    def _get_request_partition(self, request_id: int) -> Optional[Tuple[str, str, str]]:
+        """Тип, город и категория заявки"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.cursor()
             cursor.execute("""
-                SELECT photo_data, city, category 
+                SELECT request_type, city, category 
                 FROM requests 
                 WHERE id = ?
             """, (request_id,))
-            result = cursor.fetchone()
+            return cursor.fetchone()
+        finally:
+            conn.close()
+
+    def compare_with_database(self, request_id: int) -> List[Tuple[int, float]]:
+        """
+        Совпадения заявки с противоположным пулом. Ошибки инференса и БД пробрасываются:
+        проход и воркеры очереди повторяют такую заявку, а не считают её обработанной
+        """
+        # Получаем данные исходного запроса
+        result = self._get_request_partition(request_id)
+
+        if not result:
+            # Заявку удалили или перенесли в архив - сравнивать нечего
+            logger.error(f"Request {request_id} not found")
+            return []
+
+        request_type, city, category = result
 
-            if not result:
-                logger.error(f"Request {request_id} not found")
-                return []
+        # Дубликаты по dHash находятся без CLIP - и для заявок с недекодируемым для модели фото
+        duplicates = self._find_duplicates(request_id, request_type, city, category)
 
-            source_blob, city, category = result
+        # Эмбеддинг берётся из хранилища, фото декодируется только при его отсутствии
+        source_embedding = self._get_source_embedding(request_id, (request_type, city, category))
+        if source_embedding is None:
+            if not duplicates:
+                logger.error(f"Invalid source image for request {request_id}")
+            return duplicates
 
-            # Конвертируем исходное изображение
+        ids, scores = None, None
+        if self.use_index:
             try:
-                source_image = self._blob_to_image(source_blob)  # <-- Исправлено здесь
-            except ValueError as e:
-                logger.error(f"Invalid source image: {str(e)}")
-                return []
-
-            # Получаем сравнимые запросы с фильтрами
-            comparable = self._get_comparable_requests(request_id, city, category)
-            if not comparable:
-                return []
-
-            # Подготавливаем данные в формате (request_id, Image)
-            image_pairs = []
-            for req_id, blob in comparable:
-                try:
-                    image = self._blob_to_image(blob)
-                    image_pairs.append((req_id, image))
-                except Exception as e:
-                    logger.warning(f"Пропущен запрос {req_id}: {str(e)}")
-                    continue
-
-            # Выполняем сравнение
-            results = batch_compare(source_image, image_pairs)  # <-- Теперь source_image определен
-
-            # Фильтрация по порогу
-            filtered = [
-                (req_id, score)
-                for req_id, score in results
-                if score >= self.similarity_threshold
-            ]
-
-            return filtered
+                ids, scores = self._search_index(request_type, city, category, source_embedding)
+            except Exception as e:
+                logger.warning(f"Индекс недоступен, используем точный перебор: {str(e)}")
+        if ids is None:
+            ids, scores = self._search_exact(request_id, request_type, city, category, source_embedding)
 
-        except Exception as e:
-            logger.error(f"Ошибка сравнения: {str(e)}")
-            return []
-        finally:
-            conn.close()
+        # Фильтрация по порогу; для дубликатов берётся большая из двух оценок
+        merged = dict(duplicates)
+        for req_id, score in zip(ids, scores):
+            if score >= self.similarity_threshold:
+                merged[int(req_id)] = max(float(score), merged.get(int(req_id), 0.0))
+
+        return sorted(merged.items(), key=lambda item: -item[1])
 
     def save_comparison_results(self, request_id: int, results: List[Tuple[int, float]]):
         """Сохраняет результаты сравнения в БД"""
-        conn = sqlite3.connect(self.db_path)
+        conn = connect(self.db_path)
         cursor = conn.cursor()
 
         try:
@@ -1,57 +1,200 @@
 import numpy as np
 from PIL import Image
 from io import BytesIO
-from sentence_transformers import SentenceTransformer
 from pathlib import Path
 import logging
-from typing import List, Tuple
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from clip_backend import MODEL_INPUT_SIZE, create_image_encoder
+from config import CLIP_MODEL_NAME
+from inference_service import InferenceService
+from metrics import ENCODED_IMAGES, INFERENCE_QUEUE_DEPTH, stage_timer
+from tracing import debug_sampled
+from worker_pool import worker_pool
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Загружаем нейросетевую модель CLIP при старте
+# Нейросетевая модель CLIP загружается лениво, при первом обращении или прогреве.
 # Эта модель будет преобразовывать изображения в числовые векторы
-try:
-    model = SentenceTransformer('clip-ViT-B-32')
-    logger.info("✅ CLIP загружен успешно")
-except Exception as e:
-    logger.error(f"❌ Ошибка при загрузке CLIP: {str(e)}")
-    raise
+_model = None
+_model_lock = threading.Lock()
+
+# Кодировщик изображений поверх модели: бэкенд выбирается настройками CLIP_BACKEND
+_encoder = None
+_encoder_lock = threading.Lock()
+
+# Сигнал готовности: модель загружена и прогрета
+model_ready = threading.Event()
+
+
+def get_model():
+    """Возвращает модель CLIP, загружая её при первом вызове"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                started = time.perf_counter()
+                try:
+                    # torch и sentence-transformers импортируются только здесь - это самая долгая часть
+                    from sentence_transformers import SentenceTransformer
+                    _model = SentenceTransformer(CLIP_MODEL_NAME)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка при загрузке CLIP: {str(e)}")
+                    raise
+                logger.info(f"✅ CLIP загружен успешно за {time.perf_counter() - started:.1f} с")
+    return _model
+
+
+def get_image_encoder():
+    """Кодировщик изображений текущего процесса, создаётся при первом вызове"""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                _encoder = create_image_encoder(get_model())
+    return _encoder
+
+
+def encode_images(images: List[Image.Image]) -> np.ndarray:
+    """Кодирует батч изображений моделью текущего процесса"""
+    return get_image_encoder().encode(images)
+
+
+def _encode_batch(images: List[Image.Image]) -> np.ndarray:
+    # Если настроен пул процессов, инференс уходит туда и не конкурирует с event loop за GIL
+    executor = worker_pool.inference_executor
+    with stage_timer("encode"):
+        if executor is None:
+            embeddings = encode_images(images)
+        else:
+            embeddings = executor.submit(encode_images, images).result()
+    ENCODED_IMAGES.inc(len(images))
+    return embeddings
+
+
+# Общий сервис инференса: одиночные вызовы объединяются в батчи
+inference_service = InferenceService(_encode_batch)
+INFERENCE_QUEUE_DEPTH.set_function(lambda: inference_service.metrics()["queue_depth"])
+
+
+def warm_up() -> float:
+    """
+    Загружает модель там, где выполняется инференс (в этом процессе или в пуле),
+    прогоняя пустое изображение. Возвращает длительность в секундах
+    """
+    started = time.perf_counter()
+    inference_service.encode(Image.new("RGB", (224, 224)))
+    model_ready.set()
+    return time.perf_counter() - started
+
+
+def start_warm_up(on_ready: Optional[Callable[[float], None]] = None) -> threading.Thread:
+    """Прогревает модель в фоне, не задерживая запуск бота"""
+    def run():
+        try:
+            elapsed = warm_up()
+        except Exception as e:
+            logger.error(f"❌ Прогрев CLIP не удался: {str(e)}")
+            return
+        if on_ready:
+            on_ready(elapsed)
+
+    thread = threading.Thread(target=run, name="clip-warm-up", daemon=True)
+    thread.start()
+    return thread
 
 
 # =============================================
 # ФУНКЦИЯ ДЛЯ ЗАГРУЗКИ И ОБРАБОТКИ ИЗОБРАЖЕНИЙ
 # =============================================
+def pick_photo_size(sizes: list, min_side: int = MODEL_INPUT_SIZE):
+    """
+    Самый маленький PhotoSize из Telegram, который ещё покрывает вход модели.
+    Если все меньше - самый большой
+    """
+    covering = [size for size in sizes if min(size.width, size.height) >= min_side]
+    if covering:
+        return min(covering, key=lambda size: size.width * size.height)
+    return max(sizes, key=lambda size: size.width * size.height)
+
+
+def decode_image(source, size: int = MODEL_INPUT_SIZE) -> Image.Image:
+    """
+    Декодирует фото сразу в уменьшенном виде: для JPEG draft-режим
+    масштабирует в 2-8 раз при декодировании, не опускаясь ниже size по короткой стороне
+    """
+    with stage_timer("decode"):
+        image = Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+        image.draft("RGB", (size, size))
+        if image.mode != 'RGB':
+            return image.convert('RGB')
+        image.load()  # Декодируем сразу, чтобы не держать файл открытым
+        return image
+
+
+def make_thumbnail(data: bytes, size: int = MODEL_INPUT_SIZE, quality: int = 90) -> bytes:
+    """Нормализованная миниатюра: RGB JPEG, короткая сторона size"""
+    image = decode_image(data, size)
+    scale = size / min(image.size)
+    if scale < 1:
+        image = image.resize((max(size, round(image.width * scale)), max(size, round(image.height * scale))),
+                             Image.BICUBIC)
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def load_image(image_input) -> Image.Image:
+    # Если входные данные - bytes (BLOB из БД)
+    if isinstance(image_input, bytes):
+        debug_sampled(logger, "🔍 Loading image from BLOB data")
+        image = decode_image(image_input)
+
+    # Если путь к файлу или URL
+    elif isinstance(image_input, (str, Path)):
+        image_path = Path(image_input)
+        debug_sampled(logger, f"📂 Loading image: {image_path}")
+        if not image_path.exists():
+            raise FileNotFoundError(f"Image file not found: {image_path}")
+        image = decode_image(image_path)
+
+    # Если уже объект Image
+    elif isinstance(image_input, Image.Image):
+        image = image_input
+
+    else:
+        raise ValueError("❌ Unsupported image input type")
+
+    # Конвертация в RGB
+    if image.mode != 'RGB':
+        debug_sampled(logger, "Converting image to RGB format")
+        image = image.convert('RGB')
+
+    return image
+
+
 def get_image_embedding(image_input) -> np.ndarray:
     try:
-        # Если входные данные - bytes (BLOB из БД)
-        if isinstance(image_input, bytes):
-            logger.info("🔍 Loading image from BLOB data")
-            image = Image.open(BytesIO(image_input))
-
-        # Если путь к файлу или URL
-        elif isinstance(image_input, (str, Path)):
-            image_path = Path(image_input)
-            logger.info(f"📂 Loading image: {image_path}")
-            if not image_path.exists():
-                raise FileNotFoundError(f"Image file not found: {image_path}")
-            image = Image.open(image_path)
-
-        # Если уже объект Image
-        elif isinstance(image_input, Image.Image):
-            image = image_input
+        image = load_image(image_input)
 
-        else:
-            raise ValueError("❌ Unsupported image input type")
+        # Преобразование в вектор через общий сервис инференса
+        debug_sampled(logger, "🖼️ Processing image with CLIP model...")
+        return inference_service.encode(image)
 
-        # Конвертация в RGB
-        if image.mode != 'RGB':
-            logger.debug("Converting image to RGB format")
-            image = image.convert('RGB')
+    except Exception as e:
+        logger.error(f"🔥 Error processing image: {str(e)}")
+        raise
 
-        # Преобразование в вектор
-        logger.info("🖼️ Processing image with CLIP model...")
-        return model.encode(image)
+
+async def get_image_embedding_async(image_input) -> np.ndarray:
+    """То же, что get_image_embedding, но ожидание инференса не блокирует event loop"""
+    try:
+        image = load_image(image_input)
+        debug_sampled(logger, "🖼️ Processing image with CLIP model...")
+        return await inference_service.encode_async(image)
 
     except Exception as e:
         logger.error(f"🔥 Error processing image: {str(e)}")
@@ -62,37 +205,57 @@ def get_image_embedding(image_input) -> np.ndarray:
 # =============================================
 # ФУНКЦИЯ СРАВНЕНИЯ ИЗОБРАЖЕНИЙ
 # =============================================
-def batch_compare(
-        source_image: Image.Image,
-        image_pairs: List[Tuple[int, Image.Image]]) -> List[Tuple[int, float]]:
+def top_k_similarities(
+        source_embedding: np.ndarray,
+        candidate_ids: np.ndarray,
+        candidate_matrix: np.ndarray,
+        top_k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Сравнивает исходное изображение со списком (request_id, image)
-    Возвращает список кортежей (request_id, similarity_score)
+    Векторное сравнение одного эмбеддинга с матрицей кандидатов (N, 512).
+    Одно матричное умножение + argpartition вместо цикла по кандидатам.
+    Возвращает (request_ids, scores), отсортированные по убыванию схожести
     """
-    results = []
+    candidate_ids = np.asarray(candidate_ids)
+    if len(candidate_ids) == 0:
+        return candidate_ids, np.empty(0, dtype=np.float32)
 
-    try:
-        # Эмбеддинг исходного изображения
-        source_embedding = get_image_embedding(source_image)
-        source_embedding = source_embedding / np.linalg.norm(source_embedding)
+    source = np.asarray(source_embedding, dtype=np.float32).ravel()
+    source = source / np.linalg.norm(source)
 
-        # Пакетная обработка
-        for req_id, image in image_pairs:
-            try:
-                current_embedding = get_image_embedding(image)
-                current_embedding = current_embedding / np.linalg.norm(current_embedding)
+    matrix = np.ascontiguousarray(candidate_matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0  # Нулевой вектор даёт схожесть 0, а не NaN
 
-                similarity = float(np.dot(source_embedding, current_embedding))
-                similarity = max(0.0, min(similarity, 1.0))
+    scores = (matrix @ source) / norms
+    np.clip(scores, 0.0, 1.0, out=scores)
 
-                results.append((req_id, similarity))
+    # Частичная сортировка: полностью упорядочиваем только top_k лучших
+    if top_k is not None and 0 < top_k < len(scores):
+        order = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        order = np.arange(len(scores))
+    order = order[np.argsort(-scores[order], kind="stable")]
 
-            except Exception as e:
-                logger.warning(f"⏩ Skipping request {req_id}: {str(e)}")
-                continue
+    return candidate_ids[order], scores[order]
 
-        return sorted(results, key=lambda x: x[1], reverse=True)
+
+def batch_compare(
+        source_embedding: np.ndarray,
+        candidates: List[Tuple[int, np.ndarray]],
+        top_k: Optional[int] = None) -> List[Tuple[int, float]]:
+    """
+    Сравнивает эмбеддинг исходного изображения со списком (request_id, embedding)
+    Возвращает список кортежей (request_id, similarity_score)
+    """
+    if not candidates:
+        return []
+
+    try:
+        ids = np.array([req_id for req_id, _ in candidates])
+        matrix = np.stack([np.asarray(embedding, dtype=np.float32).ravel() for _, embedding in candidates])
+        ids, scores = top_k_similarities(source_embedding, ids, matrix, top_k)
+        return [(int(req_id), float(score)) for req_id, score in zip(ids, scores)]
 
     except Exception as e:
         logger.error(f"🔥 Batch comparison failed: {str(e)}")
-        return []
\ No newline at end of file
+        return []
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from config import INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS, INFERENCE_QUEUE_SIZE
+from metrics import INFERENCE_QUEUE_FULL
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class _EncodeRequest:
+    __slots__ = ("item", "future", "enqueued_at")
+
+    def __init__(self, item: Any):
+        self.item = item
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class InferenceService:
+    """
+    Общий сервис инференса с микробатчингом.
+    Запросы на кодирование от хендлеров и фоновых задач складываются в очередь,
+    объединяются в батчи (по размеру и времени ожидания) и кодируются одним вызовом encode
+    """
+
+    def __init__(self, encode_batch: Callable[[List[Any]], np.ndarray],
+                 max_batch_size: int = INFERENCE_MAX_BATCH_SIZE,
+                 max_wait_ms: float = INFERENCE_MAX_WAIT_MS,
+                 queue_size: int = INFERENCE_QUEUE_SIZE):
+        self.encode_batch = encode_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[Optional[_EncodeRequest]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # Метрики
+        self._requests = 0
+        self._batches = 0
+        self._errors = 0
+        self._queue_full = 0
+        self._max_batch_seen = 0
+        self._encode_seconds = 0.0
+        self._queue_latency_total = 0.0
+        self._queue_latency_max = 0.0
+
+    def start(self):
+        """Запускает поток, собирающий батчи"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+            self._thread.start()
+        logger.info(f"Сервис инференса запущен (batch={self.max_batch_size}, wait={self.max_wait * 1000:.0f}ms)")
+
+    def stop(self, timeout: Optional[float] = None):
+        """Останавливает поток после обработки уже поставленных запросов"""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, item: Any) -> Future:
+        """
+        Ставит изображение в очередь и возвращает future с эмбеддингом.
+        При полной очереди ждёт места - только для потоков, из event loop есть encode_async
+        """
+        self.start()
+        request = _EncodeRequest(item)
+        self._queue.put(request)
+        return request.future
+
+    def encode(self, item: Any, timeout: Optional[float] = None) -> np.ndarray:
+        """Блокирующее кодирование для синхронного кода"""
+        return self.submit(item).result(timeout)
+
+    async def encode_async(self, item: Any) -> np.ndarray:
+        """Кодирование без блокировки event loop"""
+        self.start()
+        request = _EncodeRequest(item)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            # Очередь забита (например, проходом фоновой обработки): место ждём в потоке,
+            # иначе хендлеры встали бы до разбора очереди
+            with self._lock:
+                self._queue_full += 1
+            INFERENCE_QUEUE_FULL.inc()
+            await asyncio.get_running_loop().run_in_executor(None, self._queue.put, request)
+        return await asyncio.wrap_future(request.future)
+
+    def _collect_batch(self, first: _EncodeRequest) -> List[Optional[_EncodeRequest]]:
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            if request is None:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = self._collect_batch(first)
+            stopping = batch[-1] is None
+            requests = [request for request in batch if request is not None]
+            self._process(requests)
+            if stopping:
+                return
+
+    def _process(self, requests: List[_EncodeRequest]):
+        started = time.perf_counter()
+        latencies = [started - request.enqueued_at for request in requests]
+
+        try:
+            embeddings = self.encode_batch([request.item for request in requests])
+            for request, embedding in zip(requests, embeddings):
+                request.future.set_result(embedding)
+        except Exception as e:
+            logger.error(f"🔥 Ошибка пакетного инференса: {str(e)}")
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            with self._lock:
+                self._errors += 1
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._requests += len(requests)
+            self._batches += 1
+            self._max_batch_seen = max(self._max_batch_seen, len(requests))
+            self._encode_seconds += elapsed
+            self._queue_latency_total += sum(latencies)
+            self._queue_latency_max = max(self._queue_latency_max, max(latencies))
+
+    def metrics(self) -> Dict[str, float]:
+        """Пропускная способность, размер батчей и задержка в очереди"""
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "batches": self._batches,
+                "errors": self._errors,
+                "queue_full": self._queue_full,
+                "queue_depth": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "avg_batch_size": self._requests / self._batches if self._batches else 0.0,
+                "max_batch_seen": self._max_batch_seen,
+                "images_per_second": self._requests / self._encode_seconds if self._encode_seconds else 0.0,
+                "avg_queue_latency_ms": self._queue_latency_total / self._requests * 1000 if self._requests else 0.0,
+                "max_queue_latency_ms": self._queue_latency_max * 1000,
+            }
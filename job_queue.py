@@ -0,0 +1,165 @@
+import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import DATABASE_NAME, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS
+from database import connect
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Приоритеты: заявка, поданная только что, обгоняет задачи часового прохода
+PRIORITY_SWEEP = 0
+PRIORITY_SUBMITTED = 10
+
+# Задача: (job_id, kind, request_id, attempts, trace_id)
+Job = Tuple[int, str, int, int, Optional[str]]
+
+# Захват готовых задач одним выражением: отбор по частичному индексу idx_jobs_ready
+# и перевод в running с арендой - два воркера не получат одну задачу
+CLAIM_SQL = """
+    UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM jobs
+        WHERE status = 'pending' AND available_at <= ?
+        ORDER BY priority DESC, available_at, id
+        LIMIT ?
+    )
+    RETURNING id, kind, request_id, attempts, trace_id
+"""
+
+# Задачи, чья аренда истекла (воркер умер или завис) - по частичному индексу idx_jobs_lease
+EXPIRED_SQL = """
+    UPDATE jobs SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL
+    WHERE status = 'running' AND lease_expires_at < ?
+"""
+
+
+class JobQueue:
+    """
+    Постоянная очередь задач сопоставления в SQLite (таблица jobs).
+    Бот ставит задачи, воркеры (worker.py, любое число процессов) забирают их в аренду
+    на lease_seconds и продлевают её, пока работают. Задачи с истёкшей арендой
+    возвращаются в очередь, после max_attempts неудачных попыток задача помечается failed
+    """
+
+    def __init__(self, db_path: str = DATABASE_NAME, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def enqueue(self, conn: sqlite3.Connection, requests: List[Tuple[int, Optional[str]]],
+                kind: str = "match", priority: int = PRIORITY_SWEEP):
+        """
+        Ставит задачи по заявкам (request_id, trace_id) в транзакцию переданного соединения.
+        Если задача по заявке уже ждёт или выполняется, повтор не добавляется - только
+        повышается приоритет
+        """
+        now = time.time()
+        conn.executemany("""
+            INSERT INTO jobs (kind, request_id, priority, available_at, trace_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (kind, request_id) WHERE status IN ('pending', 'running')
+            DO UPDATE SET priority = MAX(jobs.priority, excluded.priority)
+        """, [(kind, request_id, priority, now, trace_id) for request_id, trace_id in requests])
+
+    def claim(self, worker_id: str, limit: int = 1) -> List[Job]:
+        """Забирает до limit готовых задач в аренду воркера"""
+        now = time.time()
+        conn = connect(self.db_path)
+        try:
+            jobs = conn.execute(CLAIM_SQL, (worker_id, now + self.lease_seconds, now, limit)).fetchall()
+            conn.commit()
+            return sorted(jobs)
+        finally:
+            conn.close()
+
+    def heartbeat(self, worker_id: str, job_ids: List[int]) -> int:
+        """Продлевает аренду задач воркера; возвращает число задач, которые всё ещё за ним"""
+        if not job_ids:
+            return 0
+        conn = connect(self.db_path)
+        try:
+            placeholders = ", ".join("?" * len(job_ids))
+            cursor = conn.execute(f"""
+                UPDATE jobs SET lease_expires_at = ?
+                WHERE id IN ({placeholders}) AND status = 'running' AND lease_owner = ?
+            """, [time.time() + self.lease_seconds, *job_ids, worker_id])
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def complete(self, worker_id: str, job_id: int) -> bool:
+        """Отмечает задачу выполненной (если аренду не успели отобрать)"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.execute("""
+                UPDATE jobs SET status = 'done', finished_at = ?, lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = ? AND status = 'running' AND lease_owner = ?
+            """, (time.time(), job_id, worker_id))
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def fail(self, worker_id: str, job_id: int, error: str) -> bool:
+        """
+        Неудачная попытка: повтор с экспоненциальной задержкой или failed после max_attempts.
+        False - аренду уже отобрали, состояние задачи принадлежит новому владельцу
+        """
+        conn = connect(self.db_path)
+        try:
+            row = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND lease_owner = ?",
+                               (job_id, worker_id)).fetchone()
+            if row is None:
+                return False
+            give_up = row[0] >= self.max_attempts
+            cursor = conn.execute("""
+                UPDATE jobs SET status = ?, available_at = ?, last_error = ?,
+                    lease_owner = NULL, lease_expires_at = NULL,
+                    finished_at = CASE WHEN ? THEN ? END
+                WHERE id = ? AND status = 'running' AND lease_owner = ?
+            """, ("failed" if give_up else "pending", time.time() + min(300.0, 2.0 ** row[0]),
+                  error[:500], give_up, time.time(), job_id, worker_id))
+            conn.commit()
+            if cursor.rowcount == 0:
+                return False
+            if give_up:
+                logger.error(f"Задача {job_id} не выполнена после {row[0]} попыток: {error}")
+            return True
+        finally:
+            conn.close()
+
+    def reclaim_expired(self) -> int:
+        """Возвращает в очередь задачи с истёкшей арендой"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.execute(EXPIRED_SQL, (time.time(),))
+            conn.commit()
+            if cursor.rowcount:
+                logger.warning(f"Возвращено в очередь задач с истёкшей арендой: {cursor.rowcount}")
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def purge_done(self, older_than_seconds: float = 86400) -> int:
+        """Удаляет выполненные задачи старше older_than_seconds"""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?",
+                                  (time.time() - older_than_seconds,))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def counts(self) -> Dict[str, int]:
+        """Число задач по статусам"""
+        conn = connect(self.db_path)
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        finally:
+            conn.close()
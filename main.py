@@ -1,27 +1,82 @@
-import asyncio
-from aiogram import Bot, Dispatcher
-
-from config import BOT_TOKEN
-from handlers import rt
-from background_tasks import setup_background_tasks
-dp = Dispatcher()
-bot = Bot(token=BOT_TOKEN)
-
-
-async def main():
-    dp.include_router(rt)
-    # Инициализация фоновых задач
-    bg_processor = await setup_background_tasks(bot)
-
-    try:
-        await dp.start_polling(bot)
-    finally:
-        await bg_processor.stop()
-
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("бот остановлен")
-
+import time
+
+_import_started = time.perf_counter()
+
+import asyncio
+import logging
+from aiogram import Bot, Dispatcher
+
+from config import BOT_TOKEN, DIALOG_TTL_MINUTES
+from database import initialize_database
+from dialog_storage import ExpiringMemoryStorage
+from handlers import photo_spool, rt
+from background_tasks import setup_background_tasks
+from image_processing import inference_service, start_warm_up
+from metrics import DIALOGS_ACTIVE, start_metrics_server
+from text_search import TextSearch
+from tracing import setup_logging
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+logger = logging.getLogger(__name__)
+# Состояние диалогов в памяти: брошенные диалоги забываются через DIALOG_TTL_MINUTES,
+# их временные файлы фото удаляются
+storage = ExpiringMemoryStorage(
+    DIALOG_TTL_MINUTES * 60, on_expire=lambda data: photo_spool.discard(data.get("photo_spool"))
+)
+DIALOGS_ACTIVE.set_function(lambda: len(storage.storage))
+dp = Dispatcher(storage=storage)
+bot = Bot(token=BOT_TOKEN)
+
+# Отчёт о запуске: импорт, инициализация БД и загрузка модели измеряются отдельно
+startup_report = {"import": IMPORT_SECONDS}
+
+
+def _on_model_ready(elapsed: float):
+    startup_report["model_load"] = elapsed
+    logger.info(
+        "Отчёт о запуске: "
+        + ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in startup_report.items())
+    )
+
+
+async def main():
+    setup_logging()
+    started = time.perf_counter()
+    initialize_database()
+    startup_report["db_init"] = time.perf_counter() - started
+
+    # Модель загружается в фоне - бот отвечает на /start, не дожидаясь torch
+    start_warm_up(_on_model_ready)
+
+    # Временные файлы фото от прошлого запуска: их диалоги остались в памяти процесса
+    photo_spool.purge(0)
+    storage.start()
+
+    dp.include_router(rt)
+    # Инициализация фоновых задач
+    bg_processor = await setup_background_tasks(bot)
+    # Новые заявки сопоставляются сразу после подачи (handle_chip_number)
+    dp["matcher"] = bg_processor
+    # Поиск по описанию (/search) использует индекс векторов фоновой обработки
+    text_search = TextSearch(bg_processor.comparator)
+    dp["text_search"] = text_search
+    text_search.start_warm_up()
+    # Эндпоинт /metrics для Prometheus (METRICS_PORT=0 - выключен)
+    metrics_runner = await start_metrics_server()
+
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await bg_processor.stop()
+        await storage.close()
+        inference_service.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("бот остановлен")
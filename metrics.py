@@ -0,0 +1,262 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config import METRICS_HOST, METRICS_PORT
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+# Границы гистограмм длительностей, секунды: от 0.5 мс до 30 с
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name}: ожидаются метки {self.label_names}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                    for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Значение по меткам; либо функция, вызываемая при каждом сборе метрик"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def replace(self, values: Dict[LabelValues, float]):
+        """Атомарно заменяет все значения (метки, пропавшие из values, исчезают)"""
+        with self._lock:
+            self._values = {tuple(map(str, key)): float(value) for key, value in values.items()}
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            try:
+                return [f"{self.name} {_format_value(self._function())}"]
+            except Exception as e:
+                logger.debug(f"Не удалось вычислить {self.name}: {str(e)}")
+                return []
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                    for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # На каждый набор меток: счётчики по корзинам (последняя - +Inf), сумма
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            state[0][index] += 1
+            state[1][0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+# Этапы: download, decode, encode, text_encode, sql, scoring, send
+STAGE_SECONDS = registry.histogram(
+    "petfinder_stage_duration_seconds", "Длительность этапа обработки", ("stage",))
+STAGE_ERRORS = registry.counter(
+    "petfinder_stage_errors_total", "Ошибки по этапам", ("stage",))
+ENCODED_IMAGES = registry.counter(
+    "petfinder_encoded_images_total", "Изображений закодировано CLIP")
+INFERENCE_QUEUE_DEPTH = registry.gauge(
+    "petfinder_inference_queue_depth", "Изображений в очереди сервиса инференса")
+INFERENCE_QUEUE_FULL = registry.counter(
+    "petfinder_inference_queue_full_total", "Запросов из event loop, заставших очередь инференса полной")
+WORKER_PENDING = registry.gauge(
+    "petfinder_worker_pending", "Задач в пуле воркеров")
+OUTBOX_PENDING = registry.gauge(
+    "petfinder_outbox_pending", "Неотправленных уведомлений, готовых к отправке")
+PARTITION_ACTIVE_REQUESTS = registry.gauge(
+    "petfinder_partition_active_requests", "Активных заявок с эмбеддингом в партиции",
+    ("request_type", "city", "category"))
+SWEEP_DURATION = registry.gauge(
+    "petfinder_sweep_duration_seconds", "Длительность последнего прохода фоновой обработки")
+SWEEP_REQUESTS = registry.counter(
+    "petfinder_sweep_requests_total", "Заявок обработано фоновыми проходами", ("kind",))
+JOBS_PROCESSED = registry.counter(
+    "petfinder_jobs_processed_total", "Задач очереди обработано воркерами", ("kind", "result"))
+SUBMISSION_TO_NOTIFICATION = registry.histogram(
+    "petfinder_submission_to_notification_seconds",
+    "От подачи заявки (более новой в паре) до отправки уведомления о совпадении",
+    buckets=(1, 2, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600, 86400))
+ARCHIVED_REQUESTS = registry.counter(
+    "petfinder_archived_requests_total", "Заявок перенесено в холодный архив", ("reason",))
+DIALOGS_ACTIVE = registry.gauge(
+    "petfinder_dialogs_active", "Записей состояния FSM в памяти (диалоги подачи заявки)")
+DIALOGS_EXPIRED = registry.counter(
+    "petfinder_dialogs_expired_total", "Брошенных диалогов забыто по DIALOG_TTL_MINUTES")
+JOBS_BY_STATUS = registry.gauge(
+    "petfinder_jobs", "Задач в очереди по статусам на конец прохода", ("status",))
+PHOTO_CACHE_LOOKUPS = registry.counter(
+    "petfinder_photo_cache_lookups_total", "Обращения к кешу фото по file_unique_id (hit_memory, hit_db, miss)",
+    ("result",))
+TEXT_CACHE_LOOKUPS = registry.counter(
+    "petfinder_text_cache_lookups_total", "Обращения к кешу текстовых эмбеддингов", ("result",))
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """Замеряет этап; исключение учитывается в счётчике ошибок этапа и пробрасывается дальше"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """
+    Локальный HTTP эндпоинт /metrics для Prometheus.
+    Возвращает AppRunner (для остановки) или None, если порт не задан
+    """
+    if port <= 0:
+        return None
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
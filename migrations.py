@@ -0,0 +1,498 @@
+import logging
+import re
+import sqlite3
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from photo_store import PhotoStore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Фото хранятся в PhotoStore, в строке заявки остаётся только хеш
+REQUESTS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        request_type TEXT CHECK(request_type IN ('found', 'lost')),
+        photo_hash TEXT NOT NULL,
+        breed TEXT,
+        category TEXT,
+        gender TEXT CHECK(gender IN ('самец', 'самка', 'неизвестно')),
+        size TEXT CHECK(size IN ('маленький', 'средний', 'большой')),
+        hair TEXT CHECK(hair IN ('короткая', 'длинная', 'нет')),
+        city TEXT NOT NULL,
+        chip_number TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_active INTEGER DEFAULT 1 CHECK(is_active IN (0, 1)), 
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+'''
+
+REQUESTS_COLUMNS = (
+    "id, user_id, request_type, photo_hash, breed, category, gender, "
+    "size, hair, city, chip_number, created_at, is_active"
+)
+
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def migrate_photos_to_store(conn: sqlite3.Connection, photo_store: Optional[PhotoStore] = None,
+                            chunk_size: int = 256):
+    """
+    Переносит BLOB-ы requests.photo_data в PhotoStore и перестраивает таблицу без них.
+    Перенос идёт порциями с коммитом после каждой - миграцию можно прервать и продолжить
+    """
+    columns = _table_columns(conn, "requests")
+    if "photo_data" not in columns:
+        return
+    photo_store = photo_store or PhotoStore()
+
+    if "photo_hash" not in columns:
+        conn.execute("ALTER TABLE requests ADD COLUMN photo_hash TEXT")
+        conn.commit()
+
+    moved = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, photo_data FROM requests
+            WHERE photo_hash IS NULL
+            LIMIT ?
+        """, (chunk_size,)).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            "UPDATE requests SET photo_hash = ? WHERE id = ?",
+            [(photo_store.put(bytes(blob)), req_id) for req_id, blob in rows]
+        )
+        conn.commit()
+        moved += len(rows)
+
+    # Пересоздаём таблицу без photo_data: сканы requests больше не тянут мегабайты фото
+    conn.execute(REQUESTS_TABLE_SQL.format(table="requests_new"))
+    conn.execute(f"INSERT INTO requests_new ({REQUESTS_COLUMNS}) SELECT {REQUESTS_COLUMNS} FROM requests")
+    conn.execute("DROP TABLE requests")
+    conn.execute("ALTER TABLE requests_new RENAME TO requests")
+    conn.commit()
+    print(f"[{datetime.now()}] Фото перенесены в хранилище: {moved}")
+
+
+def _create_base_schema(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute(REQUESTS_TABLE_SQL.format(table="requests"))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_request INTEGER,
+            matched_request INTEGER,
+            similarity REAL,
+            notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(source_request, matched_request),  -- Добавляем уникальность
+            FOREIGN KEY(source_request) REFERENCES requests(id),
+            FOREIGN KEY(matched_request) REFERENCES requests(id)
+        )
+    ''')
+    # Эмбеддинги CLIP считаются один раз при создании заявки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            request_id INTEGER PRIMARY KEY,
+            model_name TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(request_id) REFERENCES requests(id)
+        )
+    ''')
+    # Состояние инкрементального сопоставления: watermark обработанных заявок
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS matcher_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    # Партиции, в которых изменились эмбеддинги уже обработанных заявок
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dirty_partitions (
+            request_type TEXT NOT NULL,
+            city TEXT NOT NULL,
+            category TEXT NOT NULL,
+            marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY(request_type, city, category)
+        )
+    ''')
+
+
+def _create_hot_indexes(conn: sqlite3.Connection):
+    """Покрывающие индексы для поиска кандидатов и прохода фоновой обработки"""
+    # Поиск кандидатов: (тип, город, категория, активность) + rowid - без обращения к таблице
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_partition
+        ON requests(request_type, city, category, is_active)
+    """)
+    # Проход по активным заявкам за последние 30 дней
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_active_created
+        ON requests(is_active, created_at)
+    """)
+    # users.chat_id уже проиндексирован ограничением UNIQUE (sqlite_autoindex_users_1)
+
+
+def _add_notification_user_pairs(conn: sqlite3.Connection):
+    """Дедупликация уведомлений по паре пользователей (user_low < user_high) через индекс"""
+    columns = _table_columns(conn, "notifications")
+    if "user_low" not in columns:
+        conn.execute("ALTER TABLE notifications ADD COLUMN user_low INTEGER")
+        conn.execute("ALTER TABLE notifications ADD COLUMN user_high INTEGER")
+
+    conn.execute("""
+        UPDATE notifications SET
+            user_low = (
+                SELECT MIN(s.user_id, m.user_id) FROM requests s, requests m
+                WHERE s.id = notifications.source_request AND m.id = notifications.matched_request
+            ),
+            user_high = (
+                SELECT MAX(s.user_id, m.user_id) FROM requests s, requests m
+                WHERE s.id = notifications.source_request AND m.id = notifications.matched_request
+            )
+        WHERE user_low IS NULL
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notifications_user_pair
+        ON notifications(user_low, user_high)
+    """)
+
+
+def _create_outbox(conn: sqlite3.Connection):
+    """Постоянная исходящая очередь уведомлений"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            peer_user_id INTEGER NOT NULL,
+            similarity REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            sent_at TIMESTAMP,
+            failed INTEGER NOT NULL DEFAULT 0 CHECK(failed IN (0, 1))
+        )
+    """)
+    # Частичный индекс: только неотправленные записи
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox(next_attempt_at) WHERE sent_at IS NULL
+    """)
+
+
+def _add_photo_dhash(conn: sqlite3.Connection, photo_store: Optional[PhotoStore] = None,
+                     chunk_size: int = 256):
+    """Перцептивный хеш фото для поиска дубликатов без CLIP"""
+    from perceptual_hash import dhash_bytes, to_db
+
+    if "dhash" not in _table_columns(conn, "requests"):
+        conn.execute("ALTER TABLE requests ADD COLUMN dhash INTEGER")
+
+    photo_store = photo_store or PhotoStore()
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, photo_hash FROM requests
+            WHERE id > ? AND dhash IS NULL
+            ORDER BY id
+            LIMIT ?
+        """, (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        hashes = []
+        for req_id, photo_hash in rows:
+            try:
+                hashes.append((to_db(dhash_bytes(photo_store.read(photo_hash))), req_id))
+            except Exception as e:
+                logger.warning(f"Не удалось посчитать dHash заявки {req_id}: {str(e)}")
+        conn.executemany("UPDATE requests SET dhash = ? WHERE id = ?", hashes)
+        conn.commit()
+        last_id = rows[-1][0]
+
+    # Проверка дубликатов при отправке фото: активные заявки пользователя того же типа
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_user_type
+        ON requests(user_id, request_type, is_active)
+    """)
+
+
+def _add_trace_ids(conn: sqlite3.Connection):
+    """trace id заявки переходит из хендлера в фоновую обработку и исходящую очередь"""
+    if "trace_id" not in _table_columns(conn, "requests"):
+        conn.execute("ALTER TABLE requests ADD COLUMN trace_id TEXT")
+    if "trace_id" not in _table_columns(conn, "outbox"):
+        conn.execute("ALTER TABLE outbox ADD COLUMN trace_id TEXT")
+
+
+def _add_chip_index(conn: sqlite3.Connection):
+    """Нормализованные номера чипов с индексом для точного совпадения при подаче заявки"""
+    from chip_match import normalize_chip_number
+
+    if "chip_match_id" not in _table_columns(conn, "requests"):
+        conn.execute("ALTER TABLE requests ADD COLUMN chip_match_id INTEGER")
+
+    rows = conn.execute("SELECT id, chip_number FROM requests WHERE chip_number IS NOT NULL").fetchall()
+    conn.executemany("UPDATE requests SET chip_number = ? WHERE id = ?",
+                     [(normalize_chip_number(chip_number), req_id) for req_id, chip_number in rows])
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_chip
+        ON requests(chip_number, request_type) WHERE chip_number IS NOT NULL
+    """)
+
+
+def _create_photo_cache(conn: sqlite3.Connection):
+    """Кеш фото и эмбеддингов по file_unique_id Telegram"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS photo_cache (
+            file_unique_id TEXT PRIMARY KEY,
+            photo_hash TEXT NOT NULL,
+            dhash INTEGER,
+            model_name TEXT,
+            model_version TEXT,
+            vector BLOB,
+            last_used REAL NOT NULL
+        )
+    """)
+    # Вытеснение давно не использованных записей
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_photo_cache_last_used ON photo_cache(last_used)")
+
+
+def _create_jobs(conn: sqlite3.Connection):
+    """Очередь задач сопоставления с арендой для воркеров"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            request_id INTEGER NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending'
+                CHECK(status IN ('pending', 'running', 'done', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at REAL,
+            last_error TEXT,
+            trace_id TEXT
+        )
+    """)
+    # Готовые к захвату задачи в порядке выдачи
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_ready
+        ON jobs(priority DESC, available_at, id) WHERE status = 'pending'
+    """)
+    # Поиск истёкших аренд
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_lease
+        ON jobs(lease_expires_at) WHERE status = 'running'
+    """)
+    # Не больше одной ждущей или выполняющейся задачи на заявку
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active
+        ON jobs(kind, request_id) WHERE status IN ('pending', 'running')
+    """)
+
+
+def _add_outbox_submitted_at(conn: sqlite3.Connection):
+    """Время подачи заявки в уведомлении - для метрики задержки от подачи до отправки"""
+    if "submitted_at" not in _table_columns(conn, "outbox"):
+        conn.execute("ALTER TABLE outbox ADD COLUMN submitted_at REAL")
+
+
+def _enable_incremental_vacuum(conn: sqlite3.Connection):
+    """
+    Индексы по хешу фото (архивация проверяет, нужен ли файл оставшимся заявкам и кешу)
+    и incremental vacuum: место после архивации возвращается порциями, без полного VACUUM
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_photo_hash ON requests(photo_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_photo_cache_hash ON photo_cache(photo_hash)")
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.commit()
+        # Режим auto_vacuum существующей базы меняется только полным VACUUM - один раз
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def _create_embedding_failures(conn: sqlite3.Connection):
+    """Фото, которые не удалось декодировать: не пересчитываются на каждом проходе"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_failures (
+            request_id INTEGER PRIMARY KEY,
+            photo_hash TEXT NOT NULL,
+            model_name TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            error TEXT,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _create_request_removals(conn: sqlite3.Connection):
+    """
+    Журнал заявок, выбывших из сопоставления (деактивация, перенос в архив), из любого процесса.
+    Индекс в памяти убирает их по журналу, не перечитывая базу целиком
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS request_removals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER NOT NULL,
+            removed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_requests_deactivated
+        AFTER UPDATE OF is_active ON requests
+        WHEN OLD.is_active = 1 AND NEW.is_active = 0
+        BEGIN
+            INSERT INTO request_removals (request_id) VALUES (OLD.id);
+        END
+    """)
+    # Деактивированные заявки уже в журнале - при удалении пишутся только активные
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_requests_deleted
+        AFTER DELETE ON requests
+        WHEN OLD.is_active = 1
+        BEGIN
+            INSERT INTO request_removals (request_id) VALUES (OLD.id);
+        END
+    """)
+
+
+def _log_chip_matches(conn: sqlite3.Connection):
+    """Заявка с совпадением по чипу выбывает из сопоставления CLIP - индекс в памяти убирает её по журналу"""
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_requests_chip_matched
+        AFTER UPDATE OF chip_match_id ON requests
+        WHEN OLD.chip_match_id IS NULL AND NEW.chip_match_id IS NOT NULL AND NEW.is_active = 1
+        BEGIN
+            INSERT INTO request_removals (request_id) VALUES (OLD.id);
+        END
+    """)
+
+
+def _add_chip_number_raw(conn: sqlite3.Connection):
+    """
+    Номер чипа в том виде, в каком его ввёл пользователь (chip_number - нормализованный или NULL).
+    Заполняется для новых заявок: исходный ввод старых миграция 8 уже заменила нормализованным
+    """
+    if "chip_number_raw" not in _table_columns(conn, "requests"):
+        conn.execute("ALTER TABLE requests ADD COLUMN chip_number_raw TEXT")
+
+
+def _add_matched_at(conn: sqlite3.Connection):
+    """Время сопоставления заявки: сопоставленную сразу после подачи проход не сравнивает повторно"""
+    if "matched_at" not in _table_columns(conn, "requests"):
+        conn.execute("ALTER TABLE requests ADD COLUMN matched_at TIMESTAMP")
+
+
+# Версионированные миграции: номер версии хранится в PRAGMA user_version
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "базовая схема", _create_base_schema),
+    (2, "перенос фото в файловое хранилище", migrate_photos_to_store),
+    (3, "индексы для горячих запросов", _create_hot_indexes),
+    (4, "пары пользователей в уведомлениях", _add_notification_user_pairs),
+    (5, "исходящая очередь уведомлений", _create_outbox),
+    (6, "перцептивные хеши фото", _add_photo_dhash),
+    (7, "trace id заявок и уведомлений", _add_trace_ids),
+    (8, "индекс номеров чипов", _add_chip_index),
+    (9, "кеш фото по file_unique_id", _create_photo_cache),
+    (10, "очередь задач сопоставления", _create_jobs),
+    (11, "время подачи заявки в исходящей очереди", _add_outbox_submitted_at),
+    (12, "индекс хешей фото и incremental vacuum", _enable_incremental_vacuum),
+    (13, "неудачные попытки посчитать эмбеддинг", _create_embedding_failures),
+    (14, "журнал выбывших заявок", _create_request_removals),
+    (15, "совпадения по чипу в журнале выбывших заявок", _log_chip_matches),
+    (16, "исходный ввод номера чипа", _add_chip_number_raw),
+    (17, "время сопоставления заявки", _add_matched_at),
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции по порядку и возвращает итоговую версию схемы"""
+    current = schema_version(conn)
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        migrate(conn)
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+        current = version
+        logger.info(f"Миграция {version} применена: {description}")
+    return current
+
+
+def hot_queries() -> List[Tuple[str, str, tuple]]:
+    """Горячие запросы бота и фоновой обработки: (название, SQL, параметры)"""
+    from background_tasks import NEW_REQUESTS_SQL, REEVALUATE_SQL
+    from embedding_store import CANDIDATES_SQL, MISSING_SQL
+    from image_comparison import HASHES_SQL, REMOVALS_SQL
+    from notifier import PENDING_SQL
+    from handlers import USER_HASHES_SQL
+    from chip_match import CHIP_MATCH_SQL
+    from photo_cache import CACHE_LOOKUP_SQL
+    from job_queue import CLAIM_SQL, EXPIRED_SQL
+    from archive import DEACTIVATED_SQL, EXPIRED_REQUESTS_SQL, PHOTO_IN_USE_SQL
+
+    return [
+        ("candidates", CANDIDATES_SQL, ("lost", "city", "category", 0, "model", "1")),
+        ("missing_embeddings", MISSING_SQL, ("model", "1", "model", "1", "lost", "city", "category")),
+        ("sweep_new_requests", NEW_REQUESTS_SQL, (0,)),
+        ("sweep_reevaluate", REEVALUATE_SQL, ("lost", "city", "category", 0)),
+        ("user_by_chat_id", "SELECT id FROM users WHERE chat_id = ?", (0,)),
+        ("outbox_pending", PENDING_SQL, (0, 500)),
+        ("photo_hashes", HASHES_SQL, (0,)),
+        ("index_removals", REMOVALS_SQL, (0,)),
+        ("user_photo_hashes", USER_HASHES_SQL, (0, "lost")),
+        ("chip_match", CHIP_MATCH_SQL, ("900000000000000", "found", 0)),
+        ("photo_cache", CACHE_LOOKUP_SQL, ("file",)),
+        ("job_claim", CLAIM_SQL, ("worker", 0, 0, 1)),
+        ("job_expired_leases", EXPIRED_SQL, (0,)),
+        ("archive_deactivated", DEACTIVATED_SQL, (500,)),
+        ("archive_expired", EXPIRED_REQUESTS_SQL, ("-30 days", 500)),
+        ("archive_photo_in_use", PHOTO_IN_USE_SQL, ("hash",)),
+        ("archive_photo_cache", "DELETE FROM photo_cache WHERE photo_hash = ?", ("hash",)),
+        ("notified_user_pair",
+         "SELECT 1 FROM notifications WHERE user_low = ? AND user_high = ?", (0, 0)),
+    ]
+
+
+# "SCAN requests" (до SQLite 3.36 - "SCAN TABLE requests") без "USING ... INDEX" - полный проход по таблице
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+
+
+def check_query_plans(conn: sqlite3.Connection,
+                      queries: Optional[List[Tuple[str, str, tuple]]] = None) -> List[str]:
+    """
+    Проверяет EXPLAIN QUERY PLAN горячих запросов.
+    Возвращает список проблем - запросов, скатившихся в полный проход по таблице
+    """
+    problems = []
+    for name, sql, params in queries if queries is not None else hot_queries():
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[-1]
+            if _FULL_SCAN.match(detail):
+                problems.append(f"{name}: {detail}")
+    return problems
@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from config import (DATABASE_NAME, OUTBOX_POLL_SECONDS, SEND_DIGEST_SIZE, SEND_GLOBAL_RATE,
+                    SEND_MAX_ATTEMPTS, SEND_PER_CHAT_RATE)
+from database import connect
+from metrics import OUTBOX_PENDING, SUBMISSION_TO_NOTIFICATION, stage_timer
+from tracing import get_trace_id, set_trace_id
+from worker_pool import WorkerPool, worker_pool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Запись очереди для отправки: (outbox_id, peer_user_id, similarity, trace_id, submitted_at)
+OutboxItem = Tuple[int, int, float, Optional[str], Optional[float]]
+
+# Частичный индекс idx_outbox_pending покрывает и фильтр, и сортировку
+PENDING_SQL = """
+    SELECT id, chat_id, peer_user_id, similarity, trace_id, submitted_at FROM outbox
+    WHERE sent_at IS NULL AND next_attempt_at <= ?
+    ORDER BY next_attempt_at, id
+    LIMIT ?
+"""
+
+class TokenBucket:
+    """Ведро токенов: не более rate событий в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до появления токена (0 - можно сейчас)"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    async def acquire(self):
+        while (wait := self.delay()) > 0:
+            await asyncio.sleep(wait)
+        self.consume()
+
+
+def enqueue_notifications(conn, rows: List[tuple], submitted_at: Optional[float] = None):
+    """
+    Ставит уведомления в исходящую очередь: (chat_id, peer_user_id, similarity[, submitted_at]).
+    Пишет в транзакцию переданного соединения - вместе с записью в notifications.
+    Записи получают trace id текущего контекста (заявки, по которой найдено совпадение)
+    и время подачи заявки (unix time) для метрики задержки - общее или своё у строки
+    """
+    trace_id = get_trace_id() if get_trace_id() != "-" else None
+    conn.executemany("""
+        INSERT INTO outbox (chat_id, peer_user_id, similarity, trace_id, submitted_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(row[0], row[1], row[2], trace_id, row[3] if len(row) > 3 else submitted_at) for row in rows])
+
+
+def _format_digest(items: List[OutboxItem]) -> Tuple[str, object]:
+    """Текст и клавиатура сообщения: одно совпадение или сводка по нескольким"""
+    builder = InlineKeyboardBuilder()
+
+    if len(items) == 1:
+        _, peer_user_id, similarity, _, _ = items[0]
+        text = (
+            "🔔 Найдено совпадение!\n\n"
+            f"• Уровень совпадения: {similarity:.2%}\n"
+            "Хотите связаться с пользователем?"
+        )
+        builder.add(InlineKeyboardButton(
+            text="✅ Да, показать контакты",
+            callback_data=f"show_contacts_{peer_user_id}"
+        ))
+    else:
+        lines = [f"• Совпадение {number}: {similarity:.2%}"
+                 for number, (_, _, similarity, _, _) in enumerate(items, start=1)]
+        text = (
+            f"🔔 Найдено совпадений: {len(items)}\n\n"
+            + "\n".join(lines)
+            + "\n\nХотите связаться с пользователями?"
+        )
+        for number, (_, peer_user_id, _, _, _) in enumerate(items, start=1):
+            builder.add(InlineKeyboardButton(
+                text=f"✅ Контакты #{number}",
+                callback_data=f"show_contacts_{peer_user_id}"
+            ))
+
+    builder.add(InlineKeyboardButton(
+        text="❌ Нет, спасибо",
+        callback_data="dismiss_notification"
+    ))
+    builder.adjust(1)
+    return text, builder.as_markup()
+
+
+class OutboundSender:
+    """
+    Разбирает исходящую очередь уведомлений (таблица outbox).
+    Соблюдает общий лимит и лимит на чат, учитывает RetryAfter от Telegram
+    и объединяет несколько совпадений для одного чата в одно сообщение
+    """
+
+    def __init__(self, bot: Bot, db_path: str = DATABASE_NAME, pool: WorkerPool = worker_pool,
+                 global_rate: float = SEND_GLOBAL_RATE, per_chat_rate: float = SEND_PER_CHAT_RATE):
+        self.bot = bot
+        self.db_path = db_path
+        self.pool = pool
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self._chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._paused_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self.sent_messages = 0
+        self.sent_items = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info("Исходящая очередь уведомлений запущена")
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def wake(self):
+        """Разобрать очередь сейчас, не дожидаясь OUTBOX_POLL_SECONDS"""
+        self._wake.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+            # Не храним вёдра всех чатов навсегда
+            while len(self._chat_buckets) > 10000:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _fetch_pending(self, limit: int = 500) -> Dict[int, List[OutboxItem]]:
+        """Готовые к отправке записи, сгруппированные по чату"""
+        conn = connect(self.db_path)
+        try:
+            rows = conn.execute(PENDING_SQL, (time.time(), limit)).fetchall()
+        finally:
+            conn.close()
+
+        by_chat: Dict[int, List[OutboxItem]] = OrderedDict()
+        for outbox_id, chat_id, peer_user_id, similarity, trace_id, submitted_at in rows:
+            by_chat.setdefault(chat_id, []).append((outbox_id, peer_user_id, similarity, trace_id, submitted_at))
+        return by_chat
+
+    def _mark_sent(self, outbox_ids: List[int]):
+        conn = connect(self.db_path)
+        try:
+            conn.executemany("UPDATE outbox SET sent_at = CURRENT_TIMESTAMP WHERE id = ?",
+                             [(outbox_id,) for outbox_id in outbox_ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _mark_failed(self, outbox_ids: List[int], give_up: bool):
+        """Откладывает повтор с экспоненциальной задержкой или снимает запись с очереди"""
+        conn = connect(self.db_path)
+        try:
+            conn.executemany("""
+                UPDATE outbox SET
+                    attempts = attempts + 1,
+                    next_attempt_at = ? + (1 << MIN(attempts, 10)) * 5,
+                    sent_at = CASE WHEN ? OR attempts + 1 >= ? THEN CURRENT_TIMESTAMP END,
+                    failed = CASE WHEN ? OR attempts + 1 >= ? THEN 1 ELSE 0 END
+                WHERE id = ?
+            """, [(time.time(), give_up, SEND_MAX_ATTEMPTS, give_up, SEND_MAX_ATTEMPTS, outbox_id)
+                  for outbox_id in outbox_ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def _send_digest(self, chat_id: int, items: List[OutboxItem]) -> bool:
+        """Отправляет одно сообщение в чат. False - Telegram попросил подождать"""
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+        # В логах отправки - trace id заявок, попавших в сводку
+        set_trace_id(",".join(sorted({item[3] for item in items if item[3]})) or "-")
+        outbox_ids = [item[0] for item in items]
+        text, keyboard = _format_digest(items)
+        try:
+            with stage_timer("send"):
+                await self.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль: ставим на паузу всю отправку, записи остаются в очереди
+            self._paused_until = time.monotonic() + e.retry_after
+            logger.warning(f"Telegram просит подождать {e.retry_after} с")
+            return False
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Пользователь заблокировал бота или чат недоступен - повторять бессмысленно
+            logger.warning(f"Уведомление в чат {chat_id} не доставлено: {str(e)}")
+            await self.pool.run_db(self._mark_failed, outbox_ids, True)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка отправки в чат {chat_id}: {str(e)}")
+            await self.pool.run_db(self._mark_failed, outbox_ids, False)
+            return True
+
+        await self.pool.run_db(self._mark_sent, outbox_ids)
+        sent_at = time.time()
+        for item in items:
+            if item[4] is not None:
+                SUBMISSION_TO_NOTIFICATION.observe(max(0.0, sent_at - item[4]))
+        self.sent_messages += 1
+        self.sent_items += len(items)
+        return True
+
+    async def drain(self) -> int:
+        """
+        Один проход по очереди. Возвращает число отправленных сообщений.
+        Чаты обходятся по кругу: чат, чей лимит ещё не восстановился, пропускается
+        до следующего круга и не задерживает отправку в остальные чаты
+        """
+        sent = 0
+        by_chat = await self.pool.run_db(self._fetch_pending)
+        OUTBOX_PENDING.set(sum(len(items) for items in by_chat.values()))
+        # Несколько совпадений для одного чата - сводные сообщения по SEND_DIGEST_SIZE
+        digests = OrderedDict(
+            (chat_id, deque(items[start:start + SEND_DIGEST_SIZE] for start in range(0, len(items), SEND_DIGEST_SIZE)))
+            for chat_id, items in by_chat.items()
+        )
+        while digests:
+            waits = []
+            for chat_id in list(digests):
+                wait = self._chat_bucket(chat_id).delay()
+                if wait > 0:
+                    waits.append(wait)
+                    continue
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                if not await self._send_digest(chat_id, digests[chat_id].popleft()):
+                    return sent
+                sent += 1
+                if not digests[chat_id]:
+                    del digests[chat_id]
+            # Все оставшиеся чаты ждут свой лимит - спим до ближайшего
+            if len(waits) == len(digests) and waits:
+                await asyncio.sleep(min(waits))
+        return sent
+
+    async def _run(self):
+        while True:
+            try:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка исходящей очереди: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
@@ -0,0 +1,189 @@
+import logging
+import threading
+from io import BytesIO
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PartitionKey = Tuple[str, str, str]  # (request_type, city, category)
+
+HASH_SIZE = 8  # dHash 8x8 = 64 бита
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    Разностный хеш (dHash): уменьшенное серое изображение 9x8,
+    бит = яркость пикселя больше яркости соседа справа
+    """
+    gray = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def dhash_bytes(data: bytes) -> int:
+    """dHash по байтам фото; JPEG декодируется сразу в уменьшенном размере"""
+    image = Image.open(BytesIO(data))
+    image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))  # Для JPEG - декодирование с понижением в 2-8 раз
+    return dhash(image)
+
+
+def to_db(value: int) -> int:
+    """64-битный хеш -> знаковое INTEGER для SQLite"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def from_db(value: int) -> int:
+    return value & ((1 << 64) - 1)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def hash_similarity(distance: int) -> float:
+    """Расстояние Хэмминга -> схожесть в шкале косинусной схожести CLIP"""
+    return 1.0 - distance / HASH_BITS
+
+
+class BKTree:
+    """
+    BK-дерево по расстоянию Хэмминга: поиск всех хешей в радиусе r
+    без перебора всей коллекции. Одинаковые хеши хранятся в одном узле.
+    Узел без id остаётся в дереве как промежуточный; когда таких становится больше,
+    чем живых, дерево перестраивается по оставшимся id
+    """
+
+    def __init__(self):
+        self._root: Optional[list] = None  # [hash, set(request_id), {distance: child}]
+        self._node_of: Dict[int, list] = {}
+        self.node_count = 0
+        self.dead_nodes = 0
+
+    def __len__(self) -> int:
+        return len(self._node_of)
+
+    def add(self, request_id: int, value: int):
+        self.remove(request_id)
+        if self._root is None:
+            node = self._root = [value, set(), {}]
+            self.node_count += 1
+        else:
+            node = self._root
+            while True:
+                distance = hamming(value, node[0])
+                if distance == 0:
+                    if not node[1]:
+                        self.dead_nodes -= 1  # Хеш вернулся в опустевший узел
+                    break
+                child = node[2].get(distance)
+                if child is None:
+                    child = [value, set(), {}]
+                    node[2][distance] = child
+                    node = child
+                    self.node_count += 1
+                    break
+                node = child
+        node[1].add(request_id)
+        self._node_of[request_id] = node
+
+    def remove(self, request_id: int) -> bool:
+        node = self._node_of.pop(request_id, None)
+        if node is None:
+            return False
+        node[1].discard(request_id)
+        if not node[1]:
+            self.dead_nodes += 1
+            if self.dead_nodes > self.node_count - self.dead_nodes:
+                self._rebuild()
+        return True
+
+    def _rebuild(self):
+        """Дерево заново только из узлов с id"""
+        values = [(request_id, node[0]) for request_id, node in self._node_of.items()]
+        self._root, self._node_of = None, {}
+        self.node_count = self.dead_nodes = 0
+        for request_id, value in values:
+            self.add(request_id, value)
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        """Все (request_id, distance) с расстоянием не больше max_distance, по возрастанию"""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                results.extend((request_id, distance) for request_id in node[1])
+            # Неравенство треугольника: поддеревья вне [d - r, d + r] не содержат ответов
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda item: (item[1], item[0]))
+        return results
+
+
+class PartitionedHashIndex:
+    """BK-деревья перцептивных хешей, по одному на партицию (request_type, city, category)"""
+
+    def __init__(self):
+        self._partitions: Dict[PartitionKey, BKTree] = {}
+        self._partition_of: Dict[int, PartitionKey] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._partition_of)
+
+    def __contains__(self, request_id: int) -> bool:
+        return request_id in self._partition_of
+
+    def add(self, request_id: int, key: PartitionKey, value: int):
+        with self._lock:
+            if self._partition_of.get(request_id, key) != key:
+                self.remove(request_id)
+            tree = self._partitions.get(key)
+            if tree is None:
+                tree = BKTree()
+                self._partitions[key] = tree
+            tree.add(request_id, value)
+            self._partition_of[request_id] = key
+
+    def remove(self, request_id: int) -> bool:
+        with self._lock:
+            key = self._partition_of.pop(request_id, None)
+            if key is None:
+                return False
+            tree = self._partitions[key]
+            tree.remove(request_id)
+            if not tree:
+                del self._partitions[key]
+            return True
+
+    def node_count(self) -> int:
+        """Узлов во всех деревьях, включая промежуточные без id"""
+        with self._lock:
+            return sum(tree.node_count for tree in self._partitions.values())
+
+    def search(self, key: PartitionKey, value: int, max_distance: int,
+               exclude: Optional[Set[int]] = None) -> List[Tuple[int, int]]:
+        with self._lock:
+            tree = self._partitions.get(key)
+            if tree is None:
+                return []
+            results = tree.search(value, max_distance)
+        if exclude:
+            results = [item for item in results if item[0] not in exclude]
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._partitions.clear()
+            self._partition_of.clear()
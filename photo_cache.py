@@ -0,0 +1,118 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+from config import CLIP_MODEL_NAME, EMBEDDING_VERSION, PHOTO_CACHE_MEMORY_SIZE, PHOTO_CACHE_SIZE
+from metrics import PHOTO_CACHE_LOOKUPS
+from perceptual_hash import from_db, to_db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Запись кеша: (photo_hash, dhash, эмбеддинг текущей модели или None)
+CachedPhoto = Tuple[str, Optional[int], Optional[np.ndarray]]
+
+CACHE_LOOKUP_SQL = """
+    SELECT photo_hash, dhash, model_name, model_version, vector FROM photo_cache
+    WHERE file_unique_id = ?
+"""
+
+# Лишние записи удаляются раз в EVICT_EVERY вставок - не на каждую
+EVICT_EVERY = 64
+
+
+class PhotoCache:
+    """
+    Кеш фото по file_unique_id Telegram: повторно присланная (пересланная) картинка
+    не скачивается и не кодируется заново. Записи хранятся в SQLite (таблица photo_cache,
+    не больше max_entries, вытесняются давно не использованные), частые - ещё и в LRU в памяти
+    """
+
+    def __init__(self, max_entries: int = PHOTO_CACHE_SIZE, memory_entries: int = PHOTO_CACHE_MEMORY_SIZE,
+                 model_name: str = CLIP_MODEL_NAME, model_version: str = EMBEDDING_VERSION):
+        self.max_entries = max_entries
+        self.memory_entries = max(1, memory_entries)
+        self.model_name = model_name
+        self.model_version = model_version
+        self._memory: "OrderedDict[str, CachedPhoto]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def _remember(self, file_unique_id: str, entry: CachedPhoto):
+        with self._lock:
+            self._memory[file_unique_id] = entry
+            self._memory.move_to_end(file_unique_id)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def peek(self, file_unique_id: str) -> Optional[CachedPhoto]:
+        """Запись из памяти без обращения к БД и без учёта в метриках"""
+        with self._lock:
+            return self._memory.get(file_unique_id)
+
+    def get(self, conn: sqlite3.Connection, file_unique_id: str) -> Optional[CachedPhoto]:
+        """Фото и эмбеддинг по file_unique_id или None; попадание продлевает жизнь записи"""
+        with self._lock:
+            entry = self._memory.get(file_unique_id)
+            if entry is not None:
+                self._memory.move_to_end(file_unique_id)
+
+        if entry is None:
+            row = conn.execute(CACHE_LOOKUP_SQL, (file_unique_id,)).fetchone()
+            if row is None:
+                PHOTO_CACHE_LOOKUPS.inc(result="miss")
+                return None
+            photo_hash, dhash, model_name, model_version, blob = row
+            # Эмбеддинг другой модели не годится, но само фото переиспользуется
+            vector = None
+            if blob is not None and (model_name, model_version) == (self.model_name, self.model_version):
+                vector = np.frombuffer(blob, dtype=np.float32)
+            entry = (photo_hash, from_db(dhash) if dhash is not None else None, vector)
+            self._remember(file_unique_id, entry)
+            PHOTO_CACHE_LOOKUPS.inc(result="hit_db")
+        else:
+            PHOTO_CACHE_LOOKUPS.inc(result="hit_memory")
+
+        conn.execute("UPDATE photo_cache SET last_used = ? WHERE file_unique_id = ?",
+                     (time.time(), file_unique_id))
+        return entry
+
+    def put(self, conn: sqlite3.Connection, file_unique_id: str, photo_hash: str,
+            dhash: Optional[int], embedding: Optional[np.ndarray]):
+        """Добавляет или обновляет запись в транзакции переданного соединения"""
+        blob = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32).ravel()
+            norm = np.linalg.norm(vector)
+            blob = (vector / norm if norm > 0 else vector).astype(np.float32).tobytes()
+        conn.execute("""
+            INSERT OR REPLACE INTO photo_cache
+            (file_unique_id, photo_hash, dhash, model_name, model_version, vector, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (file_unique_id, photo_hash, to_db(dhash) if dhash is not None else None,
+              self.model_name, self.model_version, blob, time.time()))
+        self._remember(file_unique_id, (photo_hash, dhash,
+                                        np.frombuffer(blob, dtype=np.float32) if blob is not None else None))
+
+        self._puts += 1
+        if self._puts % EVICT_EVERY == 0:
+            self.evict(conn)
+
+    def evict(self, conn: sqlite3.Connection) -> int:
+        """Удаляет самые давно использованные записи сверх max_entries"""
+        cursor = conn.execute("""
+            DELETE FROM photo_cache WHERE file_unique_id IN (
+                SELECT file_unique_id FROM photo_cache
+                ORDER BY last_used DESC
+                LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+        # Записи в памяти не сбрасываются: фото остаются в хранилище и по-прежнему верны
+        if cursor.rowcount:
+            logger.info(f"Из кеша фото вытеснено записей: {cursor.rowcount}")
+        return cursor.rowcount
@@ -0,0 +1,83 @@
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+from config import PHOTO_STORE_DIR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PhotoStore:
+    """
+    Контентно-адресуемое хранилище фотографий на диске.
+    Файл лежит по пути root/ab/cd/<sha256>, одинаковые загрузки хранятся один раз
+    """
+
+    def __init__(self, root: str = PHOTO_STORE_DIR):
+        self.root = Path(root)
+
+    @staticmethod
+    def hash_bytes(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, photo_hash: str) -> Path:
+        """Путь к файлу фото (шардирование по первым байтам хеша)"""
+        return self.root / photo_hash[:2] / photo_hash[2:4] / photo_hash
+
+    def exists(self, photo_hash: str) -> bool:
+        return self.path(photo_hash).exists()
+
+    def put(self, data: bytes, key: Optional[str] = None) -> str:
+        """
+        Сохраняет фото и возвращает его хеш. Повторная загрузка того же файла ничего не пишет.
+        key - сохранить под чужим ключом (миниатюра под хешем оригинала)
+        """
+        photo_hash = key or self.hash_bytes(data)
+        path = self.path(photo_hash)
+        if path.exists():
+            return photo_hash
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Пишем во временный файл и атомарно переименовываем - читатели не увидят недописанный файл
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return photo_hash
+
+    def open(self, photo_hash: str) -> BinaryIO:
+        """Потоковое чтение фото"""
+        return open(self.path(photo_hash), "rb")
+
+    @contextmanager
+    def mmap(self, photo_hash: str) -> Iterator[memoryview]:
+        """Чтение фото через отображение в память без копирования в кучу"""
+        with self.open(photo_hash) as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
+
+    def read(self, photo_hash: str) -> bytes:
+        with self.open(photo_hash) as f:
+            return f.read()
+
+    def delete(self, photo_hash: str) -> bool:
+        try:
+            self.path(photo_hash).unlink()
+            return True
+        except FileNotFoundError:
+            return False
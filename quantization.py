@@ -0,0 +1,59 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Режимы хранения векторов в памяти: байт на компоненту 4 / 2 / 1 (+4 байта масштаба на вектор)
+SUPPORTED_DTYPES = ("float32", "float16", "int8")
+_CODE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def code_dtype(dtype: str) -> np.dtype:
+    if dtype not in _CODE_DTYPES:
+        raise ValueError(f"Неизвестный режим хранения эмбеддингов: {dtype} (допустимо: {', '.join(SUPPORTED_DTYPES)})")
+    return np.dtype(_CODE_DTYPES[dtype])
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Сжимает векторы (N, dim). Возвращает (коды, масштабы (N,)).
+    int8 - симметричное квантование с масштабом на вектор: v ≈ scale * code
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    if code_dtype(dtype) != np.int8:
+        return vectors.astype(code_dtype(dtype)), np.ones(len(vectors), dtype=np.float32)
+
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[:, None]).clip(-127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    vectors = codes.astype(np.float32)
+    if codes.dtype == np.int8:
+        vectors *= scales[:, None]
+    return vectors
+
+
+def quantized_scores(codes: np.ndarray, scales: np.ndarray, query: np.ndarray,
+                     chunk: int = 8192) -> np.ndarray:
+    """
+    Скалярные произведения query с квантованной матрицей без её полного разжатия:
+    блоки приводятся к float32 по chunk строк, масштаб int8 применяется к результату
+    """
+    query = np.asarray(query, dtype=np.float32).ravel()
+    if codes.dtype == np.float32:
+        return codes @ query
+
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), chunk):
+        block = codes[start:start + chunk]
+        scores[start:start + chunk] = block.astype(np.float32) @ query
+    if codes.dtype == np.int8:
+        scores *= scales
+    return scores
+
+
+def nbytes(codes: np.ndarray, scales: Optional[np.ndarray] = None) -> int:
+    """Объём памяти под векторы (масштабы учитываются только для int8)"""
+    return codes.nbytes + (scales.nbytes if scales is not None and codes.dtype == np.int8 else 0)
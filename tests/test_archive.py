@@ -0,0 +1,111 @@
+"""Перенос заявок в холодный архив"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from archive import Archive
+from database import connect, initialize_database
+
+
+def _jpeg(color) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def _add_request(db_path: str, photo_hash: str, is_active: int = 1, dhash: int = None) -> int:
+    conn = connect(db_path)
+    try:
+        conn.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (1)")
+        request_id = conn.execute("""
+            INSERT INTO requests (user_id, request_type, photo_hash, category, city, is_active, dhash)
+            VALUES (1, 'lost', ?, 'Собака', 'Москва', ?, ?)
+        """, (photo_hash, is_active, dhash)).lastrowid
+        conn.commit()
+        return request_id
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    # Хранилища фото по умолчанию - относительные пути
+    monkeypatch.chdir(tmp_path)
+    # Пути абсолютные: пул соединений общий на процесс и различает базы по пути
+    db_path = str(tmp_path / "hot.db")
+    initialize_database(db_path)
+    return Archive(db_path, str(tmp_path / "archive.db"))
+
+
+def test_archive_removes_orphaned_photo(archive):
+    photo_hash = archive.photo_store.put(_jpeg((200, 30, 40)))
+    _add_request(archive.db_path, photo_hash, is_active=0)
+
+    stats = archive.archive_expired()
+    assert stats["deactivated"] == 1 and stats["photos"] == 1
+    assert not archive.photo_store.exists(photo_hash)
+    assert archive.photo_path(photo_hash) == archive.archive_photo_store.path(photo_hash)
+
+
+def test_photo_reused_during_archiving_is_kept(archive, monkeypatch):
+    photo_hash = archive.photo_store.put(_jpeg((200, 30, 40)))
+    _add_request(archive.db_path, photo_hash, is_active=0)
+
+    # Новая заявка с тем же фото сохраняется после удаления строк, но до удаления файлов:
+    # PhotoStore.put видит файл и ничего не пишет
+    delete_photos = archive._delete_photos
+
+    def save_then_delete(photo_hashes):
+        assert archive.photo_store.put(_jpeg((200, 30, 40))) == photo_hash
+        _add_request(archive.db_path, photo_hash)
+        return delete_photos(photo_hashes)
+
+    monkeypatch.setattr(archive, "_delete_photos", save_then_delete)
+    assert archive.archive_expired()["photos"] == 0
+    assert archive.photo_store.exists(photo_hash)
+
+
+def test_save_request_rejects_missing_cached_photo(archive):
+    from handlers import save_request
+
+    photo_hash = archive.photo_store.put(_jpeg((200, 30, 40)))
+    archive.photo_store.delete(photo_hash)
+    data = {"request_type": "lost", "category": "Собака", "city": "Москва", "photo_hash": photo_hash}
+    conn = connect(archive.db_path)
+    try:
+        with pytest.raises(FileNotFoundError):
+            save_request(conn, 1, "user", data, None)
+        conn.rollback()
+        assert conn.execute("SELECT COUNT(*) FROM requests").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+def test_archived_requests_leave_hash_index(archive):
+    from image_comparison import ImageComparator
+    from perceptual_hash import to_db
+
+    rng = np.random.default_rng(0)
+    request_ids = [_add_request(archive.db_path, f"hash{i}", dhash=to_db(int(rng.integers(0, 2 ** 63))))
+                   for i in range(200)]
+    comparator = ImageComparator(archive.db_path)
+    comparator.sync()
+    nodes = comparator.hashes.node_count()
+    assert len(comparator.hashes) == 200 and nodes == 200
+
+    conn = connect(archive.db_path)
+    try:
+        conn.executemany("UPDATE requests SET is_active = 0 WHERE id = ?", [(i,) for i in request_ids[:180]])
+        conn.commit()
+    finally:
+        conn.close()
+    assert archive.archive_expired()["deactivated"] == 180
+    comparator.sync()
+
+    # Узлы архивных заявок не копятся в дереве: оно перестраивается по оставшимся
+    assert len(comparator.hashes) == 20
+    assert comparator.hashes.node_count() < nodes / 2
+    assert sorted(request_id for request_id, _ in comparator.hashes.search(
+        ("lost", "Москва", "Собака"), 0, 64)) == request_ids[180:]
@@ -0,0 +1,32 @@
+"""Эмбеддинги бэкендов clip_backend совпадают с исходной моделью (см. benchmarks.backend_parity)"""
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("sentence_transformers")
+
+from benchmarks.backend_benchmark import BACKEND_CONFIGS, build_encoder, sample_images  # noqa: E402
+from benchmarks.backend_parity import cosine_drift  # noqa: E402
+from clip_backend import ReferenceEncoder  # noqa: E402
+from image_processing import get_model  # noqa: E402
+
+MAX_DRIFT = 1e-3
+MAX_DRIFT_INT8 = 0.02
+
+
+@pytest.fixture(scope="module")
+def reference():
+    model = get_model()
+    images = sample_images(16)
+    return model, images, ReferenceEncoder(model).encode(images)
+
+
+@pytest.mark.parametrize("backend,quantize",
+                         [config for config in BACKEND_CONFIGS if config != ("torch", False)])
+def test_backend_matches_reference(reference, backend, quantize):
+    if backend == "onnx":
+        pytest.importorskip("onnxruntime")
+    model, images, expected = reference
+    encoder = build_encoder(model, backend, quantize, threads=0)
+    drift = cosine_drift(expected, np.asarray(encoder.encode(images)))
+    assert drift.max() <= (MAX_DRIFT_INT8 if quantize else MAX_DRIFT)
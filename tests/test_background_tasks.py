@@ -0,0 +1,82 @@
+"""Сопоставление только что поданных заявок и часовой проход"""
+import asyncio
+
+import pytest
+
+from background_tasks import BackgroundProcessor
+from database import connect, initialize_database
+from worker_pool import WorkerPool
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Путь абсолютный: пул соединений общий на процесс и различает базы по пути
+    db_path = str(tmp_path / "requests.db")
+    initialize_database(db_path)
+    conn = connect(db_path)
+    try:
+        conn.execute("INSERT INTO users (chat_id) VALUES (1)")
+        conn.execute("""
+            INSERT INTO requests (user_id, request_type, photo_hash, category, city)
+            VALUES (1, 'lost', 'a', 'Собака', 'Москва')
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+    return db_path
+
+
+def _processor(db_path: str, use_job_queue: bool):
+    processor = BackgroundProcessor(None, db_path, pool=WorkerPool(inference_processes=0),
+                                    use_job_queue=use_job_queue)
+    compared = []
+
+    def compare_with_database(request_id):
+        compared.append(request_id)
+        return []
+
+    processor.comparator.compare_with_database = compare_with_database
+    return processor, compared
+
+
+def _pending_jobs(db_path: str) -> int:
+    conn = connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_submitted_request_is_not_compared_again_by_sweep(db_path):
+    async def main():
+        processor, compared = _processor(db_path, use_job_queue=False)
+        try:
+            processor.submit(1)
+            await asyncio.gather(*processor._submitted)
+            await processor._process_all_requests()
+            return compared, await processor.pool.run_db(processor._get_watermark)
+        finally:
+            await processor.pool.shutdown()
+
+    compared, watermark = asyncio.run(main())
+    assert compared == [1]
+    assert watermark == 1
+
+
+def test_sweep_does_not_enqueue_request_matched_by_worker(db_path):
+    async def main():
+        processor, compared = _processor(db_path, use_job_queue=True)
+        try:
+            processor.submit(1)
+            await asyncio.gather(*processor._submitted)
+            job, = await processor.pool.run_db(processor.jobs.claim, "worker")
+            assert await processor.run_job("worker", job)
+            await processor._process_all_requests()
+            return compared, await processor.pool.run_db(_pending_jobs, db_path)
+        finally:
+            await processor.pool.shutdown()
+
+    compared, pending = asyncio.run(main())
+    assert compared == [1]
+    assert pending == 0
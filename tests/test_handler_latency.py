@@ -0,0 +1,84 @@
+"""Задержка хендлеров бота во время прохода фоновой обработки"""
+import argparse
+import asyncio
+import shutil
+import time
+
+import pytest
+
+import image_processing
+import worker_pool
+from background_tasks import BackgroundProcessor
+from benchmarks.handler_latency import InlinePool, _probe, _stats
+from benchmarks.pipeline_benchmark import generate_dataset
+from benchmarks.stub_encoder import install_stub_encoder
+from database import AsyncDatabase
+
+INTERVAL = 0.02
+IDLE_SECONDS = 0.5
+# p95 во время прохода - не больше LATENCY_FACTOR эталонных; нижняя граница
+# гасит шум планировщика, когда эталонный p95 - доли миллисекунды
+LATENCY_FACTOR = 10
+MIN_BOUND_MS = 50.0
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp("dataset")
+    generate_dataset(work_dir, argparse.Namespace(requests=300, cities=3, categories=2, seed=0))
+    return work_dir
+
+
+@pytest.fixture
+def db_path(dataset, tmp_path, monkeypatch):
+    # Проход досчитывает эмбеддинги и двигает watermark - каждому тесту своя копия базы
+    work_dir = tmp_path / "work"
+    shutil.copytree(dataset, work_dir)
+    monkeypatch.chdir(work_dir)
+    # Заглушка CLIP подменяет глобальное состояние модулей - после теста оно возвращается
+    monkeypatch.setattr(image_processing, "_model", image_processing._model)
+    monkeypatch.setattr(image_processing, "_encoder", image_processing._encoder)
+    monkeypatch.setattr(worker_pool.worker_pool, "inference_processes", worker_pool.worker_pool.inference_processes)
+    install_stub_encoder()
+    yield str(work_dir / "bench.db")
+    image_processing.model_ready.clear()
+
+
+def _p95_ms(pool: worker_pool.WorkerPool, db_path: str):
+    """p95 пробного хендлера без нагрузки и во время прохода, в миллисекундах"""
+    async def main():
+        db = AsyncDatabase(db_path)
+        stop = asyncio.Event()
+        probe = asyncio.create_task(_probe(db, INTERVAL, stop, time.perf_counter()))
+        await asyncio.sleep(IDLE_SECONDS)
+        stop.set()
+        idle = await probe
+
+        processor = BackgroundProcessor(None, db_path, pool=pool, use_job_queue=False)
+        try:
+            stop = asyncio.Event()
+            probe = asyncio.create_task(_probe(db, INTERVAL, stop, time.perf_counter()))
+            await processor._process_all_requests()
+            stop.set()
+            sweep = await probe
+        finally:
+            await pool.shutdown()
+            image_processing.inference_service.stop()
+        return _stats(idle, "idle")["idle_ms_p95"], _stats(sweep, "sweep")["sweep_ms_p95"]
+
+    return asyncio.run(main())
+
+
+def _within_bound(idle_p95: float, sweep_p95: float) -> bool:
+    return sweep_p95 <= max(idle_p95 * LATENCY_FACTOR, MIN_BOUND_MS)
+
+
+def test_sweep_does_not_block_handlers(db_path):
+    idle_p95, sweep_p95 = _p95_ms(worker_pool.WorkerPool(inference_processes=0), db_path)
+    assert _within_bound(idle_p95, sweep_p95), (idle_p95, sweep_p95)
+
+
+def test_inline_sweep_blocks_handlers(db_path):
+    # Контроль: тот же проход прямо в event loop проверка должна поймать
+    idle_p95, sweep_p95 = _p95_ms(InlinePool(inference_processes=0), db_path)
+    assert not _within_bound(idle_p95, sweep_p95), (idle_p95, sweep_p95)
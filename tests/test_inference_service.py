@@ -0,0 +1,47 @@
+"""Сервис инференса с микробатчингом"""
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+from inference_service import InferenceService
+
+
+def test_full_queue_does_not_block_event_loop():
+    release = threading.Event()
+    encoding = threading.Event()
+
+    def encode_batch(items):
+        encoding.set()
+        release.wait(5)
+        return np.zeros((len(items), 4), dtype=np.float32)
+
+    service = InferenceService(encode_batch, max_batch_size=1, max_wait_ms=0, queue_size=1)
+
+    async def main():
+        # Первый запрос занимает поток батчей, второй - единственное место в очереди
+        busy = [asyncio.ensure_future(service.encode_async(0))]
+        while not encoding.is_set():
+            await asyncio.sleep(0.01)
+        busy.append(asyncio.ensure_future(service.encode_async(1)))
+        while service.metrics()["queue_depth"] < 1:
+            await asyncio.sleep(0.01)
+
+        blocked = asyncio.ensure_future(service.encode_async(2))
+        started = time.perf_counter()
+        await asyncio.sleep(0.05)
+        # Event loop продолжает работать, пока третий запрос ждёт места в очереди
+        assert time.perf_counter() - started < 1.0
+        assert not blocked.done()
+        assert service.metrics()["queue_full"] == 1
+
+        release.set()
+        results = await asyncio.wait_for(asyncio.gather(*busy, blocked), 5)
+        assert [result.shape for result in results] == [(4,)] * 3
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        service.stop(timeout=5)
@@ -0,0 +1,47 @@
+"""Аренда задач очереди сопоставления"""
+import pytest
+
+from database import connect, initialize_database
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db_path = str(tmp_path / "jobs.db")
+    initialize_database(db_path)
+    queue = JobQueue(db_path, lease_seconds=-1)
+    conn = connect(db_path)
+    try:
+        queue.enqueue(conn, [(1, None)])
+        conn.commit()
+    finally:
+        conn.close()
+    return queue
+
+
+def _job_state(queue: JobQueue):
+    conn = connect(queue.db_path)
+    try:
+        return conn.execute("SELECT status, lease_owner, last_error FROM jobs").fetchone()
+    finally:
+        conn.close()
+
+
+def test_stale_worker_cannot_fail_reclaimed_job(queue):
+    (job_id, *_), = queue.claim("stale")
+    # Аренда истекла, задачу забрал другой воркер
+    assert queue.reclaim_expired() == 1
+    queue.lease_seconds = 60
+    assert queue.claim("fresh")[0][0] == job_id
+
+    assert queue.fail("stale", job_id, "timeout") is False
+    assert _job_state(queue) == ("running", "fresh", None)
+    assert queue.complete("fresh", job_id)
+
+
+def test_fail_returns_job_to_queue(queue):
+    queue.lease_seconds = 60
+    (job_id, *_), = queue.claim("worker")
+    assert queue.fail("worker", job_id, "boom") is True
+    assert _job_state(queue) == ("pending", None, "boom")
@@ -0,0 +1,114 @@
+"""Миграции схемы от исходной базы (фото в BLOB-ах requests.photo_data) до текущей версии"""
+import io
+import sqlite3
+
+import pytest
+from PIL import Image
+
+from migrations import _FULL_SCAN, MIGRATIONS, check_query_plans, run_migrations, schema_version
+from photo_store import PhotoStore
+
+# Схема до миграций (database.py первой версии)
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER UNIQUE NOT NULL,
+        username TEXT,
+        registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        request_type TEXT CHECK(request_type IN ('found', 'lost')),
+        photo_data BLOB NOT NULL,
+        breed TEXT,
+        category TEXT,
+        gender TEXT CHECK(gender IN ('самец', 'самка', 'неизвестно')),
+        size TEXT CHECK(size IN ('маленький', 'средний', 'большой')),
+        hair TEXT CHECK(hair IN ('короткая', 'длинная', 'нет')),
+        city TEXT NOT NULL,
+        chip_number TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_active INTEGER DEFAULT 1 CHECK(is_active IN (0, 1)),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+    CREATE TABLE notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source_request INTEGER,
+        matched_request INTEGER,
+        similarity REAL,
+        notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(source_request, matched_request),
+        FOREIGN KEY(source_request) REFERENCES requests(id),
+        FOREIGN KEY(matched_request) REFERENCES requests(id)
+    );
+'''
+
+
+def _jpeg(color) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def baseline_db(tmp_path, monkeypatch):
+    # Хранилища фото по умолчанию - относительные пути
+    monkeypatch.chdir(tmp_path)
+    conn = sqlite3.connect(tmp_path / "database.db")
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO users (chat_id, username) VALUES (?, ?)", [(1, "a"), (2, "b")])
+    conn.executemany("""
+        INSERT INTO requests (user_id, request_type, photo_data, category, city, chip_number)
+        VALUES (?, ?, ?, 'Собака', 'Москва', ?)
+    """, [(1, "lost", _jpeg((200, 30, 40)), "643 094 100 123 456"),
+          (2, "found", _jpeg((20, 130, 240)), "не знаю")])
+    conn.execute("INSERT INTO notifications (source_request, matched_request, similarity) VALUES (1, 2, 0.9)")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_migrates_baseline_to_current_version(baseline_db):
+    assert run_migrations(baseline_db) == MIGRATIONS[-1][0]
+    assert schema_version(baseline_db) == MIGRATIONS[-1][0]
+
+    columns = [row[1] for row in baseline_db.execute("PRAGMA table_info(requests)")]
+    assert "photo_data" not in columns
+    rows = baseline_db.execute("SELECT photo_hash, dhash FROM requests ORDER BY id").fetchall()
+    assert len(rows) == 2
+    store = PhotoStore()
+    for photo_hash, dhash in rows:
+        assert store.exists(photo_hash)
+        assert dhash is not None
+    assert baseline_db.execute("SELECT user_low, user_high FROM notifications").fetchone() == (1, 2)
+    # Миграция 8 нормализует номер чипа; исходный ввод хранится только у новых заявок
+    assert baseline_db.execute("SELECT chip_number, chip_number_raw FROM requests ORDER BY id").fetchall() == [
+        ("643094100123456", None), (None, None)]
+
+
+def test_hot_queries_use_indexes(baseline_db):
+    run_migrations(baseline_db)
+    assert check_query_plans(baseline_db) == []
+
+
+def test_migrations_are_idempotent(baseline_db):
+    version = run_migrations(baseline_db)
+    # Повторный запуск ничего не применяет, а сами миграции переживают повторное выполнение
+    assert run_migrations(baseline_db) == version
+    for _, _, migrate in MIGRATIONS:
+        migrate(baseline_db)
+        baseline_db.commit()
+    assert check_query_plans(baseline_db) == []
+
+
+@pytest.mark.parametrize("detail,full_scan", [
+    ("SCAN requests", True),
+    ("SCAN TABLE requests", True),  # SQLite до 3.36
+    ("SCAN TABLE requests AS r", True),
+    ("SCAN r USING INDEX idx_requests_partition", False),
+    ("SCAN TABLE requests USING COVERING INDEX idx_requests_partition", False),
+    ("SEARCH r USING INDEX idx_requests_partition (request_type=?)", False),
+])
+def test_full_scan_detection(detail, full_scan):
+    assert bool(_FULL_SCAN.match(detail)) == full_scan
@@ -0,0 +1,47 @@
+"""Исходящая очередь уведомлений"""
+import asyncio
+import time
+
+from config import SEND_DIGEST_SIZE
+from database import connect, initialize_database
+from notifier import OutboundSender, enqueue_notifications
+from worker_pool import WorkerPool
+
+
+class RecordingBot:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append((chat_id, time.monotonic() - self.started))
+
+
+def test_busy_chat_does_not_delay_other_chats(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db_path = str(tmp_path / "outbox.db")
+    initialize_database(db_path)
+    conn = connect(db_path)
+    try:
+        # Чату 1 - три сводки (лимит 1 сообщение в секунду на чат), чату 2 - одна
+        enqueue_notifications(conn, [(1, peer, 0.9) for peer in range(3 * SEND_DIGEST_SIZE)])
+        enqueue_notifications(conn, [(2, 1000, 0.9)])
+        conn.commit()
+    finally:
+        conn.close()
+
+    bot = RecordingBot()
+
+    async def main():
+        pool = WorkerPool(inference_processes=0)
+        try:
+            sender = OutboundSender(bot, db_path, pool=pool, global_rate=100, per_chat_rate=1)
+            return await sender.drain()
+        finally:
+            await pool.shutdown()
+
+    assert asyncio.run(main()) == 4
+    assert [chat_id for chat_id, _ in bot.sent] == [1, 2, 1, 1]
+    # Чат 2 получает уведомление сразу, а не после сводок чата 1
+    assert dict((chat_id, at) for chat_id, at in reversed(bot.sent))[2] < 0.5
+    assert bot.sent[-1][1] >= 1.5
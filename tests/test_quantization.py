@@ -0,0 +1,26 @@
+"""Сжатое хранение эмбеддингов не меняет совпадений на порогах (см. benchmarks.quantization_check)"""
+import numpy as np
+import pytest
+
+from benchmarks.quantization_check import THRESHOLDS, make_reference_set, run
+from config import MATCH_TOP_K
+
+
+@pytest.fixture(scope="module")
+def reports():
+    queries, vectors = make_reference_set(100, 40, 512, np.random.default_rng(0))
+    return run(queries, vectors, MATCH_TOP_K)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_rerank_keeps_matches(reports, dtype):
+    report = next(r for r in reports if r["dtype"] == dtype and r["rerank"])
+    for threshold in THRESHOLDS:
+        assert report[f"matches@{threshold}"] > 0
+        assert report[f"changed@{threshold}"] == 0
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_compressed_index_is_smaller(reports, dtype):
+    report = next(r for r in reports if r["dtype"] == dtype)
+    assert report["bytes_per_vector"] < report["float32_bytes_per_vector"]
@@ -0,0 +1,226 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from archive import Archive
+from config import (CLIP_MODEL_NAME, CLIP_TEXT_MODEL_NAME, SEARCH_TOP_K, TEXT_CACHE_SIZE,
+                    TEXT_PRECOMPUTE_PHRASES)
+from database import connect
+from image_comparison import ImageComparator
+from image_processing import get_model, top_k_similarities
+from metrics import TEXT_CACHE_LOOKUPS, stage_timer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Текстовая модель CLIP загружается лениво, как и модель изображений
+_text_model = None
+_text_model_lock = threading.Lock()
+
+# Сигнал готовности: текстовая модель загружена, частые фразы посчитаны
+text_model_ready = threading.Event()
+
+# Частые сочетания категории и породы среди активных заявок - их эмбеддинги считаются заранее
+PHRASES_SQL = """
+    SELECT category, breed FROM requests
+    WHERE is_active = 1
+    GROUP BY category, breed
+    ORDER BY COUNT(*) DESC
+    LIMIT ?
+"""
+
+# Результат поиска: (request_id, user_id, request_type, city, category, breed, photo_hash, score)
+SearchResult = Tuple[int, int, str, str, str, str, str, float]
+
+
+def get_text_model():
+    """
+    Текстовая модель в пространстве эмбеддингов CLIP_MODEL_NAME.
+    Если отдельная модель не задана, текст кодирует сама модель CLIP
+    """
+    global _text_model
+    if not CLIP_TEXT_MODEL_NAME or CLIP_TEXT_MODEL_NAME == CLIP_MODEL_NAME:
+        return get_model()
+    if _text_model is None:
+        with _text_model_lock:
+            if _text_model is None:
+                started = time.perf_counter()
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    _text_model = SentenceTransformer(CLIP_TEXT_MODEL_NAME)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка при загрузке текстовой модели: {str(e)}")
+                    raise
+                logger.info(f"✅ Текстовая модель загружена за {time.perf_counter() - started:.1f} с")
+    return _text_model
+
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Кодирует батч строк текстовой моделью, векторы нормированы"""
+    with stage_timer("text_encode"):
+        vectors = np.asarray(get_text_model().encode(texts, batch_size=len(texts)), dtype=np.float32)
+    vectors = np.atleast_2d(vectors)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def normalize_query(text: str) -> str:
+    """Ключ кеша: регистр и лишние пробелы на эмбеддинг почти не влияют"""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class TextEmbeddingCache:
+    """LRU кеш эмбеддингов текстовых запросов; промахи кодируются одним батчем"""
+
+    def __init__(self, encode: Callable[[List[str]], np.ndarray] = encode_texts,
+                 max_size: int = TEXT_CACHE_SIZE):
+        self.encode = encode
+        self.max_size = max(1, max_size)
+        self._items: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get_many(self, texts: List[str]) -> np.ndarray:
+        keys = [normalize_query(text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for key in keys:
+                vector = self._items.get(key)
+                if vector is not None:
+                    self._items.move_to_end(key)
+                    found[key] = vector
+
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        TEXT_CACHE_LOOKUPS.inc(len(keys) - len(missing), result="hit")
+        if missing:
+            TEXT_CACHE_LOOKUPS.inc(len(missing), result="miss")
+            vectors = self.encode(missing)
+            with self._lock:
+                for key, vector in zip(missing, vectors):
+                    found[key] = vector
+                    self._items[key] = vector
+                    self._items.move_to_end(key)
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+        return np.stack([found[key] for key in keys])
+
+    def get(self, text: str) -> np.ndarray:
+        return self.get_many([text])[0]
+
+
+class TextSearch:
+    """
+    Поиск заявок по текстовому описанию (/search): запрос кодируется текстовой моделью
+    CLIP и ищется в том же индексе векторов, что и сопоставление фото
+    """
+
+    def __init__(self, comparator: ImageComparator, cache: Optional[TextEmbeddingCache] = None,
+                 top_k: int = SEARCH_TOP_K, archive: Optional[Archive] = None):
+        self.comparator = comparator
+        self.cache = cache or TextEmbeddingCache()
+        self.top_k = top_k
+        self.archive = archive or Archive(comparator.db_path)
+
+    def known_cities(self) -> Dict[str, str]:
+        """Города активных заявок из индекса: casefold -> как записано в заявках"""
+        return {city.casefold(): city for _, city, _ in self.comparator.index.partition_sizes()}
+
+    def parse_query(self, text: str) -> Tuple[str, Optional[str]]:
+        """
+        Разбирает аргументы /search: описание и необязательный город в конце
+        (город может состоять из нескольких слов: "Нижний Новгород")
+        """
+        words = text.split()
+        cities = self.known_cities()
+        for size in (3, 2, 1):
+            if len(words) > size:
+                city = cities.get(" ".join(words[-size:]).casefold())
+                if city is not None:
+                    return " ".join(words[:-size]), city
+        return " ".join(words), None
+
+    def precompute_phrases(self, limit: int = TEXT_PRECOMPUTE_PHRASES) -> int:
+        """Кладёт в кеш эмбеддинги частых категорий и пород; возвращает число фраз"""
+        conn = connect(self.comparator.db_path)
+        try:
+            rows = conn.execute(PHRASES_SQL, (limit,)).fetchall()
+        finally:
+            conn.close()
+        phrases = []
+        for category, breed in rows:
+            phrases.extend(phrase for phrase in (category, breed) if phrase)
+            if category and breed:
+                phrases.append(f"{breed} {category}")
+        phrases = list(dict.fromkeys(normalize_query(phrase) for phrase in phrases))[:self.cache.max_size]
+        if phrases:
+            self.cache.get_many(phrases)
+        return len(phrases)
+
+    def warm_up(self) -> float:
+        """Загружает текстовую модель и считает частые фразы. Возвращает длительность в секундах"""
+        started = time.perf_counter()
+        get_text_model()
+        self.comparator._sync_index()
+        count = self.precompute_phrases()
+        text_model_ready.set()
+        elapsed = time.perf_counter() - started
+        logger.info(f"Текстовый поиск готов за {elapsed:.1f} с, заранее посчитано фраз: {count}")
+        return elapsed
+
+    def start_warm_up(self) -> threading.Thread:
+        """Прогревает текстовый поиск в фоне, не задерживая запуск бота"""
+        def run():
+            try:
+                self.warm_up()
+            except Exception as e:
+                logger.error(f"❌ Прогрев текстового поиска не удался: {str(e)}")
+
+        thread = threading.Thread(target=run, name="text-search-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def _load_results(self, ids: np.ndarray, scores: np.ndarray) -> List[SearchResult]:
+        """Данные найденных заявок (деактивированные после синхронизации индекса отбрасываются)"""
+        if len(ids) == 0:
+            return []
+        conn = connect(self.comparator.db_path)
+        try:
+            placeholders = ", ".join("?" * len(ids))
+            rows = conn.execute(f"""
+                SELECT id, user_id, request_type, city, category, breed, photo_hash FROM requests
+                WHERE id IN ({placeholders}) AND is_active = 1
+            """, [int(req_id) for req_id in ids]).fetchall()
+        finally:
+            conn.close()
+        by_id = {row[0]: row for row in rows}
+        return [by_id[int(req_id)] + (float(score),) for req_id, score in zip(ids, scores)
+                if int(req_id) in by_id][:self.top_k]
+
+    def search(self, description: str, city: Optional[str] = None) -> List[SearchResult]:
+        """top-k активных заявок, чьи фото ближе всего к описанию; city ограничивает поиск городом"""
+        query = self.cache.get(description)
+        comparator = self.comparator
+        comparator._sync_index()
+
+        keys = [key for key in comparator.index.partition_sizes() if city is None or key[1] == city]
+        # С запасом: часть заявок могла быть деактивирована, сжатые оценки уточняются по float32
+        with stage_timer("scoring"):
+            ids, scores = comparator.index.search_many(keys, query, 2 * self.top_k)
+            if comparator.rerank and len(ids):
+                exact_ids, matrix = comparator.store.load_many(ids.tolist())
+                ids, scores = top_k_similarities(query, exact_ids, matrix, 2 * self.top_k)
+        return self._load_results(ids, scores)
+
+    def search_archive(self, description: str, city: Optional[str] = None) -> List[SearchResult]:
+        """То же по холодному архиву (/archive): без индекса, полным проходом по запросу"""
+        query = self.cache.get(description)
+        with stage_timer("scoring"):
+            return self.archive.search(query, city, self.top_k)
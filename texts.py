@@ -24,6 +24,23 @@ FOUNDPET = '''
 '''
 
 CANCEL = '↩️<b><i> Действие отменено</i></b>'
+SEARCH_USAGE = """
+🔎 <b>Поиск по описанию</b>
+
+Напишите, как выглядит питомец, и при желании город в конце:
+<code>/search рыжий кот с белыми лапами Москва</code>"""
+SEARCH_NOT_READY = "⏳ Поиск по описанию ещё запускается, попробуйте через минуту"
+SEARCH_EMPTY = "😔 По этому описанию пока ничего не нашлось"
+ARCHIVE_USAGE = """
+🗄 <b>Поиск по архиву</b>
+
+Старые и закрытые заявки хранятся в архиве. Напишите, как выглядит питомец, и при желании город в конце:
+<code>/archive рыжий кот Москва</code>"""
+ARCHIVE_EMPTY = "😔 В архиве по этому описанию ничего не нашлось"
+DUPLICATE_PHOTO = """
+🔁 <b>Похоже, вы уже отправляли это фото - такая заявка у вас уже есть.</b>
+
+Мы сообщим, как только найдём совпадение!"""
 NOT_PHOTO = """
 📷 <i><b>Пожалуйста, отправьте именно фотографию животного!
 
@@ -33,5 +50,9 @@ SIZE_TEXT = "📏 Выберите размер животного:"
 FUR_TEXT = "🧶 Выберите тип шерсти:"
 CITY_TEXT = "🌆 Введите город, где животное было потеряно/найдено:"
 CHIP_TEXT = "🔢 Если известно, введите номер чипа (или отправьте /skip):"
+CHIP_MATCH = """
+🎉 <b>Найдена заявка с тем же номером чипа!</b>
+
+Мы уже отправили вам и второму пользователю контакты друг друга."""
 SUCCESS = "✅ Данные сохранены! Начинаем поиск..."
 ERROR = "✅ Данные сохранены! Начинаем поиск..."
\ No newline at end of file
@@ -0,0 +1,49 @@
+import logging
+import random
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+from config import LOG_SAMPLE_RATE
+
+# Идентификатор трассы: заявка получает его в хендлере, он сохраняется в БД
+# и восстанавливается фоновой обработкой и отправкой уведомлений
+trace_id_var: ContextVar[str] = ContextVar("trace_id", default="-")
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def get_trace_id() -> str:
+    return trace_id_var.get()
+
+
+def set_trace_id(trace_id: Optional[str]) -> str:
+    """Устанавливает trace id текущего контекста (новый, если не передан)"""
+    trace_id = trace_id or new_trace_id()
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+class TraceIdFilter(logging.Filter):
+    """Добавляет trace_id в каждую запись лога"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+def setup_logging(level: int = logging.INFO):
+    """Формат логов с trace id; вызывается один раз при запуске бота"""
+    logging.basicConfig(level=level, format=LOG_FORMAT, force=True)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+
+
+def debug_sampled(logger: logging.Logger, message: str, rate: float = LOG_SAMPLE_RATE):
+    """Отладочный лог для горячих циклов: пишется только доля rate вызовов"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < rate:
+        logger.debug(message)
@@ -0,0 +1,132 @@
+"""
+Воркер сопоставления заявок: забирает задачи из очереди jobs (см. job_queue) и сравнивает
+заявки с противоположным пулом. Бот при JOB_QUEUE_ENABLED=1 только ставит задачи,
+поэтому воркеров можно запускать сколько угодно - на этой же машине или на другой
+с доступом к файлу БД.
+
+Запуск из корня репозитория:
+    python worker.py                    # один процесс
+    python worker.py --processes 4      # четыре процесса, по одному ядру на каждый
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+from typing import List, Optional
+
+from clip_backend import configure_threads
+from config import DATABASE_NAME, INFERENCE_THREADS, WORKER_POLL_SECONDS
+from database import initialize_database
+from metrics import start_metrics_server
+from tracing import setup_logging
+from worker_pool import WorkerPool, worker_pool
+
+logger = logging.getLogger(__name__)
+
+async def _heartbeat(processor, worker_id: str, active: List[int]):
+    """Продлевает аренду задач, пока воркер их обрабатывает"""
+    while True:
+        await asyncio.sleep(processor.jobs.lease_seconds / 3)
+        if active:
+            await processor.pool.run_db(processor.jobs.heartbeat, worker_id, list(active))
+
+
+async def run_worker(db_path: str = DATABASE_NAME, worker_id: Optional[str] = None,
+                     batch: int = 8, exit_when_idle: bool = False) -> int:
+    """
+    Цикл воркера: вернуть просроченные задачи, взять пачку в аренду, обработать.
+    С exit_when_idle завершается, когда очередь пуста. Возвращает число обработанных задач
+    """
+    from background_tasks import BackgroundProcessor
+
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    # Инференс в процессе воркера: масштабирование - числом воркеров, а не пулом внутри
+    worker_pool.inference_processes = 0
+    processor = BackgroundProcessor(None, db_path, pool=WorkerPool(inference_processes=0),
+                                    use_job_queue=False)
+    active: List[int] = []
+    heartbeat = asyncio.create_task(_heartbeat(processor, worker_id, active))
+    processed = 0
+    logger.info(f"Воркер {worker_id} запущен")
+
+    try:
+        while True:
+            # Деактивированные в боте и перенесённые в архив заявки уходят из индекса по журналу
+            await processor.pool.run_db(processor.comparator.sync)
+            await processor.pool.run_db(processor.jobs.reclaim_expired)
+            jobs = await processor.pool.run_db(processor.jobs.claim, worker_id, batch)
+            if not jobs:
+                if exit_when_idle:
+                    break
+                await asyncio.sleep(WORKER_POLL_SECONDS)
+                continue
+
+            active.extend(job[0] for job in jobs)
+            for job in jobs:
+                await processor.run_job(worker_id, job)
+                active.remove(job[0])
+                processed += 1
+    finally:
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+        await processor.pool.shutdown()
+        logger.info(f"Воркер {worker_id} остановлен, обработано задач: {processed}")
+    return processed
+
+
+async def _serve(db_path: str, exit_when_idle: bool, metrics_port: int):
+    metrics_runner = await start_metrics_server(port=metrics_port)
+    try:
+        await run_worker(db_path, exit_when_idle=exit_when_idle)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+def _worker_process(db_path: str, threads: int, exit_when_idle: bool, metrics_port: int = 0):
+    setup_logging()
+    configure_threads(threads)
+    try:
+        asyncio.run(_serve(db_path, exit_when_idle, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=INFERENCE_THREADS,
+                        help="потоков инференса на процесс (0 - по умолчанию)")
+    parser.add_argument("--exit-when-idle", action="store_true", help="завершиться, когда очередь пуста")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="порт /metrics первого процесса, у следующих +1, +2... (0 - выключен)")
+    args = parser.parse_args()
+
+    setup_logging()
+    initialize_database(args.db)
+    if args.processes <= 1:
+        _worker_process(args.db, args.threads, args.exit_when_idle, args.metrics_port)
+        return
+
+    # spawn: у каждого процесса своя модель и свои потоки torch
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_worker_process, args=(args.db, args.threads, args.exit_when_idle,
+                                                      args.metrics_port + i if args.metrics_port else 0))
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
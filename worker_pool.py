@@ -0,0 +1,102 @@
+import asyncio
+import contextvars
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional, Set
+
+from config import DB_WORKERS, INFERENCE_PROCESSES, WORKER_MAX_PENDING
+from metrics import WORKER_PENDING
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    Выносит блокирующую работу из event loop aiogram:
+    пул потоков для SQLite и пул процессов для инференса CLIP.
+    Количество одновременных задач ограничено - при заполнении вызывающий ждёт (backpressure)
+    """
+
+    def __init__(self, db_workers: int = DB_WORKERS,
+                 inference_processes: int = INFERENCE_PROCESSES,
+                 max_pending: int = WORKER_MAX_PENDING):
+        self.db_workers = db_workers
+        self.inference_processes = inference_processes
+        self.max_pending = max_pending
+        self._db_executor: Optional[ThreadPoolExecutor] = None
+        self._inference_executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pending: Set[asyncio.Future] = set()
+        self._closed = False
+
+    @property
+    def db_executor(self) -> ThreadPoolExecutor:
+        if self._db_executor is None:
+            self._db_executor = ThreadPoolExecutor(self.db_workers, thread_name_prefix="db")
+        return self._db_executor
+
+    @property
+    def inference_executor(self) -> Optional[ProcessPoolExecutor]:
+        """Пул процессов для инференса или None, если инференс идёт в текущем процессе"""
+        if self.inference_processes <= 0:
+            return None
+        if self._inference_executor is None:
+            # spawn: torch небезопасно наследовать через fork из многопоточного процесса
+            self._inference_executor = ProcessPoolExecutor(
+                self.inference_processes,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._inference_executor
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def run_db(self, fn: Callable, *args, **kwargs) -> Any:
+        """Выполняет работу с БД (и прочий блокирующий код) в пуле потоков"""
+        return await self._run(self.db_executor, fn, *args, **kwargs)
+
+    async def run_inference(self, fn: Callable, *args, **kwargs) -> Any:
+        """Выполняет CPU-тяжёлую функцию в пуле процессов"""
+        return await self._run(self.inference_executor or self.db_executor, fn, *args, **kwargs)
+
+    async def _run(self, executor: Executor, fn: Callable, *args, **kwargs) -> Any:
+        if self._closed:
+            raise RuntimeError("Worker pool is stopped")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+
+        async with self._slots:
+            # Контекст (trace id) переносится в поток; в пул процессов передаётся только функция
+            call = partial(fn, *args, **kwargs)
+            if isinstance(executor, ThreadPoolExecutor):
+                call = partial(contextvars.copy_context().run, call)
+            future = asyncio.get_running_loop().run_in_executor(executor, call)
+            self._pending.add(future)
+            try:
+                return await future
+            finally:
+                self._pending.discard(future)
+
+    async def shutdown(self):
+        """Отменяет ожидающие задачи и останавливает пулы"""
+        self._closed = True
+        for future in list(self._pending):
+            future.cancel()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+        for executor in (self._db_executor, self._inference_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._db_executor = None
+        self._inference_executor = None
+        logger.info("Пулы воркеров остановлены")
+
+
+# Общий пул для хендлеров и фоновых задач
+worker_pool = WorkerPool()
+WORKER_PENDING.set_function(lambda: worker_pool.pending)